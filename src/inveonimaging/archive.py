@@ -0,0 +1,188 @@
+import io
+import os
+import sys
+import tarfile
+import zipfile
+
+from inveonimaging.inveon import InveonImage, get_img_path, check_extra_file, pair_img_files
+
+
+# Inveon studies read straight from zip and tar archives (including a tar streamed on
+# stdin). Headers are parsed and pixel data are streamed from the archive members;
+# nothing is extracted to disk. .img members may themselves be compressed (foo.img.gz).
+# Members may sit in nested folders; foo.img is paired with foo.img.hdr in the same folder.
+
+
+# "-" is a tar archive on stdin
+def is_archive(path: str) -> bool:
+    if (path == "-"):
+        return True
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def open_archive(path: str):
+    if (path == "-"):
+        return TarStream(sys.stdin.buffer)
+    if (zipfile.is_zipfile(path)):
+        return ZipArchive(path)
+    return TarArchive(path)
+
+
+# Archive whose members can be opened in any order (zip file, tar file on disk)
+class RandomAccessArchive:
+    def __init__(
+            self,
+            path: str):
+        self.path = path
+
+    def get_names(self) -> list:
+        raise NotImplementedError
+
+    def open_member(self, name: str):
+        raise NotImplementedError
+
+    # Parsed images, in archive order
+    def iterate_images(self, study_description: str, ignore_all_extra_files: bool,
+                       ignore_specific_extra_files: list):
+        names = self.get_names()
+        found = set(names)
+        img_files = pair_img_files(names, lambda name: name in found,
+                                   ignore_all_extra_files, ignore_specific_extra_files)
+        for img_file in img_files:
+            yield InveonImage(study_description, img_file, self).parse_header()
+
+
+# Stored members are read in place; deflated members are inflated as they are read
+class ZipArchive(RandomAccessArchive):
+    def __init__(
+            self,
+            path: str):
+        super().__init__(path)
+        self.zip_file = zipfile.ZipFile(path)
+
+    def get_names(self) -> list:
+        return [info.filename for info in self.zip_file.infolist() if not info.is_dir()]
+
+    def open_member(self, name: str):
+        return self.zip_file.open(name)
+
+
+# Plain or compressed (.tar.gz, .tgz, .tar.xz, .tar.bz2) tar file
+class TarArchive(RandomAccessArchive):
+    def __init__(
+            self,
+            path: str):
+        super().__init__(path)
+        self.tar_file = tarfile.open(path, "r:*")
+
+    def get_names(self) -> list:
+        return [member.name for member in self.tar_file.getmembers() if member.isfile()]
+
+    def open_member(self, name: str):
+        return self.tar_file.extractfile(name)
+
+
+# A member of a tar stream. The stream can only move forward, so seeking forward reads
+# and discards and seeking backward is an error. Reports itself seekable so the
+# decompressors accept it for compressed .img members.
+class ForwardStream(io.RawIOBase):
+    def __init__(
+            self,
+            fh):
+        self.fh       = fh
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = self.fh.readinto(buffer)
+        self.position += count
+        return count
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if (whence == io.SEEK_CUR):
+            offset += self.position
+        elif (whence != io.SEEK_SET):
+            raise Exception("A tar stream can not seek from the end of a member")
+        if (offset < self.position):
+            raise Exception(f"A tar stream can not seek backward from {self.position} to {offset}")
+        while (self.position < offset):
+            skipped = self.fh.read(min(offset - self.position, 1024 * 1024))
+            if (len(skipped) == 0):
+                break
+            self.position += len(skipped)
+        return self.position
+
+
+# Tar archive read once, front to back, from a pipe. Headers are kept in memory as they
+# go by. An .img member whose header has already been seen is converted while the
+# archive is positioned on it, so its pixels are streamed straight from the pipe;
+# an .img member that arrives before its header has to be held in memory until the
+# header turns up.
+class TarStream:
+    def __init__(
+            self,
+            fileobj):
+        self.tar_file     = tarfile.open(fileobj=fileobj, mode="r|*")
+        self.buffered     = {}
+        self.current_name = None
+        self.current_fh   = None
+
+    def open_member(self, name: str):
+        if (name in self.buffered):
+            return io.BytesIO(self.buffered[name])
+        if (name == self.current_name and self.current_fh is not None):
+            fh, self.current_fh = self.current_fh, None
+            return fh
+        raise Exception(f"Archive member {name} can only be read once, in archive order, from a tar stream")
+
+    # Parsed images, in the order their pixel data can be read. Each image must be
+    # converted before the next one is requested.
+    def iterate_images(self, study_description: str, ignore_all_extra_files: bool,
+                       ignore_specific_extra_files: list):
+        waiting_img_files = {}
+        paired_hdr_files  = set()
+
+        for member in self.tar_file:
+            if (not member.isfile()):
+                continue
+            name = member.name
+            img_path = get_img_path(name)
+            if (img_path is not None):
+                hdr_file = f"{img_path}.hdr"
+                if (hdr_file in paired_hdr_files or hdr_file in waiting_img_files):
+                    raise Exception(f"We found this .hdr file {hdr_file} with more than one .img file")
+                if (hdr_file in self.buffered):
+                    paired_hdr_files.add(hdr_file)
+                    self.current_name = name
+                    self.current_fh   = ForwardStream(self.tar_file.extractfile(member))
+                    yield InveonImage(study_description, name, self).parse_header()
+                    self.current_name = None
+                    self.current_fh   = None
+                else:
+                    self.buffered[name] = self.tar_file.extractfile(member).read()
+                    waiting_img_files[hdr_file] = name
+
+            elif (name.endswith(".hdr")):
+                self.buffered[name] = self.tar_file.extractfile(member).read()
+                if (name in waiting_img_files):
+                    img_file = waiting_img_files.pop(name)
+                    paired_hdr_files.add(name)
+                    yield InveonImage(study_description, img_file, self).parse_header()
+                    del self.buffered[img_file]
+
+            else:
+                check_extra_file(name, ignore_all_extra_files, ignore_specific_extra_files)
+
+        for hdr_file, img_file in waiting_img_files.items():
+            raise Exception(f"We found this .img file {img_file} with no corresponding .hdr file")
+        for hdr_file in self.buffered:
+            if (hdr_file.endswith(".hdr") and hdr_file not in paired_hdr_files):
+                raise Exception(f"We found this .hdr file {hdr_file} with no corresponding .img file")
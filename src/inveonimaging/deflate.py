@@ -0,0 +1,89 @@
+import zlib
+import threading
+from pydicom.dataset import FileDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset, write_file_meta_info
+
+
+# Deflated Explicit VR Little Endian (PS3.5 A.5): the preamble and file meta information
+# are written as usual and everything after them is one raw deflate stream.
+
+# zlib's own default, a balance of size and speed
+DEFAULT_DEFLATE_LEVEL = 6
+
+
+# Compresses what is written to it into fh as it arrives, so a file is never held in
+# memory whole. finish() ends the stream and pads it to an even length.
+class DeflateStream:
+    def __init__(
+            self,
+            fh,
+            level: int = DEFAULT_DEFLATE_LEVEL):
+        self.fh               = fh
+        self.compressor       = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.input_length     = 0
+        self.output_length    = 0
+
+    def write(self, data) -> int:
+        compressed = self.compressor.compress(data)
+        self.fh.write(compressed)
+        self.output_length += len(compressed)
+        length = data.nbytes if (isinstance(data, memoryview)) else len(data)
+        self.input_length  += length
+        return length
+
+    def finish(self) -> None:
+        compressed = self.compressor.flush()
+        if ((self.output_length + len(compressed)) % 2 == 1):
+            compressed += b"\0"
+        self.fh.write(compressed)
+        self.output_length += len(compressed)
+
+
+# Writes the preamble and file meta information of file_dataset to fh, then its elements
+# through a DeflateStream, which is returned so that the large elements (per-frame
+# functional groups, PixelData) can be streamed after them before it is finished. The
+# elements of the dataset itself are small and are encoded in memory first.
+def start_deflated_file(fh, file_dataset: FileDataset, level: int = DEFAULT_DEFLATE_LEVEL) -> DeflateStream:
+    if (file_dataset.preamble):
+        fh.write(file_dataset.preamble + b"DICM")
+    write_file_meta_info(fh, file_dataset.file_meta, enforce_standard=False)
+
+    buffer = DicomBytesIO()
+    buffer.is_little_endian = True
+    buffer.is_implicit_VR   = False
+    write_dataset(buffer, file_dataset)
+
+    stream = DeflateStream(fh, level)
+    stream.write(buffer.getvalue())
+    return stream
+
+
+# Totals of the deflated files of a conversion, for choosing a compression level: bytes
+# before and after deflating and the time spent writing them. Files are written from
+# several threads, so updates are locked.
+class CompressionStatistics:
+    def __init__(
+            self):
+        self.file_count    = 0
+        self.input_length  = 0
+        self.output_length = 0
+        self.seconds       = 0.
+        self.lock          = threading.Lock()
+
+    def add(self, stream: DeflateStream, seconds: float) -> None:
+        with self.lock:
+            self.file_count    += 1
+            self.input_length  += stream.input_length
+            self.output_length += stream.output_length
+            self.seconds       += seconds
+
+    def format_report(self, level: int) -> str:
+        if (self.file_count == 0):
+            return f"Deflate level {level}: no files written"
+        ratio = self.input_length / self.output_length if (self.output_length > 0) else 0.
+        rate  = self.input_length / self.seconds / 1e6 if (self.seconds > 0) else 0.
+        return (f"Deflate level {level}: {self.file_count} files, {self.input_length / 1e6:.1f} MB deflated to "
+                f"{self.output_length / 1e6:.1f} MB ({ratio:.1f}x smaller) in {self.seconds:.2f} s of "
+                f"compression ({rate:.1f} MB/s per thread)")
+
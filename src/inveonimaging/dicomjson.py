@@ -0,0 +1,87 @@
+import json
+import posixpath
+from pydicom.dataset import FileDataset
+from pydicom.filewriter import correct_ambiguous_vr
+from pydicom.tag import Tag
+
+from inveonimaging.sinks import FolderSink
+from inveonimaging.writer import PIXEL_DATA_TAG
+
+
+METADATA_FILE_NAME = "metadata.json"
+BULK_DATA_FOLDER   = "bulkdata"
+
+
+# Writes the single-frame instances of a series as DICOM JSON (PS3.18 F.2) instead of
+# Part 10 files: one metadata.json holding the array of instances, as a DICOMweb series
+# metadata request returns it, and the pixels of each instance as a raw little endian
+# bulk data file referenced from it by a relative BulkDataURI (bulkdata/PET-000001.raw).
+#
+# Used in place of an InstanceWriter, with the same template (see Factory.write_instance).
+# The template's elements that do not vary between instances are converted to JSON text
+# once, for the first instance; each instance then only converts the elements named in
+# varying_keywords and splices them in, in tag order. The pixels are written to the bulk
+# data file straight from the buffer the template holds.
+class DicomJSONWriter:
+    def __init__(
+            self,
+            varying_keywords: list,
+            output_sink=None):
+        self.varying_tags = {Tag(keyword) for keyword in varying_keywords} - {PIXEL_DATA_TAG}
+        self.output_sink  = output_sink if (output_sink is not None) else FolderSink()
+        self.folder       = None
+        self.segments     = None
+        self.instances    = []
+
+    # path is where the Part 10 file would be written; the bulk data file is named after it
+    def write(self, template: FileDataset, path: str) -> None:
+        folder, file_name = posixpath.split(path.replace("\\", "/"))
+        if (self.segments is None):
+            self.encode_static_elements(template)
+            self.folder = folder
+            self.output_sink.create_folder(f"{folder}/{BULK_DATA_FOLDER}", True)
+        elif (folder != self.folder):
+            raise Exception(f"Instances of one series must share a folder: {folder} and {self.folder}")
+
+        fields = []
+        for segment in self.segments:
+            if (isinstance(segment, str)):
+                fields.append(segment)
+            elif (segment not in template):
+                continue
+            elif (segment == PIXEL_DATA_TAG):
+                fields.append(self.write_bulk_data(template, file_name))
+            else:
+                fields.append(encode_element(template[segment]))
+        self.instances.append("{" + ",".join(fields) + "}")
+
+    # The JSON of every element that does not vary, and the tags of those that do, in tag order
+    def encode_static_elements(self, template: FileDataset) -> None:
+        correct_ambiguous_vr(template, True)
+        self.segments = []
+        for tag in sorted(set(template.keys()) | self.varying_tags | {PIXEL_DATA_TAG}):
+            if (tag in self.varying_tags or tag == PIXEL_DATA_TAG):
+                self.segments.append(tag)
+            elif (not (tag.element == 0 and tag.group > 6)):
+                self.segments.append(encode_element(template[tag]))
+
+    # The pixels of an instance as a bulk data file, and the PixelData field referring to it
+    def write_bulk_data(self, template: FileDataset, file_name: str) -> str:
+        uri = f"{BULK_DATA_FOLDER}/{posixpath.splitext(file_name)[0]}.raw"
+        self.output_sink.write_file(f"{self.folder}/{uri}", [template.PixelData])
+        return f'"{PIXEL_DATA_TAG:08X}":' + json.dumps({"vr": "OW", "BulkDataURI": uri})
+
+    # Writes metadata.json once all instances are written
+    def close(self) -> None:
+        if (self.folder is None):
+            return
+        text = "[" + ",\n".join(self.instances) + "]\n"
+        self.output_sink.write_file(f"{self.folder}/{METADATA_FILE_NAME}", [text.encode("utf-8")])
+        self.instances = []
+        self.folder    = None
+
+
+# One element as a "tag": {...} field of a DICOM JSON object. Binary values other than
+# the pixels are small and stay inline.
+def encode_element(element) -> str:
+    return f'"{element.tag:08X}":' + json.dumps(element.to_json_dict(None, 0))
@@ -0,0 +1,121 @@
+import re
+import numpy
+
+
+# Formatting of numbers as DICOM DS (decimal string) and IS (integer string) values.
+#
+# DS values are written in scientific notation with a fixed number of digits after the
+# decimal point ('%.nE'), then the exponent is shortened in one of these styles:
+#   compact   no plus sign, no leading zero      1.2345000E1   7.9600000E-1   0.0000000E0
+#   signed    sign kept, no leading zero         1.23450E+1    7.96000E-1
+#   unsigned  no plus sign, leading zero kept    1.2345E1      7.9600E-01
+#   plain     as printed by '%.nE'               1.23E+01      7.96E-01
+# Whole arrays are formatted with one % operation and a few str.replace calls on the
+# joined text, instead of Decimal conversions and regular expressions per value. A single
+# value is printed with a prepared format and its exponent looked up in a table; the
+# scalar fields the factory formats are the same header values series after series, so
+# each distinct request is also kept in DS_CACHE.
+
+DS_MAX_LENGTH = 16
+IS_MAX_LENGTH = 12
+IS_MIN_VALUE  = -2**31
+IS_MAX_VALUE  = 2**31 - 1
+
+EXPONENT_REPLACEMENTS = {
+    "compact":  (("E+0", "E"), ("E-0", "E-"), ("E+", "E")),
+    "signed":   (("E+0", "E+"), ("E-0", "E-")),
+    "unsigned": (("E+0", "E"), ("E+", "E")),
+    "plain":    (),
+}
+
+# The last digit of the mantissa when it is a zero preceded by at least five digits
+TRAILING_ZERO = re.compile("(?<=[0-9]{5})0E")
+
+# Bound str.format of '{:.nE}' for each precision
+DS_FORMATTERS = [("{:.%dE}" % precision).format for precision in range(DS_MAX_LENGTH)]
+
+
+def shorten_exponent(exponent: str, style: str) -> str:
+    for old, new in EXPONENT_REPLACEMENTS[style]:
+        exponent = exponent.replace(old, new)
+    return exponent
+
+
+# Two digit exponents ('E+01', 'E-07') as each style writes them; longer ones are rare
+# and take the str.replace path
+EXPONENT_TABLES = {style: {exponent: shorten_exponent(exponent, style)
+                           for exponent in ("E%+03d" % power for power in range(-99, 100))}
+                   for style in EXPONENT_REPLACEMENTS}
+
+DS_CACHE      = {}
+DS_CACHE_SIZE = 4096
+
+
+def format_ds(value, precision: int, style: str = "compact", trim_zero: bool = False) -> str:
+    key  = (value, precision, style, trim_zero)
+    text = DS_CACHE.get(key)
+    if (text is not None):
+        return text
+
+    text = DS_FORMATTERS[precision](float(value))
+    exponent = EXPONENT_TABLES[style].get(text[-4:])
+    if (exponent is not None):
+        text = text[:-4] + exponent
+    else:
+        text = shorten_exponent(text, style)
+    if (trim_zero):
+        text = TRAILING_ZERO.sub("E", text)
+    if (len(text) > DS_MAX_LENGTH):
+        text = shorten_ds(value, precision, style, trim_zero)
+
+    # 0.0 and -0.0 are equal keys but have their own strings, so zeros are not kept
+    if (value and len(DS_CACHE) < DS_CACHE_SIZE):
+        DS_CACHE[key] = text
+    return text
+
+
+# One DS string for each value of an array (or any sequence of numbers), in order.
+# Each distinct value is formatted once: across the slices of a stack most coordinates
+# repeat. Values are told apart by their bits, so 0.0 and -0.0 keep their own strings.
+def format_ds_array(values, precision: int, style: str = "compact", trim_zero: bool = False) -> list:
+    values = numpy.ascontiguousarray(values, numpy.float64).ravel()
+    if (len(values) == 0):
+        return []
+    bits, inverse = numpy.unique(values.view(numpy.int64), return_inverse=True)
+    distinct = bits.view(numpy.float64).tolist()
+
+    text = (f"%.{precision}E\n" * len(distinct)) % tuple(distinct)
+    for old, new in EXPONENT_REPLACEMENTS[style]:
+        text = text.replace(old, new)
+    if (trim_zero):
+        text = TRAILING_ZERO.sub("E", text)
+
+    strings = text.split("\n")
+    strings.pop()
+    if (max(map(len, strings)) > DS_MAX_LENGTH):
+        strings = [string if (len(string) <= DS_MAX_LENGTH) else shorten_ds(value, precision, style, trim_zero)
+                   for string, value in zip(strings, distinct)]
+    return list(map(strings.__getitem__, inverse.ravel().tolist()))
+
+
+# Drop digits until the value fits in the 16 characters DS allows
+def shorten_ds(value, precision: int, style: str, trim_zero: bool) -> str:
+    for shorter in range(precision - 1, -1, -1):
+        text = format_ds(value, shorter, style, trim_zero)
+        if (len(text) <= DS_MAX_LENGTH):
+            return text
+    raise Exception(f"Can not write {value} as a DICOM decimal string of at most {DS_MAX_LENGTH} characters")
+
+
+def format_is(value) -> str:
+    value = int(value)
+    if (value < IS_MIN_VALUE or value > IS_MAX_VALUE):
+        raise Exception(f"Can not write {value} as a DICOM integer string, the range is {IS_MIN_VALUE} to {IS_MAX_VALUE}")
+    return str(value)
+
+
+def format_is_array(values) -> list:
+    values = numpy.asarray(values)
+    if (values.size > 0 and (values.min() < IS_MIN_VALUE or values.max() > IS_MAX_VALUE)):
+        raise Exception(f"Can not write values outside {IS_MIN_VALUE} to {IS_MAX_VALUE} as DICOM integer strings")
+    return [str(value) for value in values.astype(numpy.int64).ravel().tolist()]
@@ -1,13 +1,14 @@
 from pathlib import Path
 import os
 import json
+import math
 import numpy
-import re
+import struct
+from time import perf_counter
 from dateutil.parser import *
 from dateutil.tz import *
 from dateutil.relativedelta import *
 from datetime import *
-from decimal import Decimal
 
 import pydicom
 from pydicom.sequence import Sequence
@@ -15,17 +16,39 @@ from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
 from pydicom.uid import generate_uid, UID
 from inveonimaging.inveon import InveonImage
 from inveonimaging.inveon import InveonImage
+from inveonimaging.geometry import ImageGeometry
+from inveonimaging.dicomstrings import format_ds, format_ds_array
+from inveonimaging.uids import UIDProvider
+from inveonimaging.writer import InstanceWriter
+from inveonimaging.deflate import CompressionStatistics, DEFAULT_DEFLATE_LEVEL, start_deflated_file
+from inveonimaging.sinks import FolderSink
+from inveonimaging.dicomjson import DicomJSONWriter
+from inveonimaging.framegroups import PerFrameFunctionalGroups, PER_FRAME_FUNCTIONAL_GROUPS_TAG
+from inveonimaging.pixels import BufferPool, FrameNormalizer, PixelDataStream, ReadAhead, iterate_pixel_blocks
+from inveonimaging.rle import RLEFrameEncoder, encapsulate_frame, write_encapsulated_frames, get_max_rle_frame_length
 from inveonimaging.invdicom import PatientModule, GeneralStudyModule,  GeneralEquipmentModule, \
     EnhancedGeneralEquipmentModule, \
     GeneralSeriesModule, FrameOfReferenceModule, GeneralAcquisitionModule, \
     GeneralImageModule, ImagePlaneModule, ImagePixelModule, MultiframeFunctionalGroupsModule, \
     MultiframeDimensionModule, ContrastBolusModule, SOPCommonModule, \
-    AcquisitionContextModule, FrameContentItem, \
+    AcquisitionContextModule, \
     PETSeriesModule, PETIsotopeModule, NMPETPatientOrientation, \
     PETImageModule, EnhancedPETImageModule, CTImageModule, EnhancedCTImageModule, \
     mergeDatasets, mergeDatasetsVerbose, PatientStudyModule
 
 
+# Elements that the patch_* methods change from one single-frame instance to the next
+PET_INSTANCE_KEYWORDS = ["AcquisitionTime", "RescaleSlope", "FrameReferenceTime", "ActualFrameDuration", "DecayFactor",
+                         "InstanceNumber", "AcquisitionNumber", "SOPInstanceUID", "ImagePositionPatient",
+                         "SliceLocation", "ImageIndex", "PixelData"]
+CT_INSTANCE_KEYWORDS  = ["InstanceNumber", "SOPInstanceUID", "ImagePositionPatient", "SliceLocation", "PixelData"]
+
+# Transfer syntaxes the files can be written in, by the name set_transfer_syntax takes
+TRANSFER_SYNTAXES = {"explicit": pydicom.uid.ExplicitVRLittleEndian,
+                     "deflate":  pydicom.uid.DeflatedExplicitVRLittleEndian,
+                     "rle":      pydicom.uid.RLELossless}
+
+
 class Factory:
     def __init__(
             self):
@@ -34,6 +57,22 @@ class Factory:
         self.instance_number    = 1
         self.file_prefix_map    = {}
         self.code_table         = None
+        self.frame_normalizer   = None
+        self.slice_pool         = None
+        self.frame_values       = None
+        self.integer_slopes     = None
+        self.slice_geometry     = None
+        self.read_ahead_depth   = 0
+        self.read_ahead         = None
+        self.uid_provider       = UIDProvider()
+        self.series_key         = None
+        self.instance_uids      = None
+        self.transfer_syntax    = "explicit"
+        self.jobs               = 1
+        self.deflate_level      = DEFAULT_DEFLATE_LEVEL
+        self.compression_stats  = CompressionStatistics()
+        self.output_sink        = FolderSink()
+        self.json_output        = False
 
     def import_code_table_file(self, path: str) -> None:
         with open(path) as f:
@@ -49,6 +88,71 @@ class Factory:
             return self.code_table[key]
         else:
             return None
+    # Number of slices (or PET time frames) to read ahead of the writer on a background
+    # thread. 0 reads pixels on demand.
+    def set_read_ahead(self, depth: int) -> None:
+        if (depth < 0):
+            raise Exception(f"Read-ahead depth must not be negative: {depth}")
+        self.read_ahead_depth = depth
+
+    # Start reading the pixels of the selection in the background, in the order the
+    # single frame writers ask for them. Normalized data types are read a time frame at a time.
+    def start_read_ahead(self, inveon_image: InveonImage, time_frames, slices) -> None:
+        self.stop_read_ahead()
+        if (self.read_ahead_depth <= 0):
+            return
+        if (inveon_image.get_header().data_type in (1, 2, 6)):
+            keys = [(time_index, slice_index) for time_index in time_frames for slice_index in slices]
+        else:
+            keys = [(time_index, None) for time_index in time_frames]
+        # One block is being written, read_ahead_depth are queued and one is being read
+        self.read_ahead = ReadAhead(iterate_pixel_blocks(inveon_image, keys, self.read_ahead_depth + 2),
+                                    self.read_ahead_depth)
+
+    def stop_read_ahead(self) -> None:
+        if (self.read_ahead is not None):
+            self.read_ahead.stop()
+            self.read_ahead = None
+
+    # "explicit" (Explicit VR Little Endian, the default), "deflate" (Deflated Explicit VR
+    # Little Endian) or "rle" (RLE Lossless)
+    def set_transfer_syntax(self, name: str) -> None:
+        if (name not in TRANSFER_SYNTAXES):
+            raise Exception(f"Unsupported transfer syntax {name}, expected one of {', '.join(TRANSFER_SYNTAXES)}")
+        self.transfer_syntax = name
+
+    def is_encapsulated(self) -> bool:
+        return self.transfer_syntax == "rle"
+
+    def is_deflated(self) -> bool:
+        return self.transfer_syntax == "deflate"
+
+    # zlib compression level of every deflated file, 0 (none, fastest) to 9 (smallest)
+    def set_deflate_level(self, level: int) -> None:
+        if (level < 0 or level > 9):
+            raise Exception(f"Deflate level must be between 0 and 9: {level}")
+        self.deflate_level = level
+
+    # Sizes and compression time of the deflated files written so far
+    def get_compression_report(self) -> str:
+        return self.compression_stats.format_report(self.deflate_level)
+
+    # Where the files are written: folders on disk (the default) or an archive (see sinks.py)
+    def set_output_sink(self, output_sink) -> None:
+        self.output_sink = output_sink
+
+    # Single-frame series are written as DICOM JSON metadata with raw bulk data files
+    # instead of Part 10 files (see DicomJSONWriter)
+    def set_json_output(self, json_output: bool) -> None:
+        self.json_output = json_output
+
+    # Number of workers for a compressed transfer syntax: processes that encode RLE frames,
+    # or threads that deflate single-frame instances. None uses one per CPU.
+    def set_jobs(self, jobs) -> None:
+        if (jobs is not None and jobs < 1):
+            raise Exception(f"The number of jobs must be at least 1: {jobs}")
+        self.jobs = jobs
+
     def get_series_number(self) -> int:
         return self.series_number
 
@@ -63,8 +167,42 @@ class Factory:
 
     def increment_instance_number(self) -> None:
         self.instance_number += 1
-    def generate_study_instance_uid(self) -> None:
-        self.study_instance_uid = generate_uid()
+    # With a namespace, UIDs are derived from the source files and the conversion options
+    # instead of being random, so a repeated conversion gives the same UIDs (see UIDProvider)
+    def set_uid_namespace(self, namespace: str) -> None:
+        self.uid_provider = UIDProvider(namespace)
+
+    # When UIDs are derived the study is named by the source identities of its images
+    # (see InveonImage.get_source_identity), in sorted order so the order the images are
+    # found in does not matter
+    def generate_study_instance_uid(self, source_identities: list) -> None:
+        self.study_instance_uid = self.uid_provider.derive_uid("study", *sorted(source_identities))
+
+    def has_study_instance_uid(self) -> bool:
+        return self.study_instance_uid is not None
+
+    # Identifies the series written from an image: the source files, the kind of output
+    # and the time frame and slice selection. Series, Frame of Reference and SOP Instance
+    # UIDs are derived from it.
+    def begin_series(self, inveon_image: InveonImage, kind: str, time_frames: list, slices: list) -> None:
+        selection = f"{','.join(map(str, time_frames))}:{','.join(map(str, slices))}"
+        self.series_key    = (inveon_image, (inveon_image.get_source_identity(), kind, selection))
+        self.instance_uids = None
+
+    def get_series_key(self, inveon_image: InveonImage) -> tuple:
+        if (self.series_key is not None and self.series_key[0] is inveon_image):
+            return self.series_key[1]
+        return (inveon_image.get_source_identity(), "", "")
+
+    # SOP Instance UIDs of all the instances of the current series, made in one batch.
+    # Instance numbers count from 1.
+    def generate_instance_uids(self, inveon_image: InveonImage, count: int) -> None:
+        self.instance_uids = self.uid_provider.derive_uids(self.get_series_key(inveon_image) + ("instance",), count)
+
+    def get_instance_uid(self, inveon_image: InveonImage, instance_number: int) -> str:
+        if (self.instance_uids is not None and instance_number <= len(self.instance_uids)):
+            return self.instance_uids[instance_number - 1]
+        return self.uid_provider.derive_uid(*self.get_series_key(inveon_image), "instance", instance_number)
 
     def add_file_prefix(self, modality: str, prefix: str) -> None:
         self.file_prefix_map[modality] = prefix
@@ -77,94 +215,187 @@ class Factory:
     #  Multiframe data (one DICOM file)
     #  Legacy Converted Multiframe data (one DICOM file)
     #  Standard Images (one DICOM file per slice/timepoint)
-    def convert_to_multiframe(self, inveon_image: InveonImage, output_folder: str, file_name=None):
+    #
+    # time_frames and slices optionally restrict the conversion to a subset of the
+    # time frames and/or z range. Each is None (everything), a list of indices or a
+    # string such as "10-20" or "0,3,5-7". Indices number from 0 and ranges are inclusive.
+    def convert_to_multiframe(self, inveon_image: InveonImage, output_folder: str, file_name=None,
+                              time_frames=None, slices=None):
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        self.begin_series(inveon_image, "multiframe", time_frames, slices)
         modality_mapped = inveon_image.get_metadata_element("modality_mapped")
         if (modality_mapped == 'CT'):
-            self.create_write_dicom_multiframe_ct(inveon_image, output_folder, file_name)
+            self.create_write_dicom_multiframe_ct(inveon_image, output_folder, file_name, time_frames, slices)
         else:
-            self.create_write_dicom_multiframe_pet(inveon_image, output_folder, file_name)
+            self.create_write_dicom_multiframe_pet(inveon_image, output_folder, file_name, time_frames, slices)
 
         return None
 
-    def convert_to_legacy_converted_multiframe(self, inveon_image: InveonImage, output_folder: str, file_name=None):
+    def convert_to_legacy_converted_multiframe(self, inveon_image: InveonImage, output_folder: str, file_name=None,
+                                               time_frames=None, slices=None):
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        self.begin_series(inveon_image, "legacy converted", time_frames, slices)
         modality_mapped = inveon_image.get_metadata_element("modality_mapped")
         if (modality_mapped == 'CT'):
-            self.create_write_dicom_legacy_converted_multiframe_ct(inveon_image, output_folder, file_name)
+            self.create_write_dicom_legacy_converted_multiframe_ct(inveon_image, output_folder, file_name,
+                                                                   time_frames, slices)
         else:
-            self.create_write_dicom_legacy_converted_multiframe_pet(inveon_image, output_folder, file_name)
+            self.create_write_dicom_legacy_converted_multiframe_pet(inveon_image, output_folder, file_name,
+                                                                    time_frames, slices)
 
         return None
 
-    def convert_to_standard_images(self, inveon_image: InveonImage, overrides: {}, output_folder: str):
+    def convert_to_standard_images(self, inveon_image: InveonImage, overrides: {}, output_folder: str,
+                                   time_frames=None, slices=None):
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        self.begin_series(inveon_image, "single frame", time_frames, slices)
         modality_mapped = inveon_image.get_metadata_element("modality_mapped")
         if (modality_mapped == 'CT'):
-            self.create_write_dicom_files_ct(inveon_image, overrides, output_folder)
+            self.create_write_dicom_files_ct(inveon_image, overrides, output_folder, time_frames, slices)
         else:
-            self.create_write_dicom_files_pet(inveon_image, overrides, output_folder)
+            self.create_write_dicom_files_pet(inveon_image, overrides, output_folder, time_frames, slices)
 
         return None
 
-    def create_write_dicom_multiframe_ct(self, inveon_image: InveonImage, output_path: str, file_name=None):
+    def select_time_frames_and_slices(self, inveon_image: InveonImage, time_frames=None, slices=None):
+        frame_count = inveon_image.get_pixel_frame_count()
+        z_dimension = inveon_image.get_header().z_dimension
+        return (self.select_indices(time_frames, frame_count, "time frame"),
+                self.select_indices(slices, z_dimension, "slice"))
+
+    # Resolve a selection (None, list of indices, or "10-20" / "0,3,5-7") to a sorted list
+    # of indices in the range [0, count).
+    def select_indices(self, selection, count: int, label: str) -> list:
+        if (selection is None):
+            return list(range(count))
+
+        indices = set()
+        if (isinstance(selection, str)):
+            for token in selection.split(","):
+                token = token.strip()
+                if (token == ""):
+                    continue
+                if ("-" in token):
+                    first, last = token.split("-", 1)
+                    indices.update(range(int(first), int(last) + 1))
+                else:
+                    indices.add(int(token))
+        else:
+            indices.update(int(index) for index in selection)
+
+        if (len(indices) == 0):
+            raise Exception(f"Empty {label} selection {selection}")
+        for index in indices:
+            if (index < 0 or index >= count):
+                raise Exception(f"Requested {label} {index} is outside the range 0-{count - 1}")
+
+        return sorted(indices)
+
+    def create_write_dicom_multiframe_ct(self, inveon_image: InveonImage, output_path: str, file_name=None,
+                                         time_frames=None, slices=None):
         print(f"create_write_dicom_multiframe_ct {file_name}")
-        ds = self.create_enhanced_ct_dataset(inveon_image)
+        ds = self.create_enhanced_ct_dataset(inveon_image, time_frames, slices, False)
+        per_frame_groups = self.create_per_frame_functional_groups(inveon_image, time_frames, slices, False)
         self.create_output_folder(output_path, False)
-        self.write_dataset(ds, output_path, self.determine_filename(ds, file_name))
+        self.write_dataset_with_pixel_stream(ds, output_path, self.determine_filename(ds, file_name),
+                                             self.create_pixel_data_stream(inveon_image, time_frames, slices),
+                                             per_frame_groups)
         return None
 
-    def create_write_dicom_multiframe_pet(self, inveon_image: InveonImage, output_path: str, file_name=None):
+    def create_write_dicom_multiframe_pet(self, inveon_image: InveonImage, output_path: str, file_name=None,
+                                          time_frames=None, slices=None):
         print(f"create_write_dicom_multiframe_pet {file_name}")
-        ds = self.create_enhanced_pet_dataset(inveon_image)
+        ds = self.create_enhanced_pet_dataset(inveon_image, time_frames, slices, False)
+        per_frame_groups = self.create_per_frame_functional_groups(inveon_image, time_frames, slices, False)
         self.create_output_folder(output_path, False)
-        self.write_dataset(ds, output_path, self.determine_filename(ds, file_name))
+        self.write_dataset_with_pixel_stream(ds, output_path, self.determine_filename(ds, file_name),
+                                             self.create_pixel_data_stream(inveon_image, time_frames, slices),
+                                             per_frame_groups)
         return None
 
     def create_write_dicom_legacy_converted_multiframe_ct(self, inveon_image: InveonImage, output_path: str,
-                                                          file_name=None):
+                                                          file_name=None, time_frames=None, slices=None):
         print(f"create_write_dicom_multiframe_ct {file_name}")
-        ds = self.create_legacy_converted_enhanced_ct_dataset(inveon_image)
+        ds = self.create_legacy_converted_enhanced_ct_dataset(inveon_image, time_frames, slices, False)
+        per_frame_groups = self.create_per_frame_functional_groups(inveon_image, time_frames, slices, True)
         self.create_output_folder(output_path, False)
-        self.write_dataset(ds, output_path, self.determine_filename(ds, file_name))
+        self.write_dataset_with_pixel_stream(ds, output_path, self.determine_filename(ds, file_name),
+                                             self.create_pixel_data_stream(inveon_image, time_frames, slices),
+                                             per_frame_groups)
         return None
 
     def create_write_dicom_legacy_converted_multiframe_pet(self, inveon_image: InveonImage, output_path: str,
-                                                           file_name=None):
+                                                           file_name=None, time_frames=None, slices=None):
         print(f"create_write_dicom_multiframe_pet {file_name}")
-        ds = self.create_legacy_converted_enhanced_pet_dataset(inveon_image)
+        ds = self.create_legacy_converted_enhanced_pet_dataset(inveon_image, time_frames, slices, False)
+        per_frame_groups = self.create_per_frame_functional_groups(inveon_image, time_frames, slices, True)
         self.create_output_folder(output_path, False)
-        self.write_dataset(ds, output_path, self.determine_filename(ds, file_name))
+        self.write_dataset_with_pixel_stream(ds, output_path, self.determine_filename(ds, file_name),
+                                             self.create_pixel_data_stream(inveon_image, time_frames, slices),
+                                             per_frame_groups)
         return None
 
-    def create_write_dicom_files_ct(self, inveon_image: InveonImage, overrides: {}, output_path: str):
+    def create_write_dicom_files_ct(self, inveon_image: InveonImage, overrides: {}, output_path: str,
+                                    time_frames=None, slices=None):
 
         self.create_output_folder(output_path, True)
         ct_common = self.create_ct_common_elements(inveon_image, overrides)
         self.reset_instance_number()
 
-        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
-        total_frames = int(inveon_image.get_metadata_element("total_frames"))
-        frame_count = z_dimension * total_frames
-
-        for index in range(frame_count):
-            current_frame = index // z_dimension
-            frame_ds = self.fill_ct_per_frame_data(inveon_image, current_frame, index)
-            instance_ds = mergeDatasets(ct_common, frame_ds)
-            self.write_dataset(instance_ds, output_path, self.determine_filename(instance_ds, None))
-
-    def create_write_dicom_files_pet(self, inveon_image: InveonImage, overrides: {}, output_path: str):
+        z_dimension = inveon_image.get_header().z_dimension
+        total_frames = inveon_image.get_header().total_frames
+        if (time_frames is None):
+            time_frames = range(total_frames)
+        if (slices is None):
+            slices = range(z_dimension)
+
+        self.generate_instance_uids(inveon_image, len(time_frames) * len(slices))
+        template = self.create_instance_template(ct_common)
+        writer = self.create_instance_writer(CT_INSTANCE_KEYWORDS)
+        self.start_read_ahead(inveon_image, time_frames, slices)
+        pixel_frames = self.create_encoded_frames(inveon_image, time_frames, slices)
+        try:
+            for current_frame in time_frames:
+                for slice_index in slices:
+                    index = current_frame * z_dimension + slice_index
+                    self.patch_ct_instance(template, inveon_image, current_frame, index, pixel_frames)
+                    self.write_instance(template, output_path, writer)
+        finally:
+            if (pixel_frames is not None):
+                pixel_frames.close()
+            writer.close()
+            self.stop_read_ahead()
+
+    def create_write_dicom_files_pet(self, inveon_image: InveonImage, overrides: {}, output_path: str,
+                                     time_frames=None, slices=None):
 
         self.create_output_folder(output_path, True)
         pet_common = self.create_pet_common_elements(inveon_image, overrides)
         self.reset_instance_number()
 
-        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
-        time_frames = int(inveon_image.get_metadata_element("time_frames"))
+        z_dimension = inveon_image.get_header().z_dimension
+        if (time_frames is None):
+            time_frames = range(inveon_image.get_header().time_frames)
+        if (slices is None):
+            slices = range(z_dimension)
         overrides_ds = self.create_override_dataset(overrides)
 
-        for time_index in range(time_frames):
-            for frame_index in range(z_dimension):
-                frame_ds = self.fill_pet_per_frame_data(inveon_image, time_index, frame_index)
-                instance_ds = mergeDatasets(pet_common, frame_ds, overrides_ds)
-                self.write_dataset(instance_ds, output_path, self.determine_filename(instance_ds, None))
+        self.generate_instance_uids(inveon_image, len(time_frames) * len(slices))
+        template = self.create_instance_template(pet_common, overrides_ds)
+        writer = self.create_instance_writer(PET_INSTANCE_KEYWORDS)
+        self.start_read_ahead(inveon_image, time_frames, slices)
+        pixel_frames = self.create_encoded_frames(inveon_image, time_frames, slices)
+        try:
+            for time_index in time_frames:
+                self.patch_pet_time_frame(template, inveon_image, time_index)
+                for frame_index in slices:
+                    self.patch_pet_instance(template, inveon_image, time_index, frame_index, pixel_frames)
+                    self.write_instance(template, output_path, writer)
+        finally:
+            if (pixel_frames is not None):
+                pixel_frames.close()
+            writer.close()
+            self.stop_read_ahead()
 
     #        for frame_index in range(frame_count):
     #            time_frame = frame_index // z_dimension
@@ -176,25 +407,19 @@ class Factory:
 
     def create_override_dataset(self, overrides: {}) -> Dataset:
         ds = Dataset()
-        if (overrides["patient_name"] is not None):
+        if (overrides.get("patient_name") is not None):
             ds.PatientName = overrides["patient_name"]
-        if (overrides["patient_id"] is not None):
+        if (overrides.get("patient_id") is not None):
             ds.PatientID = overrides["patient_id"]
-        if (overrides["patient_birthdate"] is not None):
+        if (overrides.get("patient_birthdate") is not None):
             ds.PatientBirthDate = overrides["patient_birthdate"]
-        if (overrides["patient_sex"] is not None):
+        if (overrides.get("patient_sex") is not None):
             ds.PatientSex = overrides["patient_sex"]
 
         return ds
 
     def create_output_folder(self, folder: str, must_be_empty: bool) -> None:
-        if (os.path.exists(folder)):
-            if (not os.path.isdir(folder)):
-                raise Exception(f'The item identified by {folder} exists, but it is not a folder')
-            if (must_be_empty and (os.listdir(folder))):
-                raise Exception(f'The item identified by {folder} exists, but it is not empty')
-        else:
-            os.makedirs(folder, 0o777, True)
+        self.output_sink.create_folder(folder, must_be_empty)
 
     def determine_filename(self, ds: Dataset, file_name=None):
         if (file_name is None):
@@ -203,19 +428,106 @@ class Factory:
         return file_name
 
     def write_dataset(self, ds: Dataset, folder: str, file_name=None) -> None:
+        file_dataset = self.create_file_dataset(ds)
+        with self.output_sink.open_file(f"{folder}/{file_name}") as fh:
+            file_dataset.save_as(fh)
+
+    # Write a dataset that has no PixelData, then append the PixelData element from
+    # the stream chunk by chunk. PixelData is the last element, so the file is the same
+    # as one written with the pixels in the dataset, but the pixels are never held in memory.
+    # per_frame_groups, when given, is encoded in bulk and written just before PixelData,
+    # where PerFrameFunctionalGroupsSequence belongs in tag order.
+    #
+    # Deflated files are compressed as they are written, PixelData included (see DeflateStream).
+    # With RLE Lossless the frames are encoded as they stream past and written as one
+    # fragment each, after an offset table that is filled in once they are all written
+    # (see write_encapsulated_frames).
+    def write_dataset_with_pixel_stream(self, ds: Dataset, folder: str, file_name: str,
+                                        pixel_stream: PixelDataStream, per_frame_groups=None) -> None:
+        file_dataset = self.create_file_dataset(ds)
+        if (per_frame_groups is not None and len(ds) > 0 and max(ds.keys()) >= PER_FRAME_FUNCTIONAL_GROUPS_TAG):
+            raise Exception(f"Cannot append the per-frame functional groups to {file_name}, "
+                            f"the dataset has element {max(ds.keys())} after them")
+        with self.output_sink.open_file(f"{folder}/{file_name}") as fh:
+            start = perf_counter()
+            out = fh
+            if (self.is_deflated()):
+                out = start_deflated_file(fh, file_dataset, self.deflate_level)
+            else:
+                file_dataset.save_as(fh)
+            if (per_frame_groups is not None):
+                out.write(per_frame_groups.encode())
+            if (self.is_encapsulated()):
+                self.write_encapsulated_pixel_stream(fh, ds, pixel_stream)
+                return
+            pixel_length = pixel_stream.get_length()
+            out.write(struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OW", 0, pixel_length))
+            written = 0
+            for chunk in pixel_stream:
+                out.write(chunk)
+                written += len(chunk)
+            if (written != pixel_length):
+                raise Exception(f"Wrote {written} bytes of pixel data to {file_name}, expected {pixel_length}")
+            if (self.is_deflated()):
+                out.finish()
+                self.compression_stats.add(out, perf_counter() - start)
+
+    # Writer of the single-frame instances of a series: DICOM JSON, or Part 10 files that,
+    # for a deflated series, are compressed on jobs threads. Both write to the output sink.
+    def create_instance_writer(self, keywords: list):
+        if (self.json_output):
+            if (self.transfer_syntax != "explicit"):
+                raise Exception(f"DICOM JSON output has uncompressed bulk data, not {self.transfer_syntax}")
+            return DicomJSONWriter(keywords, self.output_sink)
+        if (self.is_deflated()):
+            return InstanceWriter(keywords, self.deflate_level, self.jobs, self.compression_stats, self.output_sink)
+        return InstanceWriter(keywords, output_sink=self.output_sink)
+
+    # A frame's offset is only known once the frames before it are encoded. When the worst
+    # case might not fit in the 32 bit Basic Offset Table, the Extended Offset Table is
+    # written instead and the Basic Offset Table left empty, as PS3.5 A.4 requires.
+    def write_encapsulated_pixel_stream(self, fh, ds: Dataset, pixel_stream: PixelDataStream) -> None:
+        frame_count = pixel_stream.get_frame_count()
+        extended = frame_count * (get_max_rle_frame_length(ds.Rows, ds.Columns) + 8) >= 2**32
+        encoder = RLEFrameEncoder(ds.Rows, ds.Columns, 2, self.jobs)
+        write_encapsulated_frames(fh, encoder.encode_frames(pixel_stream.iterate_frames()), frame_count, extended)
+
+    # The RLE frames of the single-frame instances of a series, encoded ahead of the
+    # writer (in parallel with jobs > 1) in the order the instances are written, or
+    # None when the pixels are written uncompressed
+    def create_encoded_frames(self, inveon_image: InveonImage, time_frames, slices):
+        if (not self.is_encapsulated()):
+            return None
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        frames = (self.read_normalize_pixel_data(inveon_image, False, time_index, slice_index)
+                  for time_index in time_frames for slice_index in slices)
+        return RLEFrameEncoder(rows, columns, 2, self.jobs).encode_frames(frames)
+
+    # Sets the PixelData of a template to one encapsulated frame
+    def set_encapsulated_pixel_data(self, template: FileDataset, encoded_frame: bytes) -> None:
+        template.PixelData = encapsulate_frame(encoded_frame)
+        template["PixelData"].VR = "OB"
+        template["PixelData"].is_undefined_length = True
+
+    def create_file_dataset(self, ds: Dataset) -> FileDataset:
         file_meta = FileMetaDataset()
         file_meta.FileMetaInformationVersion = b'\x00\x01'
         file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
         file_meta.MediaStorageSOPInstanceUID = UID(ds.SOPInstanceUID)
         file_meta.ImplementationClassUID = UID("1.2.3.4")
-        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        file_meta.TransferSyntaxUID = TRANSFER_SYNTAXES[self.transfer_syntax]
         file_meta.FileMetaInformationGroupLength = 0
 
         file_dataset = FileDataset("", dataset=ds, file_meta=file_meta, preamble=b"\0" * 128)
         file_dataset.is_little_endian = True
         file_dataset.is_implicit_VR = False
         file_dataset.write_like_original = False
-        file_dataset.save_as(f"{folder}/{file_name}")
+        return file_dataset
+
+    def create_pixel_data_stream(self, inveon_image: InveonImage, time_frames: list, slices: list) -> PixelDataStream:
+        return PixelDataStream(inveon_image, time_frames, slices,
+                               lambda time_index: self.calculate_pixel_scale(inveon_image, time_index),
+                               read_ahead_depth=self.read_ahead_depth)
 
     # Create the elements that are common to all CT slices
     # A.3 CT Image IOD
@@ -294,7 +606,8 @@ class Factory:
 
     # A.38.1.3 Enhanced CT Image IOD
     # https://dicom.nema.org/medical/dicom/current/output/html/part03.html#sect_A.38
-    def create_enhanced_ct_dataset(self, inveon_image: InveonImage) -> Dataset:
+    def create_enhanced_ct_dataset(self, inveon_image: InveonImage, time_frames=None, slices=None,
+            include_pixels=True) -> Dataset:
 
         # Patient
         patient = self.create_patient_module(inveon_image, {})
@@ -317,10 +630,11 @@ class Factory:
         enhanced_gen_equip = self.create_enhanced_general_equipment_module(inveon_image)
 
         # Image
-        image_pixel = self.create_image_pixel_module(inveon_image)
+        image_pixel = self.create_image_pixel_module(inveon_image, include_pixels, time_frames=time_frames, slices=slices)
         enhanced_contrast_bolus = None
-        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module(inveon_image)
-        multiframe_dimension = self.create_multiframe_dimension_module(inveon_image)
+        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module(inveon_image, time_frames, slices,
+                                                                                False, include_pixels)
+        multiframe_dimension = self.create_multiframe_dimension_module(inveon_image, time_frames, slices)
         cardiac_synchronization = None
         respiratory_synchronization = None
         supplemental_palette_color_lut = None
@@ -371,7 +685,8 @@ class Factory:
 
     # A.70 Legacy Converted Enhanced CT Image IOD
     # https://dicom.nema.org/medical/dicom/current/output/html/part03.html#sect_A.70
-    def create_legacy_converted_enhanced_ct_dataset(self, inveon_image: InveonImage) -> Dataset:
+    def create_legacy_converted_enhanced_ct_dataset(self, inveon_image: InveonImage, time_frames=None, slices=None,
+            include_pixels=True) -> Dataset:
 
         patient = self.create_patient_module(inveon_image, {})
         clin_trial_subject = None
@@ -391,11 +706,12 @@ class Factory:
         enhanced_gen_equip = self.create_enhanced_general_equipment_module(inveon_image)
 
         # These are at the Image level in the IOD definition
-        image_pixel = self.create_image_pixel_module(inveon_image)
+        image_pixel = self.create_image_pixel_module(inveon_image, include_pixels, time_frames=time_frames, slices=slices)
         contrast_bolus = self.create_contrast_bolus_module(inveon_image)
         enhanced_contrast_bolus = None
-        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module(inveon_image)
-        multiframe_dimension = None
+        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module(inveon_image, time_frames, slices,
+                                                                                True, include_pixels)
+        multiframe_dimension = self.create_multiframe_dimension_module(inveon_image, time_frames, slices)
         cardiac_synchronization = None
         respiratory_synchronization = None
         acquisition_context = self.create_acquisition_context_module(inveon_image)
@@ -523,7 +839,8 @@ class Factory:
 
     # A.56.1 Enhanced PET Image IOD Description
     # https://dicom.nema.org/medical/dicom/current/output/html/part03.html#sect_A.56
-    def create_enhanced_pet_dataset(self, inveon_image: InveonImage) -> Dataset:
+    def create_enhanced_pet_dataset(self, inveon_image: InveonImage, time_frames=None, slices=None,
+            include_pixels=True) -> Dataset:
 
         patient = self.create_patient_module(inveon_image, {})
         clin_trial_subject = None
@@ -546,11 +863,12 @@ class Factory:
         enhanced_gen_equip = self.create_enhanced_general_equipment_module(inveon_image)
 
         # These are at the Image level in the IOD definition
-        image_pixel = self.create_image_pixel_module(inveon_image)
+        image_pixel = self.create_image_pixel_module(inveon_image, include_pixels, time_frames=time_frames, slices=slices)
         intervention = None
         acquisition_context = self.create_acquisition_context_module(inveon_image)
-        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module_pet(inveon_image)
-        multiframe_dimension = None
+        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module_pet(inveon_image, time_frames, slices,
+                                                                                    False, include_pixels)
+        multiframe_dimension = self.create_multiframe_dimension_module(inveon_image, time_frames, slices)
         cardiac_synchronization = None
         respiratory_synchronization = None
         specimen = None
@@ -593,7 +911,8 @@ class Factory:
 
     # A.72 Legacy Converted Enhanced PET Image IOD
     # https://dicom.nema.org/medical/dicom/current/output/html/part03.html#sect_A.72
-    def create_legacy_converted_enhanced_pet_dataset(self, inveon_image: InveonImage) -> Dataset:
+    def create_legacy_converted_enhanced_pet_dataset(self, inveon_image: InveonImage, time_frames=None, slices=None,
+            include_pixels=True) -> Dataset:
 
         patient = self.create_patient_module(inveon_image, {})
         clin_trial_subject = None
@@ -616,11 +935,12 @@ class Factory:
         enhanced_gen_equip = self.create_enhanced_general_equipment_module(inveon_image)
 
         # These are at the Image level in the IOD definition
-        image_pixel = self.create_image_pixel_module(inveon_image)
+        image_pixel = self.create_image_pixel_module(inveon_image, include_pixels, time_frames=time_frames, slices=slices)
         intervention = None
         acquisition_context = self.create_acquisition_context_module(inveon_image)
-        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module_pet(inveon_image)
-        multiframe_dimension = None
+        multiframe_fctnl_grps = self.create_multiframe_functional_groups_module_pet(inveon_image, time_frames, slices,
+                                                                                    True, include_pixels)
+        multiframe_dimension = self.create_multiframe_dimension_module(inveon_image, time_frames, slices)
         cardiac_synchronization = None
         respiratory_synchronization = None
         specimen = None
@@ -661,54 +981,65 @@ class Factory:
                            frame_extraction)
         return ds
 
-    def fill_pet_per_frame_data(self, inveon_image: InveonImage, time_index: int, frame_index: int):
-        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
-#        instance_number = (time_index * z_dimension) + frame_index + 1
-
-        scan_time_time = inveon_image.get_metadata_element("scan_time_time")
-        scan_time_date = inveon_image.get_metadata_element("scan_time_date")
-        dt = parse(f"{scan_time_date} {scan_time_time}")
-        print(dt)
-        frame_start      = inveon_image.get_frame_metadata_element(time_index, "frame_start")
-        acquisition_date_time = dt + relativedelta(seconds=float(frame_start))
-
-        acquisition_time = acquisition_date_time.hour * 10000 + acquisition_date_time.minute * 100 + acquisition_date_time.second
-        formatted_acquisition_time = f"{acquisition_time:0.6f}"
-
-        print(
-            f"{formatted_acquisition_time} {acquisition_date_time} {acquisition_date_time.year} / {acquisition_date_time.hour} / {acquisition_date_time.minute} / {acquisition_date_time.second}")
-
-        ds = Dataset()
-        ds.InstanceNumber = self.get_instance_number()
-        ds.AcquisitionNumber = ds.InstanceNumber
+    # Single-frame instances of a series differ in only a few elements. The template is
+    # the full dataset of the series, built once from the common elements and the
+    # overrides; each instance replaces just the elements that vary and is written from
+    # the same dataset, so nothing else is rebuilt or copied per slice.
+    def create_instance_template(self, common: Dataset, overrides_ds=None) -> FileDataset:
+        return self.create_file_dataset(mergeDatasets(common, overrides_ds))
+
+    # The writer keeps the encoded bytes of everything the instances share (see
+    # InstanceWriter, and DicomJSONWriter for JSON output), so only the patched elements are encoded per slice; the file is
+    # the same as template.save_as would write. PixelData is removed after writing: the
+    # next slice's pixels are then added as a new element, and the template does not
+    # keep the slice buffer alive
+    def write_instance(self, template: FileDataset, output_path: str, writer: InstanceWriter) -> None:
+        template.file_meta.MediaStorageSOPInstanceUID = template.SOPInstanceUID
+        writer.write(template, f"{output_path}/{self.determine_filename(template, None)}")
+        del template.PixelData
+
+    # Elements that change with the PET time frame
+    def patch_pet_time_frame(self, template: FileDataset, inveon_image: InveonImage, time_index: int) -> None:
+        template.AcquisitionTime     = self.calculate_AcquisitionTime_for_PET(inveon_image, time_index)
+        template.RescaleSlope        = self.calculate_RescaleSlope_for_PET(inveon_image, time_index)
+        template.FrameReferenceTime  = self.calculate_FrameReferenceTime(inveon_image, time_index)
+        template.ActualFrameDuration = self.calculate_ActualFrameDuration(inveon_image, time_index, 0)
+        decay_factor = self.calculate_DecayFactor(inveon_image, time_index)
+        if (decay_factor is not None):
+            template.DecayFactor     = decay_factor
+
+    # Elements that change with every PET slice
+    # pixel_frames, when given, supplies the slice's pixels already encoded (see create_encoded_frames)
+    def patch_pet_instance(self, template: FileDataset, inveon_image: InveonImage, time_index: int,
+                           frame_index: int, pixel_frames=None) -> None:
+        template.InstanceNumber       = self.get_instance_number()
+        template.AcquisitionNumber    = template.InstanceNumber
         self.increment_instance_number()
 
-        ds.SOPInstanceUID  = generate_uid()
-        ds.AcquisitionTime = formatted_acquisition_time
-
-        image_plane_module = self.create_image_plane_module(inveon_image, frame_index)
-        image_pixel_module = self.create_image_pixel_module(inveon_image, True, False, time_index)
-        pet_image_module   = self.create_pet_image_module(inveon_image, time_index, frame_index)
-        return mergeDatasets(image_plane_module, image_pixel_module, pet_image_module, ds)
-
-    def fill_ct_per_frame_data(self, inveon_image: InveonImage, current_frame: int, index: int) -> Dataset:
-        z = current_frame * index
-        acquisition_number = index + 1
-#        instance_number = index + 1
-
-#        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
-
-#        in_frame_index = index % z_dimension
+        template.SOPInstanceUID       = self.get_instance_uid(inveon_image, template.InstanceNumber)
+        template.ImagePositionPatient = self.calculate_ImagePositionPatient(inveon_image, frame_index)
+        template.SliceLocation        = self.calculate_SliceLocation(inveon_image, frame_index)
+        template.ImageIndex           = self.calculate_ImageIndex(inveon_image, time_index, frame_index)
+        if (pixel_frames is not None):
+            self.set_encapsulated_pixel_data(template, next(pixel_frames))
+        else:
+            template.PixelData        = self.read_normalize_pixel_data(inveon_image, False, time_index, frame_index)
 
-        ds = Dataset()
-        ds.InstanceNumber = self.get_instance_number()
+    # Elements that change with every CT slice. index counts slices over all frames.
+    def patch_ct_instance(self, template: FileDataset, inveon_image: InveonImage, current_frame: int,
+                          index: int, pixel_frames=None) -> None:
+        template.InstanceNumber       = self.get_instance_number()
         self.increment_instance_number()
 
-        ds.SOPInstanceUID = generate_uid()
-
-        image_plane_module = self.create_image_plane_module(inveon_image, index)
-        image_pixel_module = self.create_image_pixel_module(inveon_image, True, False)
-        return mergeDatasets(image_plane_module, image_pixel_module, ds)
+        z_dimension = inveon_image.get_header().z_dimension
+        template.SOPInstanceUID       = self.get_instance_uid(inveon_image, template.InstanceNumber)
+        template.ImagePositionPatient = self.calculate_ImagePositionPatient(inveon_image, index)
+        template.SliceLocation        = self.calculate_SliceLocation(inveon_image, index)
+        if (pixel_frames is not None):
+            self.set_encapsulated_pixel_data(template, next(pixel_frames))
+        else:
+            template.PixelData        = self.read_normalize_pixel_data(inveon_image, False, current_frame,
+                                                                       index % z_dimension)
 
     def create_patient_module(self, inveon_image: InveonImage, overrides: {}) -> PatientModule:
 
@@ -719,19 +1050,21 @@ class Factory:
         patient_sex  = inveon_image.get_metadata_element("subject_sex")
 
         if (not patient_name):
-            patient_name = overrides["patient_name"]
+            patient_name = overrides.get("patient_name")
         if (not patient_id):
-            patient_id = overrides["patient_id"]
+            patient_id = overrides.get("patient_id")
         if (not patient_dob):
-            patient_dob = overrides["patient_birthdate"]
+            patient_dob = overrides.get("patient_birthdate")
         if (not patient_sex):
-            patient_sex = overrides["patient_sex"]
+            patient_sex = overrides.get("patient_sex")
 
         m = PatientModule(patient_name,patient_id,patient_dob,patient_sex)
         return m
 
     def create_general_study_module(self, inveon_image: InveonImage) -> GeneralStudyModule:
-        study_instance_uid = generate_uid() if self.study_instance_uid is None else self.study_instance_uid
+        study_instance_uid = self.study_instance_uid
+        if (study_instance_uid is None):
+            study_instance_uid = self.uid_provider.derive_uid("study", inveon_image.get_source_identity())
         study_date = inveon_image.get_metadata_element("scan_time_date")
         study_time = inveon_image.get_metadata_element("scan_time_time")
         referring_phys = inveon_image.get_metadata_element("investigator")
@@ -799,7 +1132,7 @@ class Factory:
 
         series_number = str(self.series_number)
 
-        series_instance_uid = generate_uid()
+        series_instance_uid = self.uid_provider.derive_uid(*self.get_series_key(inveon_image), "series")
         laterality = ""
         series_date = inveon_image.get_metadata_element("scan_time_date")
         series_time = inveon_image.get_metadata_element("scan_time_time")
@@ -832,8 +1165,8 @@ class Factory:
         energy_window_lower_limit = inveon_image.get_metadata_element("lld")
         energy_window_upper_limit = inveon_image.get_metadata_element("uld")
 
-        energy_window_lower_limit = '%.2E' % Decimal(energy_window_lower_limit)
-        energy_window_upper_limit = '%.2E' % Decimal(energy_window_upper_limit)
+        energy_window_lower_limit = format_ds(energy_window_lower_limit, 2, "plain")
+        energy_window_upper_limit = format_ds(energy_window_upper_limit, 2, "plain")
 
         m = PETSeriesModule(series_date, series_time, units, counts_source, series_type,
                             number_of_slices, decay_correction, corrected_image, collimator_type,
@@ -923,7 +1256,7 @@ class Factory:
             return None
 
     def create_frame_of_reference_module(self, inveon_image: InveonImage) -> FrameOfReferenceModule:
-        frame_of_reference_uid = generate_uid()
+        frame_of_reference_uid = self.uid_provider.derive_uid(*self.get_series_key(inveon_image), "frame of reference")
         position_reference_indicator = ""
 
         m = FrameOfReferenceModule(
@@ -973,17 +1306,15 @@ class Factory:
                         f"Do not understand value for dose_units {dose_units}, expected one of: 0, 1, 2")
 
             calculated_dose = dose_raw * scale
-            ds.RadionuclideTotalDose = self.adjust_scientific_notation_no_plus_sign('%.4E' % Decimal(calculated_dose))
+            ds.RadionuclideTotalDose = format_ds(calculated_dose, 4, "unsigned")
 
         isotope_half_life = inveon_image.get_metadata_element("isotope_half_life")
         if isotope_half_life is not None:
-            half_life_string = '%.4E' % Decimal(float(isotope_half_life))
-            ds.RadionuclideHalfLife = self.adjust_scientific_notation_no_plus_sign(half_life_string)
+            ds.RadionuclideHalfLife = format_ds(isotope_half_life, 4, "unsigned")
 
         isotope_branching_fraction = inveon_image.get_metadata_element("isotope_branching_fraction")
         if isotope_branching_fraction is not None:
-            fraction_string = '%.4E' % Decimal(float(isotope_branching_fraction))
-            ds.RadionuclidePositronFraction = self.adjust_scientific_notation_no_plus_sign(fraction_string)
+            ds.RadionuclidePositronFraction = format_ds(isotope_branching_fraction, 4, "unsigned")
 
         return ds
 
@@ -1019,8 +1350,8 @@ class Factory:
 
         patient_gantry_relationship = Dataset()
         patient_orientation_modifier = Dataset()
-        subject_orientation = inveon_image.get_metadata_element("subject_orientation")
-        if (subject_orientation in ["1", "3", "5", "7"]):
+        subject_orientation = inveon_image.get_header().subject_orientation
+        if (subject_orientation in [1, 3, 5, 7]):
 #            patient_gantry_relationship.CodeValue = "102541007"
 #            patient_gantry_relationship.CodingSchemeDesignator = "SCT"
 #            patient_gantry_relationship.CodeMeaning = "feet-first"
@@ -1034,7 +1365,7 @@ class Factory:
             patient_orientation_modifier.CodingSchemeDesignator = "99SDM"
             patient_orientation_modifier.CodeMeaning = "supine"
 
-        elif (subject_orientation in ["2", "4", "6", "8"]):
+        elif (subject_orientation in [2, 4, 6, 8]):
             patient_gantry_relationship.CodeValue = "102540008"
             patient_gantry_relationship.CodingSchemeDesignator = "SCT"
             patient_gantry_relationship.CodeMeaning = "headfirst"
@@ -1115,178 +1446,62 @@ class Factory:
         )
         return m
 
+    # Geometry of every slice of an image, computed and formatted in one vectorized pass
+    # from the header and kept for the image being converted: (ImageGeometry,
+    # ImagePositionPatient of each slice, SliceLocation of each slice), the last two as
+    # DS strings. Slices are counted over all time frames.
+    def calculate_slice_geometry(self, inveon_image: InveonImage) -> tuple:
+        if (self.slice_geometry is not None and self.slice_geometry[0] is inveon_image):
+            return self.slice_geometry[1]
+
+        geometry = ImageGeometry(inveon_image.get_header())
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        slice_indices = numpy.arange(frame_count * z_dimension)
+        positions = format_ds_array(geometry.get_slice_positions(slice_indices), 7)
+        values = (geometry,
+                  ["\\".join(positions[index:index + 3]) for index in range(0, len(positions), 3)],
+                  format_ds_array(geometry.get_slice_locations(slice_indices), 7))
+
+        self.slice_geometry = (inveon_image, values)
+        return values
+
     def calculate_ImageOrientationPatient(self, inveon_image: InveonImage) -> str:
-        subject_orientation = inveon_image.get_metadata_element("subject_orientation")
-        rtn = ""
-        match subject_orientation:
-            case "0":
-                return "-1\\0\\0\\0\\1\\0"
-            case "2":
-                return "-1\\0\\0\\0\\-1\\0"
-            case "3":
-                return "-1\\0\\0\\0\\1\\0"
-            case _:
-                raise Exception(
-                    f"Do not have code to calculate ImageOrientationPatient when subject_orientation is {subject_orientation}")
+        geometry, positions, locations = self.calculate_slice_geometry(inveon_image)
+        row_direction, column_direction = geometry.get_image_orientation()
+        return "\\".join(str(value) for value in row_direction + column_direction)
 
     # index numbers from 0
     def calculate_ImagePositionPatient(self, inveon_image: InveonImage, index: int) -> str:
-        subject_orientation = inveon_image.get_metadata_element("subject_orientation")
-        x_delta = 0
-        y_delta = 0
-        image_shift_ref = inveon_image.get_metadata_element("image_ref_shift")
-        if (image_shift_ref is not None and image_shift_ref != ""):
-            tokens = image_shift_ref.split(" ")
-            x_delta = float(tokens[1])
-            y_delta = float(tokens[2])
-
-
-        pixel_size_x = float(inveon_image.get_metadata_element("pixel_size_x"))
-        pixel_size_y = float(inveon_image.get_metadata_element("pixel_size_y"))
-
-        x_dimension = inveon_image.get_metadata_element("x_dimension")
-        y_dimension = inveon_image.get_metadata_element("y_dimension")
-
-        x_position =   ((float(x_dimension)-1)/2.0 * pixel_size_x) - x_delta
-        y_position = -(((float(y_dimension)-1)/2.0 * pixel_size_y) - y_delta)
-
-        # Because we already do this calculation, reuse the code
-        z_position = self.calculate_SliceLocationFloat(inveon_image, index)
-
-        if (subject_orientation == "2"):
-            y_position = - y_position
-            z_position = - z_position
-
-        x_posit_sci_notation = '%.7E' % Decimal(x_position)
-        y_posit_sci_notation = '%.7E' % Decimal(y_position)
-        z_posit_sci_notation = '%.7E' % Decimal(z_position)
-
-        x_posit = self.adjust_scientific_notation(x_posit_sci_notation)
-        y_posit = self.adjust_scientific_notation(y_posit_sci_notation)
-        z_posit = self.adjust_scientific_notation(z_posit_sci_notation)
-
-        x_posit = self.adjust_scientific_notation_no_plus_sign(x_posit)
-        y_posit = self.adjust_scientific_notation_no_plus_sign(y_posit)
-        z_posit = self.adjust_scientific_notation_no_plus_sign(z_posit)
-
-#        x_posit = x_posit_sci_notation
-#        y_posit = y_posit_sci_notation
-
-        return f"{x_posit}\\{y_posit}\\{z_posit}"
-
-
-    # If expression ends in 'E-0', return as is
-    # Otherwise, replace E-0 with E-1
-    # The example is 1.233E-01 -> 1.233E-1
-    def adjust_scientific_notation_no_plus_sign(self, expression: str) -> str:
-        print(f"no plus {expression}")
-        if re.search('E\\+0$', expression):
-            x = re.sub('E\\+0', 'E0', expression)
-            print(f"case 1  {x}")
-            return re.sub('E\\+0', 'E0', expression)
-        elif re.search('E\\+0', expression):
-            x = re.sub('E\\+0', 'E', expression)
-            print(f"case 2 {x}")
-            return re.sub('E\\+0', 'E', expression)
-        elif re.search('E\\+', expression):
-            x = re.sub('E\\+', 'E', expression)
-            print(f"case 3 {x}")
-            return re.sub('E\\+', 'E', expression)
-        else:
-            print(f"case 4 {expression}")
-            return expression
-
-
-    # If expression ends in 'E-0', return as is
-    # Otherwise, replace E-0 with E-1
-    # The example is 1.233E-01 -> 1.233E-1
-    def adjust_scientific_notation(self, expression: str) -> str:
-        #print(f"Adjust {expression}")
-        if re.search("E-0$", expression):
-            #print("Trigger E-0$")
-            return expression
-
-        elif re.search("E+0$", expression):
-            #print("Trigger E+0$")
-            return expression
-
-        elif re.search("E-0", expression):
-            #print(f"E-0 expression {expression} converted {re.sub('E-0', 'E-', expression)}")
-            return re.sub('E-0', 'E-', expression)
-
-        elif re.search('E\\+0', expression):
-            #print(f"E+0 expression {expression} converted {re.sub('E\\+0', 'E+', expression)}")
-            return re.sub('E\\+0', 'E+', expression)
-
-        else:
-            #print(f"Expression did not trigger change {expression}")
-            return expression
-
-    def trim_trailing_zero(self, expression: str) -> str:
-        if re.search('[0-9]{5}0E', expression):
-            expression = re.sub('0E', 'E', expression)
-        return expression
+        geometry, positions, locations = self.calculate_slice_geometry(inveon_image)
+        return positions[index]
 
     def calculate_KVP(self, inveon_image: InveonImage) -> str:
         ct_xray_voltage = inveon_image.get_metadata_element("ct_xray_voltage")
-        kvp = '%.0E' % Decimal(ct_xray_voltage)
-        return self.adjust_scientific_notation_no_plus_sign(kvp)
+        return format_ds(ct_xray_voltage, 0, "unsigned")
 
     def calculate_detector_distance(self, inveon_image: InveonImage, inveon_field: str) -> str:
         distance_in_cm = inveon_image.get_metadata_element(inveon_field)
         if distance_in_cm is not None:
             distance_in_mm = float(distance_in_cm) * 10
-            distance_in_mm_str = '%.4E' % Decimal(distance_in_mm)
-            return self.adjust_scientific_notation_no_plus_sign(distance_in_mm_str)
+            return format_ds(distance_in_mm, 4, "unsigned")
         else:
             return distance_in_cm
 
     def calculate_PixelSpacingXorY(self, inveon_image: InveonImage, inveon_field:str) -> str:
         spacing = inveon_image.get_metadata_element(inveon_field)
-        spacing_in_scientific_notation = '%.6E' % Decimal(spacing)
-        expression = self.adjust_scientific_notation(spacing_in_scientific_notation)
-        return self.trim_trailing_zero(expression)
+        return format_ds(spacing, 6, "signed", trim_zero=True)
     def calculate_SliceThickness(self, inveon_image: InveonImage, index:int) -> str:
         pixel_size_z = inveon_image.get_metadata_element("pixel_size_z")
-        slice_thickness = '%.5E' % Decimal(pixel_size_z)
-        return self.adjust_scientific_notation(slice_thickness)
-
-    # index numbers from 0
-    def calculate_SliceLocationFloat(self, inveon_image: InveonImage, index: int) -> float:
-        pixel_size_z = float(inveon_image.get_metadata_element("pixel_size_z"))
-        z_dimension = inveon_image.get_metadata_element("z_dimension")
-        z_position = (float(index) + .5 - float(z_dimension)/2) * pixel_size_z
-
-        image_shift_ref = inveon_image.get_metadata_element("image_ref_shift")
-        if (image_shift_ref is not None and image_shift_ref != ""):
-            tokens = image_shift_ref.split(" ")
-            z_delta = float(tokens[3])
-            z_position = z_position + z_delta
-
-        return z_position
-
+        return format_ds(pixel_size_z, 5, "signed")
 
     # index numbers from 0
     def calculate_SliceLocation(self, inveon_image: InveonImage, index: int) -> str:
-        pixel_size_z = float(inveon_image.get_metadata_element("pixel_size_z"))
-        z_dimension = inveon_image.get_metadata_element("z_dimension")
-        z_position = (float(index) + .5 - float(z_dimension)/2) * pixel_size_z
-
-        image_shift_ref = inveon_image.get_metadata_element("image_ref_shift")
-        if (image_shift_ref is not None and image_shift_ref != ""):
-            tokens = image_shift_ref.split(" ")
-            z_delta = float(tokens[3])
-            z_position = z_position + z_delta
-
-        z_posit_sci_notation = '%.7E' % Decimal(z_position)
-        z_posit = self.adjust_scientific_notation(z_posit_sci_notation)
-        z_posit = self.adjust_scientific_notation_no_plus_sign(z_posit)
-#       z2_posit = self.trim_trailing_zero(z1_posit)
-
-        return z_posit
+        geometry, positions, locations = self.calculate_slice_geometry(inveon_image)
+        return locations[index]
 
     def create_image_pixel_module(self, inveon_image: InveonImage, include_pixels=True,
-                                  include_all_pixels=True, time_index=0) -> ImagePixelModule:
+                                  include_all_pixels=True, time_index=0, slice_index=0,
+                                  time_frames=None, slices=None) -> ImagePixelModule:
         # TODO Fix hard coding
         # TODO Fix assumption that data from Inveon is 2 byte integer
         samples_per_pixel = 1
@@ -1301,7 +1516,8 @@ class Factory:
         pixel_data = None
 
         if (include_pixels):
-            pixel_data = self.read_normalize_pixel_data(inveon_image, include_all_pixels, time_index)
+            pixel_data = self.read_normalize_pixel_data(inveon_image, include_all_pixels, time_index, slice_index,
+                                                        time_frames, slices)
 
         m = ImagePixelModule(
             samples_per_pixel,
@@ -1317,106 +1533,310 @@ class Factory:
         return m
 
 
-    def read_normalize_pixel_data(self, inveon_image: InveonImage, include_all_pixels, time_index):
-        data_type = int(inveon_image.get_metadata_element("data_type"))
+    # Pixels are taken from the memory mapped .img file by (time_index, slice_index),
+    # so callers may request slices in any order. When include_all_pixels is set,
+    # time_frames and slices restrict the volume to the selected indices.
+    def read_normalize_pixel_data(self, inveon_image: InveonImage, include_all_pixels, time_index, slice_index=0,
+                                  time_frames=None, slices=None):
+        data_type = inveon_image.get_header().data_type
         rtn_pixels = None
         match data_type:
-            case 2:
-                return self.read_2byte_integer_pixels(inveon_image, include_all_pixels)
-            case 4:
-                return self.read_normalize_4byte_float_pixels(inveon_image, include_all_pixels, time_index)
+            case 1 | 2 | 6:
+                return self.read_2byte_integer_pixels(inveon_image, include_all_pixels, time_index, slice_index,
+                                                      time_frames, slices)
+            case 3 | 4 | 5 | 7:
+                if (include_all_pixels):
+                    return self.read_normalize_all_4byte_float_pixels(inveon_image, time_frames, slices)
+                return self.read_normalize_4byte_float_pixels(inveon_image, include_all_pixels, time_index, slice_index)
             case _:
                 raise Exception(f"Unsupported data_type {data_type} when trying to read pixel data")
 
-    def read_2byte_integer_pixels(self, inveon_image: InveonImage, include_all_pixels):
-        rows    = int(inveon_image.get_metadata_element("y_dimension"))
-        columns = int(inveon_image.get_metadata_element("x_dimension"))
-        pixel_data = None
-        fh = inveon_image.get_pixel_fh();
+    def read_2byte_integer_pixels(self, inveon_image: InveonImage, include_all_pixels, time_index=0, slice_index=0,
+                                  time_frames=None, slices=None):
+        pixels = None
         if (include_all_pixels):
-            pixel_data = bytes(fh.read())
-            inveon_image.close_pixel_file();
-        else:
-            pixel_data = bytes(fh.read(rows * columns * 2))
-
-        return pixel_data
+            pixels = inveon_image.get_pixel_subset(time_frames, slices)
+        elif (self.read_ahead is not None):
+            pixels = self.read_ahead.get((time_index, slice_index))
+        if (pixels is None):
+            pixels = inveon_image.get_slice_pixels(time_index, slice_index)
+
+        # Byte and big endian data are widened / swapped to little endian int16 in one bulk
+        # conversion. Little endian int16 data stay a view on the memory map; the bytes are
+        # copied once, when the dataset is written.
+        if (pixels.dtype != numpy.dtype("<i2")):
+            if (include_all_pixels):
+                pixels = pixels.astype("<i2")
+            else:
+                target = self.get_slice_buffer(pixels.shape)
+                numpy.copyto(target, pixels, casting="unsafe")
+                pixels = target
+
+        return memoryview(pixels).cast("B")
 
 
     # TODO debug this method
-    def read_normalize_4byte_float_pixels(self,inveon_image: InveonImage, include_all_pixels, time_index):
-        rows        = int(inveon_image.get_metadata_element("y_dimension"))
-        columns     = int(inveon_image.get_metadata_element("x_dimension"))
-        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
-        time_frames = int(inveon_image.get_metadata_element("time_frames"))
-
-        scale_factor               = float(inveon_image.get_frame_metadata_element(time_index, "scale_factor"))
-        calibration_factor         = float(inveon_image.get_metadata_element("calibration_factor"))
-        isotope_branching_fraction = float(inveon_image.get_metadata_element("isotope_branching_fraction"))
-        minimum_in_frame           = float(inveon_image.get_frame_metadata_element(time_index, "minimum"))
-        maximum_in_frame           = float(inveon_image.get_frame_metadata_element(time_index, "maximum"))
-
-        max_scaled = maximum_in_frame * calibration_factor * scale_factor / isotope_branching_fraction * 37
-        #rescale_slope = max_scaled / 32767
-
-        pixel_scale = calibration_factor * scale_factor / isotope_branching_fraction * 37 * (32767 / max_scaled)
-
-        float_pixels = numpy.fromfile(inveon_image.get_pixel_fh(), numpy.float32, rows*columns, "", 0)
-
-#        min_float = numpy.min(float_pixels)
-#        max_float = numpy.max(float_pixels)
-
-        scaled_pixels  = float_pixels * pixel_scale
-        s16_pixels     = numpy.array(scaled_pixels, numpy.int16)
-
-#        min_int = numpy.min(s16_pixels)
-#        max_int = numpy.max(s16_pixels)
-#        print(f"{time_index} SCALAR {pixel_scale}")
-#        print(f"{time_index} MIN_SCALED {min_int}")
-#        print(f"{time_index} MAX_SCALED {max_int}")
-#        print(f"Minimum {min_float} Maximum {max_float}  Min int {min_int} Max int {max_int} slope {rescale_slope}")
-#        print("")
-
-        return s16_pixels.tobytes()
-
-    def create_multiframe_functional_groups_module(self, inveon_image: InveonImage) -> ImagePixelModule:
+    # Used for 4 byte float and integer data in either byte order; calculate_pixel_scale
+    # gives the scale of each kind.
+    # The time frame holding the slice is normalized once, in bulk, and cached;
+    # the remaining slices of that frame are views on the cached frame.
+    def read_normalize_4byte_float_pixels(self,inveon_image: InveonImage, include_all_pixels, time_index, slice_index=0):
+        normalizer = self.get_frame_normalizer(inveon_image)
+        if (not normalizer.has_frame(time_index)):
+            frame_pixels = None
+            if (self.read_ahead is not None):
+                frame_pixels = self.read_ahead.get((time_index, None))
+            normalizer.load_frame(time_index, self.calculate_pixel_scale(inveon_image, time_index),
+                                  frame_pixels)
+
+        return memoryview(normalizer.get_slice(slice_index)).cast("B")
+
+    # The selected slices of every selected time frame as one int16 (time, z, y, x) volume,
+    # each time frame normalized with its own pixel scale as the multiframe writers do
+    def read_normalize_all_4byte_float_pixels(self, inveon_image: InveonImage, time_frames=None, slices=None):
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        pixels = numpy.empty((len(time_frames), len(slices), rows, columns), "<i2")
+
+        normalizer = self.get_frame_normalizer(inveon_image)
+        for position, time_index in enumerate(time_frames):
+            normalizer.load_frame(time_index, self.calculate_pixel_scale(inveon_image, time_index))
+            numpy.take(normalizer.get_frame(), slices, axis=0, out=pixels[position])
+
+        return memoryview(pixels).cast("B")
+
+    # Reused for every converted slice; the slice is written before the next one is converted
+    def get_slice_buffer(self, shape: tuple) -> numpy.ndarray:
+        if (self.slice_pool is None or not self.slice_pool.matches(shape, "<i2")):
+            self.slice_pool = BufferPool(shape, "<i2")
+        return self.slice_pool.next_buffer()
+
+    def get_frame_normalizer(self, inveon_image: InveonImage) -> FrameNormalizer:
+        if (self.frame_normalizer is None or self.frame_normalizer.inveon_image is not inveon_image):
+            self.frame_normalizer = FrameNormalizer(inveon_image)
+        return self.frame_normalizer
+
+    # Per-frame values for every time frame of a PET image, computed from the frame table
+    # in one vectorized pass and kept for the image being converted:
+    #   reference_time  FrameReferenceTime in ms, the middle of the frame
+    #   duration        ActualFrameDuration in ms
+    #   rescale_slope   RescaleSlope of the int16 pixels
+    #   pixel_scale     factor that maps the float pixels onto the int16 range
+    #   decay_factor    decay correction applied to the frame
+    def calculate_frame_values(self, inveon_image: InveonImage) -> numpy.ndarray:
+        if (self.frame_values is not None and self.frame_values[0] is inveon_image):
+            return self.frame_values[1]
+
+        # Headers without calibration (CT) still give the frame times; their slope and scale are NaN
+        frames                     = inveon_image.get_frame_table()
+        calibration_factor         = inveon_image.get_header().calibration_factor
+        isotope_branching_fraction = inveon_image.get_header().isotope_branching_fraction
+        if (calibration_factor is None or isotope_branching_fraction is None):
+            calibration_factor         = numpy.nan
+            isotope_branching_fraction = numpy.nan
+
+        values = numpy.empty(len(frames), [("reference_time", numpy.float64), ("duration", numpy.float64),
+                                           ("rescale_slope", numpy.float64), ("pixel_scale", numpy.float64),
+                                           ("decay_factor", numpy.float64)])
+        max_scaled = frames["maximum"] * calibration_factor * frames["scale_factor"] / isotope_branching_fraction * 37
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            values["reference_time"] = 1000 * (frames["frame_start"] + frames["frame_duration"] / 2)
+            values["duration"]       = frames["frame_duration"] * 1000
+            values["rescale_slope"]  = max_scaled / 32767
+            values["pixel_scale"]    = (calibration_factor * frames["scale_factor"] / isotope_branching_fraction
+                                        * 37 * (32767 / max_scaled))
+            values["decay_factor"]   = frames["decay_correction"]
+
+        self.frame_values = (inveon_image, values)
+        return values
+
+    # Factor that maps the pixels of one time frame onto the int16 range: calibrated for
+    # float data, the integer rescaling (see calculate_integer_rescale_slopes) for 4 byte
+    # integer data
+    def calculate_pixel_scale(self, inveon_image: InveonImage, time_index: int) -> float:
+        if (self.has_4byte_integer_pixels(inveon_image)):
+            return 1 / self.calculate_integer_rescale_slopes(inveon_image)[time_index]
+        return self.calculate_pixel_scale_for_PET(inveon_image, time_index)
+
+    def has_4byte_integer_pixels(self, inveon_image: InveonImage) -> bool:
+        return inveon_image.get_header().data_type in (3, 7)
+
+    # RescaleSlope of every time frame of 4 byte integer data. No calibration is applied:
+    # a frame whose values fit the int16 range has slope 1 and is cast as it is, a larger
+    # one the smallest slope with 3 decimals (as RescaleSlope is written) that maps it into
+    # the int16 range. A CT series is written with one RescaleSlope, so its frames all get
+    # the largest slope. Finding the range reads every frame once.
+    def calculate_integer_rescale_slopes(self, inveon_image: InveonImage) -> numpy.ndarray:
+        if (self.integer_slopes is not None and self.integer_slopes[0] is inveon_image):
+            return self.integer_slopes[1]
+
+        slopes = numpy.ones(inveon_image.get_pixel_frame_count())
+        for time_index in range(len(slopes)):
+            frame_pixels = inveon_image.get_frame_pixels(time_index)
+            magnitude = max(-int(frame_pixels.min()), int(frame_pixels.max()))
+            if (magnitude > 32767):
+                slopes[time_index] = math.ceil(magnitude * 1000 / 32767) / 1000
+        if (inveon_image.get_metadata_element("modality_mapped") == "CT"):
+            slopes[:] = slopes.max()
+
+        self.integer_slopes = (inveon_image, slopes)
+        return slopes
+
+    # Header fields that scaling float pixels cannot do without
+    def check_calibration_fields(self, inveon_image: InveonImage) -> None:
+        header = inveon_image.get_header()
+        for field in ["calibration_factor", "isotope_branching_fraction"]:
+            if (getattr(header, field) is None):
+                raise Exception(f"{inveon_image.get_header_path()} has no {field}, which is needed to scale its pixels")
+
+    # Factor that maps the float pixels of one time frame onto the int16 range.
+    # See calculate_RescaleSlope_for_PET for the inverse.
+    def calculate_pixel_scale_for_PET(self, inveon_image: InveonImage, time_index: int) -> float:
+        self.check_calibration_fields(inveon_image)
+        pixel_scale = float(self.calculate_frame_values(inveon_image)["pixel_scale"][time_index])
+        if (not numpy.isfinite(pixel_scale)):
+            maximum = inveon_image.get_frame_metadata_element(time_index, "maximum")
+            raise Exception(f"Cannot scale the pixels of time frame {time_index} with maximum '{maximum}'")
+        return pixel_scale
+
+    # Shared functional groups. The per-frame groups are only added to the dataset when it
+    # is kept in memory with its pixels (include_per_frame); the multiframe writers
+    # append them in bulk from create_per_frame_functional_groups instead.
+    def create_multiframe_functional_groups_module(self, inveon_image: InveonImage, time_frames=None, slices=None,
+                                                   legacy_converted=False,
+                                                   include_per_frame=False) -> MultiframeFunctionalGroupsModule:
+        return self.create_multiframe_functional_groups_module_for(inveon_image, "CT", time_frames, slices,
+                                                                   legacy_converted, include_per_frame)
+
+    def create_multiframe_functional_groups_module_pet(self, inveon_image: InveonImage, time_frames=None, slices=None,
+                                                       legacy_converted=False,
+                                                       include_per_frame=False) -> MultiframeFunctionalGroupsModule:
+        return self.create_multiframe_functional_groups_module_for(inveon_image, "PET", time_frames, slices,
+                                                                   legacy_converted, include_per_frame)
+
+    def create_multiframe_functional_groups_module_for(self, inveon_image: InveonImage, modality: str,
+                                                       time_frames, slices, legacy_converted,
+                                                       include_per_frame) -> MultiframeFunctionalGroupsModule:
         content_date = inveon_image.get_metadata_element("scan_time_date")
         content_time = inveon_image.get_metadata_element("scan_time_time")
-        number_of_frames = int(inveon_image.get_metadata_element("z_dimension"))
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        number_of_frames = len(time_frames) * len(slices)
 
-        frame_acquisition_date_time = f"{content_date}{content_time}"
-
-        frame_content_list = []
-        for index in range(number_of_frames):
-            frame_content_list.append(FrameContentItem(index + 1, frame_acquisition_date_time))
+        per_frame_groups = None
+        if (include_per_frame):
+            per_frame_groups = self.create_per_frame_functional_groups(inveon_image, time_frames, slices,
+                                                                       legacy_converted)
 
         m = MultiframeFunctionalGroupsModule(
-            "CT",
+            modality,
             content_date,
             content_time,
             number_of_frames,
-            frame_content_list)
+            self.calculate_PixelSpacingXorY(inveon_image, "pixel_size_y"),
+            self.calculate_PixelSpacingXorY(inveon_image, "pixel_size_x"),
+            self.calculate_SliceThickness(inveon_image, 0),
+            self.calculate_ImageOrientationPatient(inveon_image),
+            per_frame_groups,
+            str(self.calculate_RescaleSlope_for_CT(inveon_image)) if (modality == "CT") else "1")
 
         return m
 
-    def create_multiframe_functional_groups_module_pet(self, inveon_image: InveonImage) -> ImagePixelModule:
-        content_date = inveon_image.get_metadata_element("scan_time_date")
-        content_time = inveon_image.get_metadata_element("scan_time_time")
-        number_of_frames = int(inveon_image.get_metadata_element("z_dimension"))
-
-        frame_acquisition_date_time = f"{content_date}{content_time}"
-
-        frame_content_list = []
-        for index in range(number_of_frames):
-            frame_content_list.append(FrameContentItem(index + 1, frame_acquisition_date_time))
-
-        m = MultiframeFunctionalGroupsModule(
-            "PET",
-            content_date,
-            content_time,
-            number_of_frames,
-            frame_content_list)
-
-        return m
+    # Per-frame functional groups of a multiframe image, one item per frame in the order
+    # of the pixel data: time frame by time frame, the selected slices within each.
+    # Values that depend on the time frame are encoded once per time frame and positions
+    # once per slice (see PerFrameFunctionalGroups).
+    def create_per_frame_functional_groups(self, inveon_image: InveonImage, time_frames: list, slices: list,
+                                           legacy_converted: bool) -> PerFrameFunctionalGroups:
+        modality = inveon_image.get_metadata_element("modality_mapped")
+        geometry, positions, locations = self.calculate_slice_geometry(inveon_image)
+        time_indices  = numpy.repeat(numpy.arange(len(time_frames)), len(slices))
+        slice_indices = numpy.tile(numpy.arange(len(slices)), len(time_frames))
+        groups = PerFrameFunctionalGroups(len(time_indices))
+
+        temporal = len(time_frames) > 1
+        frame_contents = []
+        for position, time_index in enumerate(time_frames):
+            item = self.create_frame_content(inveon_image, time_index)
+            if (temporal):
+                item.TemporalPositionIndex = position + 1
+            frame_contents.append(item)
+        groups.add_elements("FrameContentSequence", frame_contents, time_indices)
+
+        stack_positions = []
+        for position in range(len(slices)):
+            item = Dataset()
+            item.StackID               = "1"
+            item.InStackPositionNumber = position + 1
+            stack_positions.append(item)
+        groups.add_elements("FrameContentSequence", stack_positions, slice_indices)
+
+        # One value per dimension of calculate_dimensions, for every frame
+        dimension_index_values = (slice_indices + 1)[:, numpy.newaxis]
+        if (temporal):
+            dimension_index_values = numpy.stack([time_indices + 1, slice_indices + 1], axis=1)
+        groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "UL", dimension_index_values)
+
+        plane_positions = []
+        for slice_index in slices:
+            item = Dataset()
+            item.ImagePositionPatient = positions[slice_index]
+            plane_positions.append(item)
+        groups.add_elements("PlanePositionSequence", plane_positions, slice_indices)
+
+        if (modality != "CT"):
+            transformations = []
+            for time_index in time_frames:
+                item = Dataset()
+                item.RescaleIntercept = "0"
+                item.RescaleSlope     = self.calculate_RescaleSlope_for_PET(inveon_image, time_index)
+                item.RescaleType      = "BQML"
+                transformations.append(item)
+            groups.add_elements("PixelValueTransformationSequence", transformations, time_indices)
+
+        # Legacy Converted objects also carry, per frame, the single-frame attributes that
+        # have no functional group of their own
+        if (legacy_converted):
+            slice_attributes = []
+            for slice_index in slices:
+                item = Dataset()
+                item.SliceLocation = locations[slice_index]
+                slice_attributes.append(item)
+            groups.add_elements("UnassignedPerFrameConvertedAttributesSequence", slice_attributes, slice_indices)
+
+            if (modality != "CT"):
+                time_attributes = []
+                for time_index in time_frames:
+                    item = Dataset()
+                    item.FrameReferenceTime  = self.calculate_FrameReferenceTime(inveon_image, time_index)
+                    item.ActualFrameDuration = self.calculate_ActualFrameDuration(inveon_image, time_index, 0)
+                    decay_factor = self.calculate_DecayFactor(inveon_image, time_index)
+                    if (decay_factor is not None):
+                        item.DecayFactor     = decay_factor
+                    time_attributes.append(item)
+                groups.add_elements("UnassignedPerFrameConvertedAttributesSequence", time_attributes, time_indices)
+
+        return groups
+
+    # C.7.6.16.2.2 Frame Content Macro for the frames of one time frame: when the frame
+    # started, its middle and its duration. Values missing from the header are left out.
+    # The frame table is used directly, as CT headers have no calibration for calculate_frame_values.
+    def create_frame_content(self, inveon_image: InveonImage, time_index: int) -> Dataset:
+        frame          = inveon_image.get_frame_table()[time_index]
+        frame_start    = float(frame["frame_start"])
+        frame_duration = float(frame["frame_duration"])
+        scan_time      = inveon_image.get_header().scan_time
+
+        dataset = Dataset()
+        if (scan_time is not None and numpy.isfinite(frame_start)):
+            dataset.FrameAcquisitionDateTime = (scan_time + timedelta(seconds=frame_start)).strftime("%Y%m%d%H%M%S.%f")
+            if (numpy.isfinite(frame_duration)):
+                reference_time = scan_time + timedelta(seconds=frame_start + frame_duration / 2)
+                dataset.FrameReferenceDateTime = reference_time.strftime("%Y%m%d%H%M%S.%f")
+        if (numpy.isfinite(frame_duration)):
+            dataset.FrameAcquisitionDuration = frame_duration * 1000
+        dataset.FrameAcquisitionNumber       = time_index + 1
+
+        return dataset
 
     def create_acquisition_context_module(self, inveon_image: InveonImage) -> ImagePixelModule:
 
@@ -1424,12 +1844,30 @@ class Factory:
 
         return m
 
-    def create_multiframe_dimension_module(self, inveon_image: InveonImage) -> MultiframeDimensionModule:
+    # Frames are indexed by their position in the slice selection and, when more than one
+    # time frame is converted, by their time frame (see calculate_dimensions)
+    def create_multiframe_dimension_module(self, inveon_image: InveonImage, time_frames=None,
+                                           slices=None) -> MultiframeDimensionModule:
+        time_frames, slices = self.select_time_frames_and_slices(inveon_image, time_frames, slices)
+        dimension_organization_uid = self.uid_provider.derive_uid(*self.get_series_key(inveon_image),
+                                                                  "dimension organization")
+        dimension_organization_type = "3D_TEMPORAL" if (len(time_frames) > 1) else "3D"
 
-        m = MultiframeDimensionModule()
+        m = MultiframeDimensionModule(
+            dimension_organization_uid,
+            dimension_organization_type,
+            self.calculate_dimensions(time_frames))
 
         return m
 
+    # (Frame Content attribute, label) of each dimension, in the order of DimensionIndexValues.
+    # Frames are stored time frame by time frame, so time is the outer dimension.
+    def calculate_dimensions(self, time_frames: list) -> list:
+        dimensions = [("InStackPositionNumber", "Slice")]
+        if (len(time_frames) > 1):
+            dimensions.insert(0, ("TemporalPositionIndex", "Time frame"))
+        return dimensions
+
     def create_contrast_bolus_module(self, inveon_image: InveonImage) -> ContrastBolusModule:
         #        manufacturer = inveon_image.get_metadata_element("manufacturer")
 
@@ -1473,7 +1911,7 @@ class Factory:
         image_type_3 = "AXIAL"
 
         rescale_intercept = 0
-        rescale_slope = 1
+        rescale_slope = self.calculate_RescaleSlope_for_CT(inveon_image)
         acquisition_number = "1"
 
         scan_options = "ACQ MODE " + inveon_image.get_metadata_element("acquisition_mode")
@@ -1547,7 +1985,7 @@ class Factory:
         content_qualification = "RESEARCH"
 
         rescale_intercept = 0
-        rescale_slope = 1
+        rescale_slope = self.calculate_RescaleSlope_for_CT(inveon_image)
         acquisition_number = "1"
         burned_in_annotation = "NO"
         lossy_image_compression = "00"
@@ -1578,6 +2016,14 @@ class Factory:
             recon_algorithm)
         return m
 
+    # 1 unless 4 byte integer pixels had to be scaled into the int16 range
+    def calculate_RescaleSlope_for_CT(self, inveon_image: InveonImage):
+        if (self.has_4byte_integer_pixels(inveon_image)):
+            rescale_slope = self.calculate_integer_rescale_slopes(inveon_image)[0]
+            if (rescale_slope != 1):
+                return f"{rescale_slope:0.3f}"
+        return 1
+
     # index: Frame index from 0 to a small number
     def create_pet_image_module(self, inveon_image: InveonImage, time_index=0, frame_index=0) -> PETImageModule:
 
@@ -1609,31 +2055,35 @@ class Factory:
         )
         return m
 
+    # AcquisitionTime of a PET time frame: the scan time plus the frame start
+    def calculate_AcquisitionTime_for_PET(self, inveon_image: InveonImage, time_index: int) -> str:
+        frame_start = inveon_image.get_frame_table()["frame_start"][time_index]
+        acquisition_date_time = inveon_image.get_header().scan_time + relativedelta(seconds=float(frame_start))
+
+        acquisition_time = acquisition_date_time.hour * 10000 + acquisition_date_time.minute * 100 + acquisition_date_time.second
+        return f"{acquisition_time:0.6f}"
+
     def calculate_FrameReferenceTime(self, inveon_image: InveonImage, time_index: int) -> str:
-        frame_start = float(inveon_image.get_frame_metadata_element(time_index, "frame_start"))
-        frame_duration = float(inveon_image.get_frame_metadata_element(time_index, "frame_duration"))
-        return str(1000 * (frame_start + frame_duration / 2))
+        return str(float(self.calculate_frame_values(inveon_image)["reference_time"][time_index]))
 
     def calculate_RescaleSlope_for_PET(self, inveon_image: InveonImage, time_index: int) -> str:
-        scale_factor               = float(inveon_image.get_frame_metadata_element(time_index, "scale_factor"))
-        calibration_factor         = float(inveon_image.get_metadata_element("calibration_factor"))
-        isotope_branching_fraction = float(inveon_image.get_metadata_element("isotope_branching_fraction"))
-        maximum_in_frame           = float(inveon_image.get_frame_metadata_element(time_index, "maximum"))
-
-        max_scaled = maximum_in_frame * calibration_factor * scale_factor / isotope_branching_fraction * 37
-        rescale_slope = max_scaled / 32767
+        if (self.has_4byte_integer_pixels(inveon_image)):
+            return f"{self.calculate_integer_rescale_slopes(inveon_image)[time_index]:0.3f}"
+        self.check_calibration_fields(inveon_image)
+        rescale_slope = float(self.calculate_frame_values(inveon_image)["rescale_slope"][time_index])
 
         slope_string = f"{rescale_slope:0.3f}"
         return slope_string
 
     def calculate_ImageIndex(self, inveon_image: InveonImage, time_index: int, frame_index: int) -> int:
-        z_dimension = int(inveon_image.get_metadata_element("z_dimension"))
+        z_dimension = inveon_image.get_header().z_dimension
         return (time_index * z_dimension) + frame_index + 1
 
     def calculate_ActualFrameDuration(self, inveon_image: InveonImage, time_index: int, frame_index: int) -> int:
-        frame_duration = inveon_image.get_frame_metadata_element(time_index, "frame_duration")
-        return int(float(frame_duration) * 1000)
+        return int(self.calculate_frame_values(inveon_image)["duration"][time_index])
 
+    # DecayFactor is written as the header text, which keeps its original precision;
+    # the numeric value is in calculate_frame_values
     def calculate_DecayFactor(self, inveon_image: InveonImage, time_index) -> str:
         return inveon_image.get_frame_metadata_element(time_index, "decay_correction")
 
@@ -1676,5 +2126,5 @@ class Factory:
         return m
 
     def create_sop_common_module(self, inveon_image: InveonImage, sop_class_uid: str) -> SOPCommonModule:
-        m = SOPCommonModule(sop_class_uid, generate_uid())
+        m = SOPCommonModule(sop_class_uid, self.get_instance_uid(inveon_image, 1))
         return m
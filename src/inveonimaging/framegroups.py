@@ -0,0 +1,161 @@
+import struct
+import itertools
+import numpy
+from pydicom.sequence import Sequence
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_data_element
+from pydicom.tag import Tag
+
+from inveonimaging.writer import create_buffer
+
+
+PER_FRAME_FUNCTIONAL_GROUPS_TAG = Tag(0x5200, 0x9230)
+UNDEFINED_LENGTH                = 0xFFFFFFFF
+
+# Sequence element header followed by the header of its single item, little endian
+SEQUENCE_HEADER_DTYPE = numpy.dtype([("group", "<u2"), ("element", "<u2"), ("vr", "S2"), ("reserved", "<u2"),
+                                     ("length", "<u4"), ("item_group", "<u2"), ("item_element", "<u2"),
+                                     ("item_length", "<u4")])
+ITEM_HEADER_DTYPE     = numpy.dtype([("group", "<u2"), ("element", "<u2"), ("length", "<u4")])
+
+# Value types of the integer elements add_integer_element encodes itself
+INTEGER_VR_DTYPES = {"US": numpy.dtype("<u2"), "UL": numpy.dtype("<u4")}
+
+
+# The PerFrameFunctionalGroupsSequence of an enhanced multiframe image, kept as a table
+# rather than as one pydicom Dataset per frame.
+#
+# Each element of a functional group is held as the encoded bytes of its distinct values
+# and, for every frame, the index of the value the frame uses. A value that changes with
+# the time frame is encoded once per time frame, one that changes with the slice once per
+# slice, however many frames the image has. encode() assembles the whole sequence, with
+# explicit lengths, from these pieces and headers packed with numpy, so memory and time
+# grow with the number of frames only by the bytes written.
+class PerFrameFunctionalGroups:
+    def __init__(
+            self,
+            frame_count: int,
+            encodings=None):
+        self.frame_count = frame_count
+        self.encodings   = encodings
+        self.groups      = {}
+
+    # Adds the elements of items to a functional group: items are the distinct values,
+    # each a Dataset holding the group's elements for the frames that use it, and
+    # indices gives the item of each frame. An element missing from an item is left
+    # out of the frames that use that item.
+    def add_elements(self, group_keyword: str, items: list, indices) -> None:
+        indices = self.check_indices(indices, len(items))
+        encoded = {}
+        for item_index, item in enumerate(items):
+            for element in item:
+                if (element.tag not in encoded):
+                    encoded[element.tag] = [b""] * len(items)
+                buffer = create_buffer()
+                write_data_element(buffer, element, self.encodings)
+                encoded[element.tag][item_index] = buffer.getvalue()
+        for tag, values in encoded.items():
+            self.add_encoded_element(group_keyword, tag, values, indices)
+
+    # Adds one element already encoded (explicit VR little endian): values are the
+    # encoded elements and indices the value of each frame
+    def add_encoded_element(self, group_keyword: str, tag, values: list, indices) -> None:
+        group = self.groups.setdefault(Tag(group_keyword), {})
+        tag = Tag(tag)
+        if (tag in group):
+            raise Exception(f"Element {tag} is already in the per-frame functional group {group_keyword}")
+        group[tag] = (values, self.check_indices(indices, len(values)))
+
+    # Adds an unsigned integer element (US or UL) whose value differs from frame to frame,
+    # e.g. DimensionIndexValues. values has one row of values per frame; the elements of
+    # all frames are packed in one numpy record array rather than encoded one by one.
+    def add_integer_element(self, group_keyword: str, keyword: str, vr: str, values) -> None:
+        values = numpy.asarray(values).reshape(self.frame_count, -1)
+        dtype  = INTEGER_VR_DTYPES[vr]
+        if (values.size > 0 and (values.min() < 0 or values.max() > numpy.iinfo(dtype).max)):
+            raise Exception(f"Values of {keyword} do not fit in VR {vr}")
+
+        tag = Tag(keyword)
+        records = numpy.empty(self.frame_count, [("group", "<u2"), ("element", "<u2"), ("vr", "S2"), ("length", "<u2"),
+                                                 ("values", dtype, (values.shape[1],))])
+        records["group"]   = tag.group
+        records["element"] = tag.element
+        records["vr"]      = vr.encode("ascii")
+        records["length"]  = dtype.itemsize * values.shape[1]
+        records["values"]  = values
+        self.add_encoded_element(group_keyword, tag, split_records(records), numpy.arange(self.frame_count))
+
+    def check_indices(self, indices, value_count: int) -> numpy.ndarray:
+        indices = numpy.asarray(indices, numpy.intp)
+        if (indices.shape != (self.frame_count,)):
+            raise Exception(f"Expected one index per frame ({self.frame_count}), got shape {indices.shape}")
+        if (self.frame_count > 0 and (indices.min() < 0 or indices.max() >= value_count)):
+            raise Exception(f"Per-frame index outside the {value_count} values of the functional group")
+        return indices
+
+    def get_frame_count(self) -> int:
+        return self.frame_count
+
+    # The complete PerFrameFunctionalGroupsSequence element
+    def encode(self) -> bytes:
+        columns = []
+        frame_lengths = numpy.zeros(self.frame_count, numpy.int64)
+        for group_tag in sorted(self.groups):
+            group_columns = []
+            body_lengths  = numpy.zeros(self.frame_count, numpy.int64)
+            for values, indices in self.merge_runs(self.groups[group_tag]):
+                body_lengths += numpy.fromiter(map(len, values), numpy.int64, len(values))[indices]
+                group_columns.append(list(map(values.__getitem__, indices.tolist())))
+
+            headers = numpy.empty(self.frame_count, SEQUENCE_HEADER_DTYPE)
+            headers["group"]        = group_tag.group
+            headers["element"]      = group_tag.element
+            headers["vr"]           = b"SQ"
+            headers["reserved"]     = 0
+            headers["length"]       = body_lengths + 8
+            headers["item_group"]   = 0xFFFE
+            headers["item_element"] = 0xE000
+            headers["item_length"]  = body_lengths
+            columns.append(split_records(headers))
+            columns.extend(group_columns)
+            frame_lengths += body_lengths + SEQUENCE_HEADER_DTYPE.itemsize
+
+        items = numpy.empty(self.frame_count, ITEM_HEADER_DTYPE)
+        items["group"]   = 0xFFFE
+        items["element"] = 0xE000
+        items["length"]  = frame_lengths
+        columns.insert(0, split_records(items))
+
+        length = int(frame_lengths.sum()) + ITEM_HEADER_DTYPE.itemsize * self.frame_count
+        if (length >= UNDEFINED_LENGTH):
+            raise Exception(f"The per-frame functional groups of {self.frame_count} frames do not fit in one element")
+        header = struct.pack("<HH2sHI", PER_FRAME_FUNCTIONAL_GROUPS_TAG.group, PER_FRAME_FUNCTIONAL_GROUPS_TAG.element,
+                             b"SQ", 0, length)
+        return header + b"".join(itertools.chain.from_iterable(zip(*columns)))
+
+    # The elements of a group in tag order, with neighbouring elements that follow the
+    # same indices joined into one run of bytes per distinct value
+    def merge_runs(self, group: dict) -> list:
+        runs = []
+        for tag in sorted(group):
+            values, indices = group[tag]
+            if (len(runs) > 0 and runs[-1][1] is indices):
+                runs[-1] = ([before + after for before, after in zip(runs[-1][0], values)], indices)
+            else:
+                runs.append((values, indices))
+        return runs
+
+    # The sequence as pydicom Datasets, for a dataset that is kept in memory
+    def to_sequence(self) -> Sequence:
+        buffer = create_buffer()
+        buffer.write(self.encode())
+        buffer.seek(0)
+        return read_dataset(buffer, False, True).PerFrameFunctionalGroupsSequence
+
+
+# One bytes object per record of a structured array
+def split_records(records: numpy.ndarray) -> list:
+    data = records.tobytes()
+    size = records.dtype.itemsize
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
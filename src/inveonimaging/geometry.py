@@ -0,0 +1,94 @@
+import numpy
+
+from inveonimaging.inveon import InveonHeader
+
+
+# Patient (LPS) directions of the image axes for each Inveon subject_orientation:
+# (row direction, column direction, slice direction). The row direction is the
+# direction of increasing column index (first three values of ImageOrientationPatient),
+# the column direction that of increasing row index. Slices run along +z for feet
+# first and -z for head first orientations. 0 (not recorded) is treated as FFS.
+ORIENTATION_DIRECTIONS = {
+    0: ((-1, 0, 0), ( 0,  1, 0), (0, 0,  1)),
+    1: (( 1, 0, 0), ( 0, -1, 0), (0, 0,  1)),   # FFP
+    2: ((-1, 0, 0), ( 0, -1, 0), (0, 0, -1)),   # HFP
+    3: ((-1, 0, 0), ( 0,  1, 0), (0, 0,  1)),   # FFS
+    4: (( 1, 0, 0), ( 0,  1, 0), (0, 0, -1)),   # HFS
+    5: (( 0, 1, 0), ( 1,  0, 0), (0, 0,  1)),   # FFDR
+    6: (( 0,-1, 0), ( 1,  0, 0), (0, 0, -1)),   # HFDR
+    7: (( 0,-1, 0), (-1,  0, 0), (0, 0,  1)),   # FFDL
+    8: (( 0, 1, 0), (-1,  0, 0), (0, 0, -1)),   # HFDL
+}
+
+# Orientation whose patient axes the scanner coordinates below are expressed in
+REFERENCE_ORIENTATION = 3
+
+
+# Voxel to patient geometry of one image, built once from the header.
+#
+# Voxel (column i, row j, slice k) sits at these scanner coordinates, in mm, expressed
+# in the patient axes of the reference (FFS) orientation:
+#   x = ((X-1)/2 * pixel_size_x) - shift_x  -  i * pixel_size_x
+#   y = -(((Y-1)/2 * pixel_size_y) - shift_y)  +  j * pixel_size_y
+#   z = (k + .5 - Z/2) * pixel_size_z + shift_z
+# with shift = image_ref_shift. Every other orientation is a signed permutation of
+# these axes (see ORIENTATION_DIRECTIONS), so patient positions are the scanner
+# coordinates with their axes swapped and negated. They are computed that way rather
+# than through a matrix product, so the values match the per-slice formulas bit for bit.
+#
+# Slice indices count slices over all time frames (index % Z is the slice in its frame).
+class ImageGeometry:
+    def __init__(
+            self,
+            header: InveonHeader):
+        orientation = header.subject_orientation
+        if (orientation not in ORIENTATION_DIRECTIONS):
+            raise Exception(f"Do not have code to calculate patient geometry when subject_orientation is {orientation}")
+
+        self.header       = header
+        self.orientation  = orientation
+        self.directions   = numpy.array(ORIENTATION_DIRECTIONS[orientation], numpy.float64).T
+        self.shift        = header.get_image_ref_shift()
+        self.pixel_sizes  = numpy.array([header.pixel_size_x, header.pixel_size_y, header.pixel_size_z],
+                                        numpy.float64)
+
+        # Scanner axes (reference orientation) to patient axes, as a signed permutation
+        reference = numpy.array(ORIENTATION_DIRECTIONS[REFERENCE_ORIENTATION], numpy.float64).T
+        transform = self.directions @ reference.T
+        self.axes  = numpy.argmax(numpy.abs(transform), axis=1)
+        self.signs = transform[numpy.arange(3), self.axes]
+
+    # 4x4 affine that maps (column, row, slice, 1) to patient coordinates in mm. origin is
+    # the first voxel in image axes: x along the rows, y down the columns, z along the slices.
+    def get_affine(self) -> numpy.ndarray:
+        header = self.header
+        origin = numpy.array([-(float(header.x_dimension) - 1) / 2.0 * header.pixel_size_x + self.shift[0],
+                              -(float(header.y_dimension) - 1) / 2.0 * header.pixel_size_y + self.shift[1],
+                              (.5 - float(header.z_dimension) / 2) * header.pixel_size_z + self.shift[2]])
+        affine = numpy.eye(4)
+        affine[:3, :3] = self.directions * self.pixel_sizes
+        affine[:3, 3]  = self.directions @ origin
+        return affine
+
+    # (row direction, column direction), each three integers
+    def get_image_orientation(self) -> tuple:
+        row_direction, column_direction, slice_direction = ORIENTATION_DIRECTIONS[self.orientation]
+        return row_direction, column_direction
+
+    # Scanner z of each slice, in mm (SliceLocation); the same for every orientation
+    def get_slice_locations(self, slice_indices) -> numpy.ndarray:
+        header = self.header
+        z_positions = ((numpy.asarray(slice_indices, numpy.float64) + .5 - float(header.z_dimension) / 2)
+                       * header.pixel_size_z)
+        if (header.image_ref_shift is not None):
+            z_positions = z_positions + header.image_ref_shift[2]
+        return z_positions
+
+    # Patient position of the first voxel of each slice (ImagePositionPatient), one row per slice
+    def get_slice_positions(self, slice_indices) -> numpy.ndarray:
+        header = self.header
+        scanner = numpy.empty((len(slice_indices), 3), numpy.float64)
+        scanner[:, 0] =   ((float(header.x_dimension) - 1) / 2.0 * header.pixel_size_x) - self.shift[0]
+        scanner[:, 1] = -(((float(header.y_dimension) - 1) / 2.0 * header.pixel_size_y) - self.shift[1])
+        scanner[:, 2] = self.get_slice_locations(slice_indices)
+        return scanner[:, self.axes] * self.signs
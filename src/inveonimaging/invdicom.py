@@ -2,6 +2,7 @@ import pydicom
 from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
 from pydicom.sequence import Sequence
 from pydicom.uid import UID
+from pydicom.tag import Tag
 
 class PatientModule:
     def __init__(
@@ -347,7 +348,12 @@ class MultiframeFunctionalGroupsModule:
         content_date:str,
         content_time:str,
         number_of_frames:str,
-        frame_content_list:str
+        pixel_spacing_row:str,
+        pixel_spacing_col:str,
+        slice_thickness:str,
+        image_orientation_patient:str,
+        per_frame_functional_groups=None,
+        rescale_slope:str="1"
     ):
 
         self.ds = Dataset()
@@ -357,75 +363,54 @@ class MultiframeFunctionalGroupsModule:
         self.ds.ContentTime    = content_time
         self.ds.NumberOfFrames = number_of_frames
         if (modality == "CT"):
-            self.ds.SharedFunctionalGroupsSequence = Sequence([self.fill_shared_functional_groups_sequence_ct()])
+            self.ds.SharedFunctionalGroupsSequence = Sequence([self.fill_shared_functional_groups_sequence_ct(
+                pixel_spacing_row, pixel_spacing_col, slice_thickness, image_orientation_patient, rescale_slope)])
         else:
-            self.ds.SharedFunctionalGroupsSequence = Sequence([self.fill_shared_functional_groups_sequence_pet()])
+            self.ds.SharedFunctionalGroupsSequence = Sequence([self.fill_shared_functional_groups_sequence_pet(
+                pixel_spacing_row, pixel_spacing_col, slice_thickness, image_orientation_patient)])
 
-        self.ds.PerFrameFunctionalGroupsSequence   = Sequence(self.fill_per_frame_functional_groups_sequence(frame_content_list))
+        # The per-frame groups are built as a PerFrameFunctionalGroups table; they are only
+        # turned into pydicom Datasets when the caller asks for the whole dataset in memory
+        if (per_frame_functional_groups is not None):
+            self.ds.PerFrameFunctionalGroupsSequence = per_frame_functional_groups.to_sequence()
 
-    def fill_shared_functional_groups_sequence_ct(self) -> Dataset:
+    def fill_shared_functional_groups_sequence_ct(self, pixel_spacing_row, pixel_spacing_col, slice_thickness,
+                                                  image_orientation_patient, rescale_slope) -> Dataset:
         d = Dataset()
-        d.PixelMeasuresSequence     = Sequence([self.fill_pixel_measures_sequence()])
-        d.CTImageFrameTypeSequence  = Sequence([self.fill_ct_image_frame_type_sequence()])
-        d.PlaneOrientationSequence  = Sequence([self.fill_plane_orientation_sequence()])
-        d.PlanePositionSequence     = Sequence([self.fill_plane_position_sequence()])
+        d.PixelMeasuresSequence            = Sequence([self.fill_pixel_measures_sequence(pixel_spacing_row, pixel_spacing_col, slice_thickness)])
+        d.CTImageFrameTypeSequence         = Sequence([self.fill_ct_image_frame_type_sequence()])
+        d.PlaneOrientationSequence         = Sequence([self.fill_plane_orientation_sequence(image_orientation_patient)])
+        d.PixelValueTransformationSequence = Sequence([self.fill_pixel_value_transformation_sequence_ct(rescale_slope)])
         return d
 
-    def fill_shared_functional_groups_sequence_pet(self) -> Dataset:
+    def fill_shared_functional_groups_sequence_pet(self, pixel_spacing_row, pixel_spacing_col, slice_thickness,
+                                                   image_orientation_patient) -> Dataset:
         d = Dataset()
-        d.PixelMeasuresSequence     = Sequence([self.fill_pixel_measures_sequence()])
+        d.PixelMeasuresSequence     = Sequence([self.fill_pixel_measures_sequence(pixel_spacing_row, pixel_spacing_col, slice_thickness)])
         d.PETFrameTypeSequence      = Sequence([self.fill_pet_frame_type_sequence()])
-        d.PlaneOrientationSequence  = Sequence([self.fill_plane_orientation_sequence()])
-        d.PlanePositionSequence     = Sequence([self.fill_plane_position_sequence()])
+        d.PlaneOrientationSequence  = Sequence([self.fill_plane_orientation_sequence(image_orientation_patient)])
         return d
 
-    def fill_per_frame_functional_groups_sequence(self, frame_content_list):
-
-        functional_groups_list = []
-
-        for index in range(len(frame_content_list)):
-            d = Dataset()
-            d.FrameContentSequence = Sequence([self.fill_frame_content_sequence(index+1, frame_content_list[index])])
-            d.UnassignedPerFrameConvertedAttributesSequence = Sequence([self.fill_unassigned_per_frame_converted_attributes_sequence(index+1,frame_content_list[index])])
-            functional_groups_list.append(d)
-
-        return functional_groups_list
-
-    def fill_pixel_measures_sequence(self) -> Dataset:
+    def fill_pixel_measures_sequence(self, pixel_spacing_row, pixel_spacing_col, slice_thickness) -> Dataset:
         dataset = Dataset()
 
-        # TODO
-        dataset.PixelSpacing = "1\\1"
-        dataset.SliceThickness = "0.05"
-        dataset.SpacingBetweenSlices = "0.05"
+        dataset.PixelSpacing         = pixel_spacing_row + "\\" + pixel_spacing_col
+        dataset.SliceThickness       = slice_thickness
+        dataset.SpacingBetweenSlices = slice_thickness
 
         return dataset
 
-    def fill_frame_content_sequence(self, index, frame_content) -> Dataset:
+    # CT pixels are written unscaled (or, for 4 byte integers out of the int16 range, all
+    # with one slope), so one transformation holds for every frame.
+    # PET frames each have their own slope, in the per-frame groups.
+    def fill_pixel_value_transformation_sequence_ct(self, rescale_slope) -> Dataset:
         dataset = Dataset()
-
-        # TODO
-#        dataset.InStackPositionNumber    = index
-        dataset.FrameReferenceDateTime   = "202405201200"
-        dataset.FrameAcquisitionDateTime = "202405201200"
-        dataset.FrameAcquisitionDuration = 100
-        dataset.FrameAcquisitionNumber   = index
+        dataset.RescaleIntercept = "0"
+        dataset.RescaleSlope     = rescale_slope
+        dataset.RescaleType      = "HU"
 
         return dataset
 
-    def fill_unassigned_per_frame_converted_attributes_sequence(self, index, frame_content) -> Dataset:
-        dataset = Dataset()
-
-        # TODO
-        dataset.DistanceSourceToDetector = 400.
-        dataset.DistanceSourceToPatient  = 380.
-        dataset.FilterType               = "None"
-        dataset.RevolutionTime           = 99
-        dataset.InstanceNumber           = index
-
-        return dataset
-
-
     def fill_ct_image_frame_type_sequence(self) -> Dataset:
         dataset = Dataset()
         dataset.FrameType                       = "ORIGINAL\\PRIMARY\\WHOLE_BODY\\NONE"
@@ -445,16 +430,9 @@ class MultiframeFunctionalGroupsModule:
         return dataset
 
 
-    def fill_plane_orientation_sequence(self) -> Dataset:
+    def fill_plane_orientation_sequence(self, image_orientation_patient) -> Dataset:
         dataset = mergeDatasets()
-        dataset.ImageOrientationPatient = "-1\\0\\0\\0\\-1\\0"
-
-        return dataset
-
-
-    def fill_plane_position_sequence(self) -> Dataset:
-        dataset = mergeDatasets()
-        dataset.ImagePositionPatient = "20.037376\\20.037224\\-109.937187"
+        dataset.ImageOrientationPatient = image_orientation_patient
 
         return dataset
 
@@ -463,16 +441,31 @@ class MultiframeFunctionalGroupsModule:
 
 class MultiframeDimensionModule:
     def __init__(
-        self):
+        self,
+        dimension_organization_uid:str,
+        dimension_organization_type:str,
+        dimensions:list):
 
         self.ds = Dataset()
 
         dimension_org_sequence = Dataset()
-        ## TODO
-        dimension_org_sequence.DimensionOrganizationUID = "1.2.3.4"
+        dimension_org_sequence.DimensionOrganizationUID = dimension_organization_uid
 
         self.ds.DimensionOrganizationSequence = Sequence([dimension_org_sequence])
-        self.ds.DimensionOrganizationType     = "3D"
+        self.ds.DimensionOrganizationType     = dimension_organization_type
+        self.ds.DimensionIndexSequence        = Sequence([self.fill_dimension_index_sequence(dimension_organization_uid,
+                                                                                             index_keyword, label)
+                                                          for index_keyword, label in dimensions])
+
+    # One dimension: an attribute of the Frame Content Sequence and a label for it
+    def fill_dimension_index_sequence(self, dimension_organization_uid, index_keyword, label) -> Dataset:
+        dataset = Dataset()
+        dataset.DimensionOrganizationUID  = dimension_organization_uid
+        dataset.DimensionIndexPointer     = Tag(index_keyword)
+        dataset.FunctionalGroupPointer    = Tag("FrameContentSequence")
+        dataset.DimensionDescriptionLabel = label
+
+        return dataset
 
     def get_dataset(self) -> Dataset:
         return self.ds
@@ -682,20 +675,6 @@ class SOPCommonModule:
     def get_dataset(self) -> Dataset:
         return self.ds
 
-class FrameContentItem:
-    def __init__(
-        self,
-        frame_acquisition_number:str,
-        frame_acquisition_date_time:str
-    ):
-
-        self.ds = Dataset()
-        self.ds.FrameAcquisitionNumber   = frame_acquisition_number
-        self.ds.FrameAcquisitionDateTime = frame_acquisition_date_time
-
-    def get_dataset(self) -> Dataset:
-        return self.ds
-
 def mergeDatasets(*arguments) -> Dataset:
     ds = Dataset()
     for arg in arguments:
@@ -1,4 +1,226 @@
+import bz2
 import datetime
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import numpy
+
+
+# Inveon data_type values and the numpy dtype used to view the .img file.
+# Big endian (Sun) data are viewed with a big endian dtype; the bytes are only
+# swapped when a whole slice or frame is converted.
+PIXEL_DTYPES = {
+    1: numpy.dtype("i1"),    # Byte
+    2: numpy.dtype("<i2"),   # 2-byte integer, Intel byte order
+    3: numpy.dtype("<i4"),   # 4-byte integer, Intel byte order
+    4: numpy.dtype("<f4"),   # 4-byte float, Intel byte order
+    5: numpy.dtype(">f4"),   # 4-byte float, Sun byte order
+    6: numpy.dtype(">i2"),   # 2-byte integer, Sun byte order
+    7: numpy.dtype(">i4"),   # 4-byte integer, Sun byte order
+}
+
+# Compressed .img files (foo.img.gz next to foo.img.hdr) are decoded as a stream
+# with the stdlib codecs
+PIXEL_FILE_OPENERS = {
+    ".gz":  gzip.open,
+    ".xz":  lzma.open,
+    ".bz2": bz2.open,
+}
+
+
+# Numeric per-frame header fields kept in the frame table, one float64 column each
+FRAME_TABLE_DTYPE = numpy.dtype([
+    ("frame_start",      numpy.float64),
+    ("frame_duration",   numpy.float64),
+    ("scale_factor",     numpy.float64),
+    ("minimum",          numpy.float64),
+    ("maximum",          numpy.float64),
+    ("decay_correction", numpy.float64),
+])
+
+
+# Header lookup tables, built once at import
+
+# Elements whose integer codes are also stored as text, as <element>_mapped
+CODED_ELEMENTS = {"model": "CODED_MODEL", "modality": "CODED_MODALITY",
+                  "modality_configuration": "CODED_MODALITY_CONFIGURATION",
+                  "acquisition_mode": "CODED_ACQUISITION_MODE",
+                  "recon_algorithm": "CODED_RECON_ALGORITHM",
+                  "subject_orientation": "CODED_SUBJECT_ORIENTATION"
+                  }
+
+CODE_TABLE = {
+    "model:0": "unknown",
+    "model:2000": "Primate",
+    "model:2001": "Rodent",
+    "model:2002": "microPET2",
+    "model:2500": "Focus_220",
+    "model:2501": "Focus_120",
+    "model:3000": "mCAT",
+    "model:3500": "mCATII",
+    "model:4000": "mSPECT",
+    "model:5000": "Inveon_Dedicated_PET",
+    "model:5001": "Inveon_MM_Platform",
+    "model:6000": "MR_PET_Head_Insert",
+    "model:8000": "Tuebingen_PET_MR",
+    "modality:-1": "Unknown",
+    "modality:0": "PET",
+    "modality:1": "CT",
+    "modality:2": "SPECT",
+    "modality_configuration:0":    "Unknown",
+
+    # These are CT values
+    "modality_configuration:3000": "mCAT",
+    "modality_configuration:3500": "mCATII",
+    "modality_configuration:3600": "Inveon_MM_Std_CT",
+    "modality_configuration:3601": "Inveon_MM_HiRes_Std_CT",
+    "modality_configuration:3602": "Inveon_MM_Std_LFOV_CT",
+    "modality_configuration:3603": "Inveon_MM_HiRes_LFOV_CT",
+
+    # These are PET values
+    "modality_configuration:2000": "Primate",
+    "modality_configuration:2001": "Rodent",
+    "modality_configuration:2002": "microPET2",
+    "modality_configuration:2500": "Focus_220",
+    "modality_configuration:2501": "Focus_120",
+    "modality_configuration:5000": "Inveon_Dedicated_PET",
+    "modality_configuration:5500": "Inveon_MM_PET",
+
+    "acquisition_mode:0": "Unknown acquisition mode",
+    "acquisition_mode:1": "Blank acquisition",
+    "acquisition_mode:2": "Emission acquisition",
+    "acquisition_mode:3": "Dynamic acquisition",
+    "acquisition_mode:4": "Gated acquisition",
+    "acquisition_mode:5": "Continuous bed motion acquisition",
+    "acquisition_mode:6": "Singles transmission acquisition",
+    "acquisition_mode:7": "Windowed coincidence transmission acquisition",
+    "acquisition_mode:8": "Non-windowed coincidence transmission acquisition",
+    "acquisition_mode:9": "CT projection acquisition",
+    "acquisition_mode:10": "CT calibration acquisition",
+    "acquisition_mode:11": "SPECT planar projection acquisitio",
+    "acquisition_mode:12": "SPECT multi-projection acquisition",
+    "acquisition_mode:13": "SPECT calibration acquisition",
+    "acquisition_mode:14": "SPECT tomography normalization acquisition",
+    "acquisition_mode:15": "SPECT detector setup acquisition",
+    "acquisition_mode:16": "SPECT scout view acquisition",
+    "acquisition_mode:17": "SPECT planar normalization acquisition",
+
+    "recon_algorithm:0": "Unknown, or no, algorithm type",
+    "recon_algorithm:1": "Filtered Backprojection",
+    "recon_algorithm:2": "OSEM2d",
+    "recon_algorithm:3": "OSEM3d",
+    "recon_algorithm:4": "3D Reprojection",
+    "recon_algorithm:5": "Undefined",      # Undefined
+    "recon_algorithm:6": "OSEM3D/MAP",
+    "recon_algorithm:7": "MAPTR for transmission image",
+    "recon_algorithm:8": "MAP 3D reconstruction",
+    "recon_algorithm:9": "Feldkamp Cone Beam",
+
+    "subject_orientation:0": "",
+    "subject_orientation:1": "FFP",
+    "subject_orientation:2": "HFP",
+    "subject_orientation:3": "FFS",
+    "subject_orientation:4": "HFS",
+    "subject_orientation:5": "FFDR",
+    "subject_orientation:6": "HFDR",
+    "subject_orientation:7": "FFDL",
+    "subject_orientation:8": "HFDL",
+}
+
+MONTH_MAP = {
+    "Jan": "01",
+    "Feb": "02",
+    "Mar": "03",
+    "Apr": "04",
+    "May": "05",
+    "Jun": "06",
+    "Jul": "07",
+    "Aug": "08",
+    "Sep": "09",
+    "Oct": "10",
+    "Nov": "11",
+    "Dec": "12"}
+
+FILTER_MAP = {
+    "x_filter:0": "No filter",
+    "x_filter:1": "Ramp filter (backprojection) or no filter",
+    "x_filter:2": "First-order Butterworth window",
+    "x_filter:3": "Hanning window",
+    "x_filter:4": "Hamming window",
+    "x_filter:5": "Parzen window",
+    "x_filter:6": "Shepp filter",
+    "x_filter:7": "Second-order Butterworth window",
+
+    "y_filter:0": "No filter",
+    "y_filter:2": "First-order Butterworth window",
+    "y_filter:3": "Hanning window",
+    "y_filter:4": "Hamming window",
+    "y_filter:5": "Parzen window",
+    "y_filter:7": "Second-order Butterworth window",
+
+    "z_filter:0": "No filter",
+    "z_filter:2": "First-order Butterworth window",
+    "z_filter:3": "Hanning window",
+    "z_filter:4": "Hamming window",
+    "z_filter:5": "Parzen window",
+    "z_filter:7": "Second-order Butterworth window",
+}
+
+
+# foo.img for foo.img and for a compressed foo.img.gz / .xz / .bz2; None for any other file
+def get_img_path(path: str):
+    filename, file_extension = os.path.splitext(path)
+    if (file_extension in PIXEL_FILE_OPENERS and filename.endswith(".img")):
+        return filename
+    if (file_extension == ".img"):
+        return path
+    return None
+
+
+# Raise for a file that is neither .img nor .hdr unless it is ignored
+def check_extra_file(path: str, ignore_all_extra_files: bool, ignore_specific_extra_files: list) -> None:
+    filename, file_extension = os.path.splitext(path)
+    raiseException = True
+    ignore_specific_extra_files_msg = ""
+    if (ignore_specific_extra_files):
+        ignore_specific_extra_files_msg = ", ".join(ignore_specific_extra_files)
+        if file_extension in ignore_specific_extra_files:
+            raiseException = False
+    if ignore_all_extra_files:
+        raiseException = False
+    if (raiseException):
+        raise Exception(
+            f"File {path} found with file extension {file_extension}. This program expects only {ignore_specific_extra_files_msg} .img and .hdr  files in the folder")
+
+
+# The .img files (plain or compressed) among paths, checking that every .img has a .hdr
+# and every .hdr has exactly one .img. exists tells whether a path is present, so the
+# same rules apply to a folder and to the members of an archive.
+def pair_img_files(paths: list, exists, ignore_all_extra_files: bool, ignore_specific_extra_files: list) -> list:
+    rtn = []
+    for full_path in paths:
+        filename, file_extension = os.path.splitext(full_path)
+        img_path = get_img_path(full_path)
+        if (img_path is not None):
+            rtn.append(full_path)
+            expected_hdr_file = f"{img_path}.hdr"
+            if not exists(expected_hdr_file):
+                raise Exception(f"We found this .img file {full_path} with no corresponding .hdr file")
+
+        elif (file_extension == ".hdr"):
+            expected_img_files = [filename] + [f"{filename}{extension}" for extension in PIXEL_FILE_OPENERS]
+            found_img_files = [img_file for img_file in expected_img_files if exists(img_file)]
+            if (len(found_img_files) == 0):
+                raise Exception(f"We found this .hdr file {full_path} with no corresponding .img file")
+            if (len(found_img_files) > 1):
+                raise Exception(f"We found this .hdr file {full_path} with more than one .img file {found_img_files}")
+
+        else:
+            check_extra_file(full_path, ignore_all_extra_files, ignore_specific_extra_files)
+
+    return rtn
 
 
 class InveonFrame:
@@ -16,22 +238,101 @@ class InveonFrame:
 
         return rtn
 
+# Converters for InveonHeader fields; an absent (or empty) element is None
+def parse_int(value):
+    if (value is None or value == ""):
+        return None
+    return int(value)
+
+
+def parse_float(value):
+    if (value is None or value == ""):
+        return None
+    return float(value)
+
+
+# image_ref_shift is stored as the whole line: "image_ref_shift x y z"
+def parse_float_tuple(line):
+    if (line is None or line == ""):
+        return None
+    return tuple(float(token) for token in line.split(" ")[1:4])
+
+
+# scan_time / injection_time lines: "scan_time Mon Jan 10 12:34:56 2022"
+def parse_inveon_datetime(line):
+    if (line is None or line == ""):
+        return None
+    tokens = line.split()
+    hour, minute, second = tokens[4].split(":")
+    return datetime.datetime(int(tokens[5]), int(MONTH_MAP[tokens[2]]), int(tokens[3]),
+                             int(hour), int(minute), int(second))
+
+
+# Typed copy of the global header fields the converters compute with. Each value is
+# converted once, when the header is parsed, instead of once per slice. Absent fields
+# are None. The string metadata dict stays as it is for everything else.
+class InveonHeader:
+    __slots__ = ("data_type", "x_dimension", "y_dimension", "z_dimension", "time_frames", "total_frames",
+                 "subject_orientation", "modality", "pixel_size_x", "pixel_size_y", "pixel_size_z",
+                 "image_ref_shift", "calibration_factor", "isotope_half_life", "isotope_branching_fraction",
+                 "scan_time", "injection_time")
+
+    def __init__(
+            self,
+            metadata: dict):
+        self.data_type                  = parse_int(metadata.get("data_type"))
+        self.x_dimension                = parse_int(metadata.get("x_dimension"))
+        self.y_dimension                = parse_int(metadata.get("y_dimension"))
+        self.z_dimension                = parse_int(metadata.get("z_dimension"))
+        self.time_frames                = parse_int(metadata.get("time_frames"))
+        self.total_frames               = parse_int(metadata.get("total_frames"))
+        self.subject_orientation        = parse_int(metadata.get("subject_orientation"))
+        self.modality                   = parse_int(metadata.get("modality"))
+        self.pixel_size_x               = parse_float(metadata.get("pixel_size_x"))
+        self.pixel_size_y               = parse_float(metadata.get("pixel_size_y"))
+        self.pixel_size_z               = parse_float(metadata.get("pixel_size_z"))
+        self.image_ref_shift            = parse_float_tuple(metadata.get("image_ref_shift"))
+        self.calibration_factor         = parse_float(metadata.get("calibration_factor"))
+        self.isotope_half_life          = parse_float(metadata.get("isotope_half_life"))
+        self.isotope_branching_fraction = parse_float(metadata.get("isotope_branching_fraction"))
+        self.scan_time                  = parse_inveon_datetime(metadata.get("scan_time"))
+        self.injection_time             = parse_inveon_datetime(metadata.get("injection_time"))
+
+    # (x, y, z) shift of the image centre, (0, 0, 0) when the header has none
+    def get_image_ref_shift(self) -> tuple:
+        if (self.image_ref_shift is None):
+            return (0.0, 0.0, 0.0)
+        return self.image_ref_shift
+
+
 class InveonImage:
+    # archive is set when the .img/.hdr pair are members of a zip or tar archive
+    # (see inveonimaging.archive); base_path is then the member name
     def __init__(
             self,
             name:str,
-            base_path=None):
+            base_path=None,
+            archive=None):
         self.name = name
         self.base_path     = base_path
+        self.archive       = archive
         self.metadata      = {}
         self.metadata["ImageComments"] = None
+        self.header        = None
+        self.header_digest = None
         self.frames        = {}
+        self.frame_lines   = None
+        self.frame_table   = None
         self.current_frame = None
         self.pixel_fh      = None
+        self.pixel_array   = None
+        self.pixel_stream  = None
+        self.stream_frame_index = None
+        self.stream_frame  = None
 
     def get_pixel_fh(self):
         if (not self.pixel_fh):
-            self.pixel_fh = open(self.base_path, 'rb')
+            self.pixel_fh = self.open_pixel_stream()
 
         return self.pixel_fh
 
@@ -39,12 +340,144 @@ class InveonImage:
         if (self.pixel_fh):
             self.pixel_fh.close();
             self.pixel_fh = None
+        if (self.pixel_stream):
+            self.pixel_stream.close()
+            self.pixel_stream = None
+        self.pixel_array = None
+        self.stream_frame_index = None
+        self.stream_frame = None
+
+    # Compression extension of the .img file (".gz", ".xz", ".bz2") or "" for a plain file
+    def get_compression(self) -> str:
+        for extension in PIXEL_FILE_OPENERS:
+            if (self.base_path.endswith(extension)):
+                return extension
+        return ""
+
+    def is_compressed(self) -> bool:
+        return self.get_compression() != ""
+
+    # Compressed files and archive members cannot be memory mapped; their pixels are
+    # decoded from a stream that is only read forward
+    def is_streamed(self) -> bool:
+        return self.is_compressed() or self.archive is not None
+
+    # The header of foo.img and of foo.img.gz is foo.img.hdr
+    def get_header_path(self) -> str:
+        img_path = self.base_path
+        compression = self.get_compression()
+        if (compression != ""):
+            img_path = img_path[:-len(compression)]
+        return f"{img_path}.hdr"
+
+    # Binary file object positioned at the start of the pixel data, decoding compressed files
+    def open_pixel_stream(self):
+        opener = PIXEL_FILE_OPENERS.get(self.get_compression(), open)
+        if (self.archive is None):
+            return opener(self.base_path, "rb")
+
+        fh = self.archive.open_member(self.base_path)
+        if (self.is_compressed()):
+            return opener(fh, "rb")
+        return fh
+
+    def get_pixel_dtype(self) -> numpy.dtype:
+        data_type = self.header.data_type
+        if (data_type not in PIXEL_DTYPES):
+            raise Exception(f"Unsupported data_type {data_type} when trying to read pixel data")
+        return PIXEL_DTYPES[data_type]
+
+    # Frame count used to lay out the .img file. CT headers carry total_frames,
+    # some PET headers only carry time_frames.
+    def get_pixel_frame_count(self) -> int:
+        for value in [self.header.total_frames, self.header.time_frames]:
+            if (value is not None):
+                return value
+        return 1
+
+    # Shape of the pixel store: (frames, z, y, x)
+    def get_pixel_shape(self) -> tuple:
+        return (self.get_pixel_frame_count(),
+                self.header.z_dimension,
+                self.header.y_dimension,
+                self.header.x_dimension)
+
+    # Read-only memory map of the .img file. Slices and frames can be taken in any
+    # order; nothing is read from disk until the returned views are touched.
+    # A compressed file or archive member cannot be mapped and is decoded into memory in full.
+    def get_pixel_array(self) -> numpy.memmap:
+        if (self.pixel_array is None):
+            dtype = self.get_pixel_dtype()
+            shape = self.get_pixel_shape()
+            if (self.is_streamed()):
+                self.pixel_array = numpy.stack([self.read_stream_frame(index).copy() for index in range(shape[0])])
+                return self.pixel_array
+            expected_size = dtype.itemsize * shape[0] * shape[1] * shape[2] * shape[3]
+            actual_size = os.path.getsize(self.base_path)
+            if (actual_size < expected_size):
+                raise Exception(
+                    f"Pixel file {self.base_path} has {actual_size} bytes, header describes {expected_size} bytes")
+            self.pixel_array = numpy.memmap(self.base_path, dtype=dtype, mode="r", shape=shape)
+
+        return self.pixel_array
+
+    # time_index and slice_index number from 0
+    def get_frame_pixels(self, time_index: int) -> numpy.ndarray:
+        if (self.is_streamed() and self.pixel_array is None):
+            return self.read_stream_frame(time_index)
+        return self.get_pixel_array()[time_index]
+
+    def get_slice_pixels(self, time_index: int, slice_index: int) -> numpy.ndarray:
+        return self.get_frame_pixels(time_index)[slice_index]
+
+    # Decode one time frame of a compressed .img file or archive member. Frames are decoded
+    # in order as the stream is read; asking for an earlier frame restarts the stream.
+    def read_stream_frame(self, time_index: int) -> numpy.ndarray:
+        if (self.stream_frame_index == time_index):
+            return self.stream_frame
+
+        # The decoded frame is read into the same buffer every time; callers use (or copy)
+        # a frame before asking for the next one.
+        frame = self.stream_frame
+        if (frame is None):
+            dtype = self.get_pixel_dtype()
+            frame_count, z_dimension, rows, columns = self.get_pixel_shape()
+            frame = numpy.empty((z_dimension, rows, columns), dtype)
+        frame_bytes = memoryview(frame).cast("B")
+
+        if (self.pixel_stream is None or self.stream_frame_index is None or self.stream_frame_index > time_index):
+            if (self.pixel_stream is not None):
+                self.pixel_stream.close()
+            self.pixel_stream = self.open_pixel_stream()
+        self.pixel_stream.seek(time_index * len(frame_bytes))
+        self.stream_frame_index = None
+
+        position = 0
+        while (position < len(frame_bytes)):
+            count = self.pixel_stream.readinto(frame_bytes[position:])
+            if (count == 0):
+                raise Exception(f"Pixel file {self.base_path} ended before time frame {time_index}")
+            position += count
+
+        self.stream_frame_index = time_index
+        self.stream_frame       = frame
+        return frame
+
+    # Selected time frames and slices as a (frames, z, y, x) array. With no selection this
+    # is the memory map itself; otherwise only the pages holding the selection are read.
+    def get_pixel_subset(self, time_frames=None, slices=None) -> numpy.ndarray:
+        pixels = self.get_pixel_array()
+        if (time_frames is not None and len(time_frames) != pixels.shape[0]):
+            pixels = pixels[list(time_frames)]
+        if (slices is not None and len(slices) != pixels.shape[1]):
+            pixels = pixels[:, list(slices)]
+        return pixels
 
     def add_frame(self, frame_index:str, frame:InveonFrame):
-        self.frames[frame_index] = frame
+        self.get_frames()[frame_index] = frame
 
     def get_frame(self, frame_index:str):
-        return self.frames[frame_index]
+        return self.get_frames()[frame_index]
 
     def get_name(self) -> str:
         return self.name
@@ -55,6 +488,11 @@ class InveonImage:
     def get_base_path(self) -> str:
         return self.base_path
 
+    # Identifies the acquisition independently of where the files are kept: the .hdr
+    # file name and a digest of its contents. Set by parse_header.
+    def get_source_identity(self) -> str:
+        return f"{os.path.basename(self.get_header_path())}:{self.header_digest}"
+
     def get_metadata_element(self, element_name) -> str:
         rtn = ""
 
@@ -72,196 +510,115 @@ class InveonImage:
         inveon_frame_instance = self.get_frame(str(index))
         return inveon_frame_instance.get_metadata_element(element_name)
 
+    # The .hdr file is read in one go. The global section is parsed straight away; the
+    # per-frame blocks that follow it are only split into lines and are tokenized the
+    # first time a frame is asked for (see load_frames).
     def parse_header(self, base_path=None):
         if (base_path != None):
             self.base_path = base_path
-        hdr_path = f"{self.base_path}.hdr"
-
-        with open(hdr_path) as file:
-            while line := file.readline():
-                if self.current_frame is None:
-                    self.parse_header_line(line.rstrip())
-                else:
-                    self.parse_frame_header_line(line.rstrip())
+        hdr_path = self.get_header_path()
 
+        if (self.archive is None):
+            file = open(hdr_path)
+        else:
+            file = io.TextIOWrapper(self.archive.open_member(hdr_path))
+        with file:
+            text = file.read()
+        self.header_digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+        lines = text.split("\n")
+        if (lines[-1] == ""):
+            lines.pop()
+
+        for index, line in enumerate(lines):
+            if (line.startswith("frame ")):
+                self.frame_lines = lines[index:]
+                break
+            self.parse_header_line(line.rstrip())
+
+        self.header = InveonHeader(self.metadata)
         return self
 
-
+    def get_header(self) -> InveonHeader:
+        return self.header
+
+    # Tokenize the per-frame blocks kept back by parse_header
+    def load_frames(self) -> None:
+        lines = self.frame_lines
+        self.frame_lines = None
+        for line in lines:
+            self.parse_frame_header_line(line.rstrip())
+
+    def get_frames(self) -> dict:
+        if (self.frame_lines is not None):
+            self.load_frames()
+        return self.frames
+
+    # The numeric per-frame fields as a structured array with one row per frame, in
+    # frame number order, so values for all frames can be computed in one expression.
+    # Fields a frame does not have are NaN.
+    def get_frame_table(self) -> numpy.ndarray:
+        if (self.frame_table is None):
+            frames = self.get_frames()
+            table = numpy.full(len(frames), numpy.nan, FRAME_TABLE_DTYPE)
+            for frame_number, frame in frames.items():
+                row = table[int(frame_number)]
+                for field in FRAME_TABLE_DTYPE.names:
+                    value = frame.metadata.get(field)
+                    if (value is not None and value != ""):
+                        row[field] = float(value)
+            self.frame_table = table
+        return self.frame_table
+
+    # A line is a keyword, a keyword and one value, or a keyword and several values;
+    # the last are stored as the whole line
     def parse_frame_header_line(self, line:str) -> None:
         if (line.startswith("#")):
             return
 
-        tokens = line.split(" ")
-        if (len(tokens) == 0):
+        keyword, separator, value = line.partition(" ")
+        if (keyword == "frame"):
+            self.current_frame = value.split(" ")[0]
+            self.frames[self.current_frame] = InveonFrame(self.current_frame)
             return
 
-        if (tokens[0] == "frame"):
-            self.current_frame = tokens[1]
-            new_frame = InveonFrame(self.current_frame)
-            self.add_frame(self.current_frame, new_frame)
-            return
-
-        frame = self.get_frame(self.current_frame)
-        if (len(tokens) == 1):
-            frame.metadata[tokens[0]] = ""
-
-        elif (len(tokens) == 2):
-            frame.metadata[tokens[0]] = tokens[1]
-
+        frame = self.frames[self.current_frame]
+        if (" " in value):
+            frame.metadata[keyword] = line
         else:
-            frame.metadata[tokens[0]] = line
-
-        self.add_frame(self.current_frame, frame)
+            frame.metadata[keyword] = value
 
     def parse_header_line(self, line:str) -> None:
         if (line.startswith("#")):
             return
 
-        tokens = line.split(" ")
-        if (len(tokens) == 0):
-            return
-
-        if (tokens[0] == "frame"):
-            self.current_frame = tokens[1]
-            new_frame = InveonFrame(self.current_frame)
-            self.add_frame(self.current_frame, new_frame)
+        keyword, separator, value = line.partition(" ")
+        if (keyword == "frame"):
+            self.current_frame = value.split(" ")[0]
+            self.add_frame(self.current_frame, InveonFrame(self.current_frame))
             return
 
-        if (len(tokens) == 1):
-            self.metadata[tokens[0]] = ""
-
-        elif (len(tokens) == 2):
-            self.metadata[tokens[0]] = tokens[1]
-            self.process_mapped_elements(tokens[0], tokens[1])
-
+        if (" " in value):
+            self.metadata[keyword] = line
+            self.process_multi_token_elements(keyword, line)
         else:
-            self.metadata[tokens[0]] = line
-            self.process_multi_token_elements(tokens[0], line)
+            self.metadata[keyword] = value
+            if (keyword in CODED_ELEMENTS):
+                self.process_mapped_elements(keyword, value)
 
 
     def process_mapped_elements(self, token:str, value:str) -> None:
-        coded_elements = {"model": "CODED_MODEL", "modality": "CODED_MODALITY",
-                          "modality_configuration": "CODED_MODALITY_CONFIGURATION",
-                          "acquisition_mode": "CODED_ACQUISITION_MODE",
-                          "recon_algorithm": "CODED_RECON_ALGORITHM",
-                          "subject_orientation": "CODED_SUBJECT_ORIENTATION"
-                          }
-        if (token in coded_elements):
-            code_table = {"model:0": "unknown",
-                          "model:2000": "Primate",
-                          "model:2001": "Rodent",
-                          "model:2002": "microPET2",
-                          "model:2500": "Focus_220",
-                          "model:2501": "Focus_120",
-                          "model:3000": "mCAT",
-                          "model:3500": "mCATII",
-                          "model:4000": "mSPECT",
-                          "model:5000": "Inveon_Dedicated_PET",
-                          "model:5001": "Inveon_MM_Platform",
-                          "model:6000": "MR_PET_Head_Insert",
-                          "model:8000": "Tuebingen_PET_MR",
-                          "modality:-1": "Unknown",
-                          "modality:0": "PET",
-                          "modality:1": "CT",
-                          "modality:2": "SPECT",
-                          "modality_configuration:0":    "Unknown",
-
-                          # These are CT values
-                          "modality_configuration:3000": "mCAT",
-                          "modality_configuration:3500": "mCATII",
-                          "modality_configuration:3600": "Inveon_MM_Std_CT",
-                          "modality_configuration:3601": "Inveon_MM_HiRes_Std_CT",
-                          "modality_configuration:3602": "Inveon_MM_Std_LFOV_CT",
-                          "modality_configuration:3603": "Inveon_MM_HiRes_LFOV_CT",
-
-                          # These are PET values
-                          "modality_configuration:2000": "Primate",
-                          "modality_configuration:2001": "Rodent",
-                          "modality_configuration:2002": "microPET2",
-                          "modality_configuration:2500": "Focus_220",
-                          "modality_configuration:2501": "Focus_120",
-                          "modality_configuration:5000": "Inveon_Dedicated_PET",
-                          "modality_configuration:5500": "Inveon_MM_PET",
-
-                          "acquisition_mode:0": "Unknown acquisition mode",
-                          "acquisition_mode:1": "Blank acquisition",
-                          "acquisition_mode:2": "Emission acquisition",
-                          "acquisition_mode:3": "Dynamic acquisition",
-                          "acquisition_mode:4": "Gated acquisition",
-                          "acquisition_mode:5": "Continuous bed motion acquisition",
-                          "acquisition_mode:6": "Singles transmission acquisition",
-                          "acquisition_mode:7": "Windowed coincidence transmission acquisition",
-                          "acquisition_mode:8": "Non-windowed coincidence transmission acquisition",
-                          "acquisition_mode:9": "CT projection acquisition",
-                          "acquisition_mode:10": "CT calibration acquisition",
-                          "acquisition_mode:11": "SPECT planar projection acquisitio",
-                          "acquisition_mode:12": "SPECT multi-projection acquisition",
-                          "acquisition_mode:13": "SPECT calibration acquisition",
-                          "acquisition_mode:14": "SPECT tomography normalization acquisition",
-                          "acquisition_mode:15": "SPECT detector setup acquisition",
-                          "acquisition_mode:16": "SPECT scout view acquisition",
-                          "acquisition_mode:17": "SPECT planar normalization acquisition",
-
-                          "recon_algorithm:0": "Unknown, or no, algorithm type",
-                          "recon_algorithm:1": "Filtered Backprojection",
-                          "recon_algorithm:2": "OSEM2d",
-                          "recon_algorithm:3": "OSEM3d",
-                          "recon_algorithm:4": "3D Reprojection",
-                          "recon_algorithm:5": "Undefined",      # Undefined
-                          "recon_algorithm:6": "OSEM3D/MAP",
-                          "recon_algorithm:7": "MAPTR for transmission image",
-                          "recon_algorithm:8": "MAP 3D reconstruction",
-                          "recon_algorithm:9": "Feldkamp Cone Beam",
-
-                          "subject_orientation:0": "",
-                          "subject_orientation:1": "FFP",
-                          "subject_orientation:2": "HFP",
-                          "subject_orientation:3": "FFS",
-                          "subject_orientation:4": "HFS",
-                          "subject_orientation:5": "FFDR",
-                          "subject_orientation:6": "HFDR",
-                          "subject_orientation:7": "FFDL",
-                          "subject_orientation:8": "HFDL",
-
-
-
-                          }
-
-            local_key = f"{token}:{value}"
-            if (local_key in code_table):
-                mapped_value = code_table[local_key];
-                mapped_key = token + "_mapped";
-                self.metadata[mapped_key] = code_table[local_key]
+        mapped_value = CODE_TABLE.get(f"{token}:{value}")
+        if (mapped_value is not None):
+            self.metadata[token + "_mapped"] = mapped_value
 
 
     def process_multi_token_elements(self, token:str, line:str) -> None:
-        if (token == "scan_time"):
-            self.process_scan_time(line)
-        elif (token == "injection_time"):
-            self.process_injection_time(line)
-        elif (token == "x_filter") :
-            self.process_xyz_filter(line)
-        elif (token == "y_filter"):
-            self.process_xyz_filter(line)
-        elif (token == "z_filter") :
-            self.process_xyz_filter(line)
-        elif (token == "injected_compound"):
-            self.process_injected_compound(line)
+        handler = MULTI_TOKEN_HANDLERS.get(token)
+        if (handler is not None):
+            handler(self, line)
 
     def parse_inveon_date_foramt(self, line:str):
-        month_map = {
-            "Jan": "01",
-            "Feb": "02",
-            "Mar": "03",
-            "Apr": "04",
-            "May": "05",
-            "Jun": "06",
-            "Jul": "07",
-            "Aug": "08",
-            "Sep": "09",
-            "Oct": "10",
-            "Nov": "11",
-            "Dec": "12"}
         tokens = line.split(' ')
         day  = tokens[1]
         mon  = tokens[2]
@@ -269,26 +626,13 @@ class InveonImage:
         time = tokens[4]
         year = tokens[5]
 
-        date_string = year + month_map[mon] + date.zfill(2)
+        date_string = year + MONTH_MAP[mon] + date.zfill(2)
         time_tokens = time.split(':')
         time_string = time_tokens[0] + time_tokens[1] + time_tokens[2]
 
         return date_string, time_string
 
     def process_scan_time(self, line:str) -> None:
-        month_map = {
-            "Jan": "01",
-            "Feb": "02",
-            "Mar": "03",
-            "Apr": "04",
-            "May": "05",
-            "Jun": "06",
-            "Jul": "07",
-            "Aug": "08",
-            "Sep": "09",
-            "Oct": "10",
-            "Nov": "11",
-            "Dec": "12"}
         tokens = line.split(' ')
         day  = tokens[1]
         mon  = tokens[2]
@@ -296,7 +640,7 @@ class InveonImage:
         time = tokens[4]
         year = tokens[5]
 
-        date_string = year + month_map[mon] + date.zfill(2)
+        date_string = year + MONTH_MAP[mon] + date.zfill(2)
         time_tokens = time.split(':')
         time_string = time_tokens[0] + time_tokens[1] + time_tokens[2] + ".000000"
 
@@ -310,39 +654,14 @@ class InveonImage:
         self.metadata["injection_time_time"] = time_string
 
     def process_xyz_filter(self, line:str) -> None:
-        filter_map = {
-            "x_filter:0": "No filter",
-            "x_filter:1": "Ramp filter (backprojection) or no filter",
-            "x_filter:2": "First-order Butterworth window",
-            "x_filter:3": "Hanning window",
-            "x_filter:4": "Hamming window",
-            "x_filter:5": "Parzen window",
-            "x_filter:6": "Shepp filter",
-            "x_filter:7": "Second-order Butterworth window",
-
-            "y_filter:0": "No filter",
-            "y_filter:2": "First-order Butterworth window",
-            "y_filter:3": "Hanning window",
-            "y_filter:4": "Hamming window",
-            "y_filter:5": "Parzen window",
-            "y_filter:7": "Second-order Butterworth window",
-
-            "z_filter:0": "No filter",
-            "z_filter:2": "First-order Butterworth window",
-            "z_filter:3": "Hanning window",
-            "z_filter:4": "Hamming window",
-            "z_filter:5": "Parzen window",
-            "z_filter:7": "Second-order Butterworth window",
-        }
-
         tokens       = line.split(' ')
         keyword      = tokens[0]
         filter_index = tokens[1]
         cutoff_value = tokens[2]
 
         local_key = keyword + ":" + filter_index
-        if (local_key in filter_map):
-            filter_name = filter_map[local_key]
+        if (local_key in FILTER_MAP):
+            filter_name = FILTER_MAP[local_key]
             new_filter_comments = tokens[0] + ", " + filter_name + " cutoff, " + cutoff_value
 
             image_comments = self.metadata["ImageComments"]
@@ -359,3 +678,14 @@ class InveonImage:
         compound = separator.join(tokens[1:])
 
         self.metadata["injected_compound"] = compound
+
+
+# Handlers for header elements with more than one value
+MULTI_TOKEN_HANDLERS = {
+    "scan_time":         InveonImage.process_scan_time,
+    "injection_time":    InveonImage.process_injection_time,
+    "x_filter":          InveonImage.process_xyz_filter,
+    "y_filter":          InveonImage.process_xyz_filter,
+    "z_filter":          InveonImage.process_xyz_filter,
+    "injected_compound": InveonImage.process_injected_compound,
+}
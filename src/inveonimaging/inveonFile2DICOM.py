@@ -1,32 +1,66 @@
 import subprocess
+import sys
 import argparse
 from inveonimaging.inveon import InveonImage
 from inveonimaging.factory import Factory
+from inveonimaging.sinks import FolderSink, is_archive_output, open_output_sink
 
 # Arguments:
 #              Input Inveon .img file (with an appropriate .hdr file)
-#              Output folder for DICOM files
+#              Output folder for DICOM files, or a tar/zip archive (- for a tar on stdout)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Inveon native .img/.hdr file to DICOM original")
     parser.add_argument("InveonImage",  help="Path to Inveon .img file")
-    parser.add_argument("OutputFolder", help="Path to output folder for DICOM files")
+    parser.add_argument("OutputFolder", help="Path to output folder for DICOM files, or a .tar, .tar.gz, .tgz or .zip archive to write them to (- for a tar on stdout)")
     parser.add_argument('-f', '--file', help="Name of output file for multiframe output")
     parser.add_argument('-l', '--legacyconverted', action='store_true')
     parser.add_argument('-m', '--multiframe',      action='store_true')
+    parser.add_argument(      '--json',            action='store_true', dest='json_output', help="Write single frame series as DICOM JSON metadata (metadata.json) with raw pixel bulk data files")
+    parser.add_argument(      '--frames',           dest='time_frames',       help="Convert only these time frames, e.g. 10-20 or 0,3,5-7 (numbered from 0)")
+    parser.add_argument(      '--slices',           dest='slices',            help="Convert only these slices, e.g. 40-80 (numbered from 0)")
+    parser.add_argument(      '--readahead',        dest='read_ahead',        type=int, default=0, help="Read this many slices (or PET time frames) ahead on a background thread")
+    parser.add_argument(      '--uidnamespace',     dest='uid_namespace',     help="Derive UIDs from the source files and this namespace (a UUID or any string) instead of making random ones, so reruns give the same UIDs")
+    parser.add_argument(      '--transfersyntax',   dest='transfer_syntax',   choices=['explicit', 'deflate', 'rle'], default='explicit', help="Write Explicit VR Little Endian (default), Deflated Explicit VR Little Endian or RLE Lossless files")
+    parser.add_argument(      '--deflatelevel',     dest='deflate_level',     type=int, default=6, help="zlib compression level of deflated files, 0 (fastest) to 9 (smallest) (default: 6)")
+    parser.add_argument('-j', '--jobs',             dest='jobs',              type=int, help="Number of workers encoding RLE frames or deflating files (default: one per CPU)")
     args = parser.parse_args()
 
     inveon_image = InveonImage("unknown", args.InveonImage).parse_header()
+    if (is_archive_output(args.OutputFolder)):
+        output_sink = open_output_sink(args.OutputFolder)
+    else:
+        output_sink = FolderSink(args.OutputFolder)
+    # The archive goes to stdout, so progress messages go to stderr
+    if (args.OutputFolder == "-"):
+        sys.stdout = sys.stderr
+
     factory = Factory()
+    factory.set_output_sink(output_sink)
+    factory.set_read_ahead(args.read_ahead)
+    factory.set_transfer_syntax(args.transfer_syntax)
+    factory.set_jobs(args.jobs)
+    factory.set_deflate_level(args.deflate_level)
+    if (args.json_output):
+        if (args.multiframe or args.legacyconverted):
+            raise Exception("--json writes single frame series; it cannot be combined with -m or -l")
+        factory.set_json_output(True)
+    if (args.uid_namespace is not None):
+        factory.set_uid_namespace(args.uid_namespace)
 
     if (args.multiframe) :
         print("Multiframe")
-        factory.convert_to_multiframe(inveon_image, args.OutputFolder, args.file)
+        factory.convert_to_multiframe(inveon_image, output_sink.get_root(), args.file, args.time_frames, args.slices)
 
     elif (args.legacyconverted):
         print ("Legacy Converted")
-        factory.convert_to_legacy_converted_multiframe(inveon_image, args.OutputFolder, args.file)
+        factory.convert_to_legacy_converted_multiframe(inveon_image, output_sink.get_root(), args.file,
+                                                       args.time_frames, args.slices)
     else:
         print ("Standard SOP classes, single frame")
-        factory.convert_to_standard_images(inveon_image, args.OutputFolder)
+        factory.convert_to_standard_images(inveon_image, {}, output_sink.get_root(), args.time_frames, args.slices)
+
+    output_sink.close()
+    if (args.transfer_syntax == "deflate"):
+        print(factory.get_compression_report())
@@ -1,45 +1,38 @@
 import os
+import sys
 import argparse
 #import inveon
 #import factory
 
-from inveonimaging.inveon import InveonImage
+from inveonimaging.inveon import InveonImage, pair_img_files
+from inveonimaging.archive import is_archive, open_archive
 from inveonimaging.factory import Factory
+from inveonimaging.sinks import FolderSink, is_archive_output, open_output_sink
 
 
+# .img files may be compressed (foo.img.gz, foo.img.xz, foo.img.bz2); the header is
+# always the plain foo.img.hdr
 def find_img_files(input_folder: str, ignore_all_extra_files: bool, ignore_specific_extra_files: list):
-    rtn = []
+    paths = []
     for f in os.listdir(input_folder):
         full_path = os.path.join(input_folder, f)
         if os.path.isfile(full_path):
-            filename, file_extension = os.path.splitext(full_path)
-            if (file_extension == ".img"):
-                rtn.append(full_path)
-                expected_hdr_file = f"{full_path}.hdr"
-                if not os.path.isfile(expected_hdr_file):
-                    raise Exception(f"We found this .img file {full_path} with no corresponding .hdr file")
-
-            elif (file_extension == ".hdr"):
-                expected_img_file = filename
-                if not os.path.isfile(expected_img_file):
-                    raise Exception(f"We found this .hdr file {full_path} with no corresponding .img file")
-
-            else:
-                raiseException = True
-                ignore_specific_extra_files_msg = ""
-                if (ignore_specific_extra_files):
-                    ignore_specific_extra_files_msg = ", ".join(ignore_specific_extra_files)
-                    if file_extension in ignore_specific_extra_files:
-                        raiseException = False
-                if ignore_all_extra_files:
-                    raiseException = False
-                if (raiseException):                
-                    raise Exception(
-                        f"File {full_path} found with file extension {file_extension}. This program expects only {ignore_specific_extra_files_msg} .img and .hdr  files in the folder")
+            paths.append(full_path)
         else:
             raise Exception(f"This program does not support nested folders {full_path}")
 
-    return rtn
+    return pair_img_files(paths, os.path.isfile, ignore_all_extra_files, ignore_specific_extra_files)
+
+# Parsed images from a folder, or from a zip/tar archive ("-" for a tar on stdin)
+def iterate_images(input_path: str, study_description: str, ignore_all_extra_files: bool,
+                   ignore_specific_extra_files: list):
+    if (is_archive(input_path)):
+        yield from open_archive(input_path).iterate_images(study_description, ignore_all_extra_files,
+                                                           ignore_specific_extra_files)
+        return
+
+    for f in find_img_files(input_path, ignore_all_extra_files, ignore_specific_extra_files):
+        yield InveonImage(study_description, f).parse_header()
 
 def construct_overrides(my_parser:argparse.Namespace) -> {}:
     overrides = {}
@@ -52,19 +45,20 @@ def construct_overrides(my_parser:argparse.Namespace) -> {}:
 
 # Arguments:
 #              Input Inveon .img file (with an appropriate .hdr file)
-#              Output folder for DICOM files
+#              Output folder for DICOM files, or a tar/zip archive (- for a tar on stdout)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Inveon native .img/.hdr file to DICOM original")
-    parser.add_argument("InveonFolder",                                      help="Path to Inveon .hdr/.img file(s)")
-    parser.add_argument("OutputFolder",                                      help="Path to output folder for DICOM files")
+    parser.add_argument("InveonFolder",                                      help="Path to Inveon .hdr/.img file(s), or a zip/tar archive of them (- for a tar on stdin)")
+    parser.add_argument("OutputFolder",                                      help="Path to output folder for DICOM files, or a .tar, .tar.gz, .tgz or .zip archive to write them to (- for a tar on stdout)")
     parser.add_argument('-C', '--codetable',        dest='code_table',       help="JSON file with code table")
     parser.add_argument('-c', '--ct',               dest='ct_prefix',        help="Prefix for a CT file")
     parser.add_argument('-p', '--pet',              dest='pet_prefix',       help="Prefix for a PET file")
     parser.add_argument('-f', '--file',                                      help="Name of output file for multiframe output")
     parser.add_argument('-l', '--legacyconverted', action='store_true')
     parser.add_argument('-m', '--multiframe',      action='store_true')
+    parser.add_argument(      '--json',            action='store_true', dest='json_output', help="Write single frame series as DICOM JSON metadata (metadata.json) with raw pixel bulk data files")
     parser.add_argument('-s', '--studydescription', dest='study_description', help="Set DICOM StudyDescription")
     parser.add_argument(      '--patientname',      dest='patient_name',      help="Set DICOM PatientName")
     parser.add_argument(      '--patientid',        dest='patient_id',        help="Set DICOM PatientID")
@@ -72,15 +66,40 @@ if __name__ == '__main__':
     parser.add_argument(      '--patientsex',       dest='patient_sex',       help="Set DICOM PatientSex")
     parser.add_argument(      '--ignoreAllExtraFiles', action='store_true', dest='ignore_all_extra_files',       help="Ignore presence of all files with extension other than .img and .hdr")
     parser.add_argument(      '--ignoreFileWithExt',  action='append', dest='ignore_specific_extra_files',       help="Ignore presence of files with specific extension other than .img and .hdr")
+    parser.add_argument(      '--frames',           dest='time_frames',       help="Convert only these time frames, e.g. 10-20 or 0,3,5-7 (numbered from 0)")
+    parser.add_argument(      '--slices',           dest='slices',            help="Convert only these slices, e.g. 40-80 (numbered from 0)")
+    parser.add_argument(      '--readahead',        dest='read_ahead',        type=int, default=0, help="Read this many slices (or PET time frames) ahead on a background thread")
+    parser.add_argument(      '--uidnamespace',     dest='uid_namespace',     help="Derive UIDs from the source files and this namespace (a UUID or any string) instead of making random ones, so reruns give the same UIDs")
+    parser.add_argument(      '--transfersyntax',   dest='transfer_syntax',   choices=['explicit', 'deflate', 'rle'], default='explicit', help="Write Explicit VR Little Endian (default), Deflated Explicit VR Little Endian or RLE Lossless files")
+    parser.add_argument(      '--deflatelevel',     dest='deflate_level',     type=int, default=6, help="zlib compression level of deflated files, 0 (fastest) to 9 (smallest) (default: 6)")
+    parser.add_argument('-j', '--jobs',             dest='jobs',              type=int, help="Number of workers encoding RLE frames or deflating files (default: one per CPU)")
 
     args = parser.parse_args()
     overrides = construct_overrides(args)
 
+    if (is_archive_output(args.OutputFolder)):
+        output_sink = open_output_sink(args.OutputFolder)
+    else:
+        output_sink = FolderSink(args.OutputFolder)
+    # The archive goes to stdout, so progress messages go to stderr
+    if (args.OutputFolder == "-"):
+        sys.stdout = sys.stderr
+
     factory = Factory()
+    factory.set_output_sink(output_sink)
+    factory.set_read_ahead(args.read_ahead)
+    factory.set_transfer_syntax(args.transfer_syntax)
+    factory.set_jobs(args.jobs)
+    factory.set_deflate_level(args.deflate_level)
+    if (args.json_output):
+        if (args.multiframe or args.legacyconverted):
+            raise Exception("--json writes single frame series; it cannot be combined with -m or -l")
+        factory.set_json_output(True)
+    if (args.uid_namespace is not None):
+        factory.set_uid_namespace(args.uid_namespace)
     if (args.code_table is not None):
         factory.import_code_table_file(args.code_table)
 
-    factory.generate_study_instance_uid()
     factory.add_file_prefix("CT",  args.ct_prefix)
     factory.add_file_prefix("PT",  args.pet_prefix)
 
@@ -89,25 +108,40 @@ if __name__ == '__main__':
     if (args.study_description is not None):
         study_description = args.study_description
 
-    img_files = find_img_files(args.InveonFolder, args.ignore_all_extra_files, args.ignore_specific_extra_files)
-    for f in img_files:
+    images = iterate_images(args.InveonFolder, study_description,
+                            args.ignore_all_extra_files, args.ignore_specific_extra_files)
+    # The study is named by all of its images, whose headers are parsed before any is
+    # converted. A tar stream on stdin can only be read once, so there the first image names it.
+    if (args.InveonFolder != "-"):
+        images = list(images)
+        factory.generate_study_instance_uid([inveon_image.get_source_identity() for inveon_image in images])
+    for inveon_image in images:
+        if (not factory.has_study_instance_uid()):
+            factory.generate_study_instance_uid([inveon_image.get_source_identity()])
         series_number = factory.get_series_number()
+        f = inveon_image.get_base_path()
 
-        inveon_image: InveonImage = InveonImage(study_description, f).parse_header()
-        output_folder: str = os.path.join(args.OutputFolder, str(series_number), "DICOM")
+        output_folder: str = os.path.join(output_sink.get_root(), str(series_number), "DICOM")
+        # A time frame selection only applies to dynamic images; static images (CT) are converted whole
+        time_frames = args.time_frames if inveon_image.get_pixel_frame_count() > 1 else None
         if (args.multiframe) :
             print(f"Multiframe {f} {output_folder}")
-            factory.convert_to_multiframe(inveon_image, output_folder, args.file)
+            factory.convert_to_multiframe(inveon_image, output_folder, args.file, time_frames, args.slices)
         
         elif (args.legacyconverted):
             print (f"Legacy Converted {f} {output_folder}")
-            factory.convert_to_legacy_converted_multiframe(inveon_image, output_folder, args.file)
+            factory.convert_to_legacy_converted_multiframe(inveon_image, output_folder, args.file,
+                                                           time_frames, args.slices)
         else:
             print (f"Standard SOP classes, single frame {f} {output_folder}")
-            factory.convert_to_standard_images(inveon_image, overrides, output_folder)
+            factory.convert_to_standard_images(inveon_image, overrides, output_folder, time_frames, args.slices)
         
         factory.increment_series_number()
 
+    output_sink.close()
+    if (args.transfer_syntax == "deflate"):
+        print(factory.get_compression_report())
+
 #    if (args.multiframe) :
 #        print("Multiframe")
 #        factory.convert_to_multiframe(inveon_image, args.OutputFolder, args.file)
@@ -0,0 +1,194 @@
+import os
+import argparse
+import datetime
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from inveonimaging.inveon import InveonImage, PIXEL_FILE_OPENERS
+
+
+# Header-only inventory of a tree of Inveon files, kept in a SQLite catalog.
+# Only .hdr files are parsed; each .img is checked with os.stat against the size the
+# header describes, so no pixel file is opened. Later runs re-read only the headers
+# whose .hdr or .img mtime or size changed, and drop entries whose files are gone.
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hdr_path             TEXT PRIMARY KEY,
+    img_path             TEXT,
+    hdr_mtime            REAL,
+    hdr_size             INTEGER,
+    img_mtime            REAL,
+    img_size             INTEGER,
+    modality             TEXT,
+    isotope              TEXT,
+    scan_time            TEXT,
+    data_type            INTEGER,
+    x_dimension          INTEGER,
+    y_dimension          INTEGER,
+    z_dimension          INTEGER,
+    frame_count          INTEGER,
+    expected_img_size    INTEGER,
+    expected_output_size INTEGER,
+    valid                INTEGER,
+    message              TEXT,
+    indexed_at           TEXT
+)
+"""
+
+CATALOG_COLUMNS = ["hdr_path", "img_path", "hdr_mtime", "hdr_size", "img_mtime", "img_size",
+                   "modality", "isotope", "scan_time", "data_type", "x_dimension", "y_dimension",
+                   "z_dimension", "frame_count", "expected_img_size", "expected_output_size",
+                   "valid", "message", "indexed_at"]
+
+
+# The .img file (plain or compressed) next to an .hdr file, or None if there is not exactly one
+def find_img_for_hdr(hdr_path: str):
+    img_path = hdr_path[:-len(".hdr")]
+    candidates = [img_path] + [f"{img_path}{extension}" for extension in PIXEL_FILE_OPENERS]
+    found = [candidate for candidate in candidates if os.path.isfile(candidate)]
+    if (len(found) == 1):
+        return found[0]
+    return None
+
+
+def find_hdr_files(input_folder: str) -> list:
+    rtn = []
+    for folder, sub_folders, files in os.walk(input_folder):
+        sub_folders.sort()
+        for f in sorted(files):
+            if (f.endswith(".img.hdr")):
+                rtn.append(os.path.join(folder, f))
+    return rtn
+
+
+# (mtime, size) of a file, (None, None) when it does not exist
+def stat_file(path):
+    if (path is None):
+        return None, None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_mtime, st.st_size
+
+
+# One catalog row for an .hdr file. Runs in a worker process.
+def index_header(hdr_path: str) -> dict:
+    img_path = find_img_for_hdr(hdr_path)
+    hdr_mtime, hdr_size = stat_file(hdr_path)
+    img_mtime, img_size = stat_file(img_path)
+    row = {"hdr_path": hdr_path, "img_path": img_path,
+           "hdr_mtime": hdr_mtime, "hdr_size": hdr_size, "img_mtime": img_mtime, "img_size": img_size,
+           "valid": 0, "message": None,
+           "indexed_at": datetime.datetime.now().isoformat(timespec="seconds")}
+
+    try:
+        inveon_image = InveonImage("index", img_path or hdr_path[:-len(".hdr")]).parse_header()
+        header = inveon_image.get_header()
+        row["modality"]    = inveon_image.get_metadata_element("modality_mapped")
+        row["isotope"]     = inveon_image.get_metadata_element("isotope")
+        row["scan_time"]   = header.scan_time.isoformat() if (header.scan_time is not None) else None
+        row["data_type"]   = header.data_type
+        row["x_dimension"] = header.x_dimension
+        row["y_dimension"] = header.y_dimension
+        row["z_dimension"] = header.z_dimension
+        row["frame_count"] = inveon_image.get_pixel_frame_count()
+
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        pixel_count = frame_count * z_dimension * rows * columns
+        row["expected_img_size"]    = pixel_count * inveon_image.get_pixel_dtype().itemsize
+        # Pixel data are written as 16 bit integers; DICOM headers are not counted
+        row["expected_output_size"] = pixel_count * 2
+    except Exception as e:
+        row["message"] = f"Cannot parse header: {e}"
+        return row
+
+    if (img_path is None):
+        row["message"] = "No corresponding .img file, or more than one"
+    elif (inveon_image.is_compressed()):
+        row["valid"] = 1
+        row["message"] = "Compressed .img; size not checked"
+    elif (img_size < row["expected_img_size"]):
+        row["message"] = f".img has {img_size} bytes, header describes {row['expected_img_size']} bytes"
+    else:
+        row["valid"] = 1
+        if (img_size > row["expected_img_size"]):
+            row["message"] = f".img has {img_size} bytes, header describes {row['expected_img_size']} bytes"
+    return row
+
+
+def open_catalog(catalog_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(catalog_path)
+    connection.execute(CATALOG_SCHEMA)
+    return connection
+
+
+# Headers whose .hdr and .img are unchanged since they were indexed
+def find_unchanged(connection: sqlite3.Connection, hdr_files: list) -> set:
+    stored = {}
+    for hdr_path, img_path, hdr_mtime, hdr_size, img_mtime, img_size in connection.execute(
+            "SELECT hdr_path, img_path, hdr_mtime, hdr_size, img_mtime, img_size FROM images"):
+        stored[hdr_path] = (img_path, hdr_mtime, hdr_size, img_mtime, img_size)
+
+    rtn = set()
+    for hdr_path in hdr_files:
+        if (hdr_path not in stored):
+            continue
+        img_path, hdr_mtime, hdr_size, img_mtime, img_size = stored[hdr_path]
+        if (find_img_for_hdr(hdr_path) != img_path):
+            continue
+        if (stat_file(hdr_path) == (hdr_mtime, hdr_size) and stat_file(img_path) == (img_mtime, img_size)):
+            rtn.add(hdr_path)
+    return rtn
+
+
+# Index every .img.hdr under input_folder into the catalog. jobs worker processes
+# parse the headers; with jobs 1 everything runs in this process.
+# Returns (headers read, headers unchanged, entries removed, invalid entries)
+def index_folder(input_folder: str, catalog_path: str, jobs: int = None, full: bool = False) -> tuple:
+    hdr_files = find_hdr_files(input_folder)
+    connection = open_catalog(catalog_path)
+    with connection:
+        unchanged = set() if full else find_unchanged(connection, hdr_files)
+        to_read = [hdr_path for hdr_path in hdr_files if hdr_path not in unchanged]
+
+        if (jobs == 1 or len(to_read) < 2):
+            rows = [index_header(hdr_path) for hdr_path in to_read]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                rows = list(executor.map(index_header, to_read, chunksize=64))
+
+        placeholders = ", ".join("?" for column in CATALOG_COLUMNS)
+        connection.executemany(
+            f"INSERT OR REPLACE INTO images ({', '.join(CATALOG_COLUMNS)}) VALUES ({placeholders})",
+            [[row.get(column) for column in CATALOG_COLUMNS] for row in rows])
+
+        # Drop entries under this folder whose .hdr file is gone
+        prefix = os.path.join(input_folder, "")
+        present = set(hdr_files)
+        removed = [(hdr_path,) for (hdr_path,) in connection.execute("SELECT hdr_path FROM images")
+                   if hdr_path.startswith(prefix) and hdr_path not in present]
+        connection.executemany("DELETE FROM images WHERE hdr_path = ?", removed)
+
+        invalid = connection.execute("SELECT COUNT(*) FROM images WHERE valid = 0").fetchone()[0]
+    connection.close()
+    return len(to_read), len(unchanged), len(removed), invalid
+
+
+# Arguments:
+#              Folder to scan for Inveon .img/.hdr files (searched recursively)
+#              SQLite catalog file, created if it does not exist
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Index Inveon .hdr files into a SQLite catalog without reading pixel data")
+    parser.add_argument("InveonFolder",                                help="Folder to scan, recursively, for Inveon .img/.hdr files")
+    parser.add_argument("Catalog",                                     help="Path to the SQLite catalog file")
+    parser.add_argument('-j', '--jobs',    dest='jobs',   type=int,   help="Number of worker processes parsing headers (default: one per CPU)")
+    parser.add_argument(      '--full',    action='store_true',        help="Re-read every header, even if unchanged")
+    args = parser.parse_args()
+
+    read, unchanged, removed, invalid = index_folder(os.path.abspath(args.InveonFolder), args.Catalog,
+                                                     args.jobs, args.full)
+    print(f"Read {read} headers, {unchanged} unchanged, {removed} removed; {invalid} invalid entries in {args.Catalog}")
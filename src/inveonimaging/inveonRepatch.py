@@ -0,0 +1,174 @@
+import io
+import os
+import json
+import shutil
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset, read_file_meta_info
+from pydicom.filewriter import write_dataset
+
+from inveonimaging.deflate import DeflateStream, DEFAULT_DEFLATE_LEVEL
+from inveonimaging.dicomjson import METADATA_FILE_NAME
+
+
+# Rewrites the patient and study elements of files that were already converted, instead
+# of converting again. Only the start of each file is parsed: the elements up to the end
+# of the Patient group (0010,xxxx), where all the patched elements sit. They are encoded
+# again with the new values and everything after them - the image elements, functional
+# groups and the pixel data, native or encapsulated - is copied as a raw byte range,
+# never decoded. A deflated file has to be inflated and deflated again, but its pixels
+# are still not decoded. The metadata.json of DICOM JSON output is patched too.
+#
+# Files are rewritten through a temporary file next to them that replaces the original,
+# on jobs worker processes.
+
+# Option name (as in inveonFolder2DICOM) and the element it sets
+REPATCH_KEYWORDS = {"patient_name":      "PatientName",
+                    "patient_id":        "PatientID",
+                    "patient_birthdate": "PatientBirthDate",
+                    "patient_sex":       "PatientSex",
+                    "study_description": "StudyDescription"}
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+TEMPORARY_SUFFIX = ".repatch"
+
+
+# The elements to set, from the options given; options left out are not changed
+def construct_values(options: dict) -> dict:
+    values = {REPATCH_KEYWORDS[name]: value for name, value in options.items()
+              if (name in REPATCH_KEYWORDS and value is not None)}
+    if (len(values) == 0):
+        raise Exception("Nothing to re-patch; give at least one of --patientname, --patientid, --patientdob, --patientsex, --studydescription")
+    return values
+
+
+def is_part10_file(path: str) -> bool:
+    with open(path, "rb") as fh:
+        fh.seek(128)
+        return fh.read(4) == b"DICM"
+
+
+# Part 10 files and DICOM JSON metadata under folder, in a stable order
+def find_repatch_files(folder: str) -> list:
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            if (f.endswith(TEMPORARY_SUFFIX)):
+                continue
+            if (f == METADATA_FILE_NAME or is_part10_file(path)):
+                paths.append(path)
+    return paths
+
+
+# Stops reading at the first element after the Patient group
+def after_patient_group(tag, vr, length) -> bool:
+    return tag.group > 0x0010
+
+
+# Re-patches one file; returns the number of bytes copied unchanged after the patched elements
+def repatch_file(path: str, values: dict, deflate_level: int = DEFAULT_DEFLATE_LEVEL) -> int:
+    if (os.path.basename(path) == METADATA_FILE_NAME):
+        repatch_json_file(path, values)
+        return 0
+
+    file_meta = read_file_meta_info(path)
+    if ("FileMetaInformationGroupLength" not in file_meta):
+        raise Exception(f"{path} has no FileMetaInformationGroupLength")
+    header_length   = 128 + 4 + 12 + file_meta.FileMetaInformationGroupLength
+    transfer_syntax = file_meta.TransferSyntaxUID
+    if (transfer_syntax.is_implicit_VR or not transfer_syntax.is_little_endian):
+        raise Exception(f"{path} is {transfer_syntax.name}; only explicit VR little endian files can be re-patched")
+    deflated = transfer_syntax == pydicom.uid.DeflatedExplicitVRLittleEndian
+
+    temporary_path = path + TEMPORARY_SUFFIX
+    with open(path, "rb") as fh:
+        header = fh.read(header_length)
+        body = fh
+        if (deflated):
+            body = io.BytesIO(zlib.decompress(fh.read(), -zlib.MAX_WBITS))
+        head = read_dataset(body, False, True, stop_when=after_patient_group)
+        for keyword, value in values.items():
+            setattr(head, keyword, value)
+
+        buffer = DicomBytesIO()
+        buffer.is_little_endian = True
+        buffer.is_implicit_VR   = False
+        write_dataset(buffer, head)
+
+        start = body.tell()
+        with open(temporary_path, "wb") as out:
+            out.write(header)
+            if (deflated):
+                stream = DeflateStream(out, deflate_level)
+                stream.write(buffer.getvalue())
+                stream.write(body.getbuffer()[start:])
+                stream.finish()
+                body.seek(0, io.SEEK_END)
+            else:
+                out.write(buffer.getvalue())
+                shutil.copyfileobj(body, out, COPY_BUFFER_SIZE)
+            copied = body.tell() - start
+    os.replace(temporary_path, path)
+    return copied
+
+
+# Sets the elements in every instance of a DICOM JSON metadata file
+def repatch_json_file(path: str, values: dict) -> None:
+    elements = Dataset()
+    for keyword, value in values.items():
+        setattr(elements, keyword, value)
+    fields = {f"{element.tag:08X}": element.to_json_dict(None, 0) for element in elements}
+
+    with open(path, encoding="utf-8") as fh:
+        instances = json.load(fh)
+    for instance in instances:
+        instance.update(fields)
+        for tag in sorted(instance):
+            instance[tag] = instance.pop(tag)
+
+    temporary_path = path + TEMPORARY_SUFFIX
+    with open(temporary_path, "w", encoding="utf-8") as fh:
+        fh.write("[" + ",\n".join(json.dumps(instance) for instance in instances) + "]\n")
+    os.replace(temporary_path, path)
+
+
+# Re-patches every converted file under folder. jobs worker processes rewrite the files;
+# with jobs 1 everything runs in this process.
+# Returns (files re-patched, bytes copied unchanged)
+def repatch_folder(folder: str, values: dict, jobs: int = None,
+                   deflate_level: int = DEFAULT_DEFLATE_LEVEL) -> tuple:
+    paths = find_repatch_files(folder)
+    if (jobs == 1 or len(paths) < 2):
+        copied = [repatch_file(path, values, deflate_level) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            copied = list(executor.map(repatch_file, paths, [values] * len(paths), [deflate_level] * len(paths),
+                                       chunksize=16))
+    return len(paths), sum(copied)
+
+
+# Arguments:
+#              Folder holding converted output (searched recursively)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Rewrite the patient and study elements of converted DICOM files in place, copying the pixel data unchanged")
+    parser.add_argument("ConvertedFolder",                                   help="Folder of converted DICOM (or DICOM JSON) output, searched recursively")
+    parser.add_argument('-s', '--studydescription', dest='study_description', help="Set DICOM StudyDescription")
+    parser.add_argument(      '--patientname',      dest='patient_name',      help="Set DICOM PatientName")
+    parser.add_argument(      '--patientid',        dest='patient_id',        help="Set DICOM PatientID")
+    parser.add_argument(      '--patientdob',       dest='patient_birthdate', help="Set DICOM PatientBirthDate")
+    parser.add_argument(      '--patientsex',       dest='patient_sex',       help="Set DICOM PatientSex")
+    parser.add_argument(      '--deflatelevel',     dest='deflate_level',     type=int, default=DEFAULT_DEFLATE_LEVEL, help="zlib compression level for re-deflating deflated files (default: 6)")
+    parser.add_argument('-j', '--jobs',             dest='jobs',              type=int, help="Number of worker processes rewriting files (default: one per CPU)")
+    args = parser.parse_args()
+
+    values = construct_values(vars(args))
+    count, copied = repatch_folder(args.ConvertedFolder, values, args.jobs, args.deflate_level)
+    print(f"Re-patched {count} files in {args.ConvertedFolder}, copied {copied / 1e6:.1f} MB unchanged")
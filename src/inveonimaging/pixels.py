@@ -0,0 +1,339 @@
+import os
+import queue
+import threading
+import numpy
+
+from inveonimaging.inveon import InveonImage
+
+
+# A fixed ring of preallocated arrays of one shape and dtype. Buffers are handed out
+# in rotation, so a buffer is reused count requests after it was handed out; callers
+# choose count so that no buffer is still in use by then.
+class BufferPool:
+    def __init__(
+            self,
+            shape: tuple,
+            dtype,
+            count: int = 1):
+        self.buffers = [numpy.empty(shape, dtype) for index in range(max(1, count))]
+        self.index   = 0
+
+    def next_buffer(self) -> numpy.ndarray:
+        buffer = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+        return buffer
+
+    def matches(self, shape: tuple, dtype) -> bool:
+        return self.buffers[0].shape == tuple(shape) and self.buffers[0].dtype == numpy.dtype(dtype)
+
+
+# Converts float (or 4 byte integer) pixel data to signed 16 bit integers one time frame at a time.
+# The whole (z, y, x) frame is read in one bulk operation, scaled, rounded and
+# clipped in place, and slices are handed out as views on the cached frame.
+#
+# The float work frame and the int16 output frames are allocated once, from the header
+# dimensions, and every step writes into them with out=. buffer_count output frames are
+# used in rotation for callers that keep slices of earlier frames (see PixelDataStream).
+class FrameNormalizer:
+    def __init__(
+            self,
+            inveon_image: InveonImage,
+            buffer_count: int = 1):
+        self.inveon_image = inveon_image
+        self.time_index   = None
+        self.frame        = None
+
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        self.work_frame   = numpy.empty((z_dimension, rows, columns), numpy.float32)
+        self.output_pool  = BufferPool((z_dimension, rows, columns), "<i2", buffer_count)
+
+    def has_frame(self, time_index: int) -> bool:
+        return self.time_index == time_index
+
+    # frame_pixels may be passed in when the raw frame has already been read (see ReadAhead)
+    def load_frame(self, time_index: int, pixel_scale: float, frame_pixels=None) -> numpy.ndarray:
+        if (frame_pixels is None):
+            frame_pixels = self.inveon_image.get_frame_pixels(time_index)
+        self.frame      = self.output_pool.next_buffer()
+        self.time_index = time_index
+
+        # Integer pixels that fit the int16 range are cast as they are
+        if (pixel_scale == 1 and frame_pixels.dtype.kind == "i"):
+            numpy.copyto(self.frame, frame_pixels, casting="unsafe")
+            return self.frame
+
+        buffer = self.work_frame
+        numpy.copyto(buffer, frame_pixels, casting="unsafe")
+
+        numpy.multiply(buffer, pixel_scale, out=buffer)
+        numpy.rint(buffer, out=buffer)
+        numpy.clip(buffer, -32768, 32767, out=buffer)
+        numpy.copyto(self.frame, buffer, casting="unsafe")
+        return self.frame
+
+    def get_frame(self) -> numpy.ndarray:
+        return self.frame
+
+    # slice_index numbers from 0
+    def get_slice(self, slice_index: int) -> numpy.ndarray:
+        return self.frame[slice_index]
+
+
+# Size of the reads used when streaming pixel data from the .img file
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+# Streams the selected time frames and slices of an image as little endian int16
+# bytes, in (time, z) order, for writing the PixelData element of a multiframe
+# object. Integer data are copied from the .img file in fixed-size chunks through
+# one reusable buffer; float and 4 byte integer data are normalized one time frame
+# at a time. Memory use is bounded by the chunk size (or one time frame) whatever
+# the size of the volume.
+#
+# Compressed .img files and archive members are decoded as they are read; the
+# selection is visited in file order so the stream only ever seeks forward.
+#
+# Each chunk is only valid until the next one is requested.
+class PixelDataStream:
+    def __init__(
+            self,
+            inveon_image: InveonImage,
+            time_frames: list,
+            slices: list,
+            pixel_scale_for_frame=None,
+            chunk_size: int = CHUNK_SIZE,
+            read_ahead_depth: int = 0):
+        self.inveon_image          = inveon_image
+        self.time_frames           = list(time_frames)
+        self.slices                = list(slices)
+        self.pixel_scale_for_frame = pixel_scale_for_frame
+        self.chunk_size            = chunk_size
+        self.read_ahead_depth      = read_ahead_depth
+
+        frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+        self.z_dimension  = z_dimension
+        self.slice_pixels = rows * columns
+        self.dtype        = inveon_image.get_pixel_dtype()
+
+    # Length of the PixelData value in bytes
+    def get_length(self) -> int:
+        return len(self.time_frames) * len(self.slices) * self.slice_pixels * 2
+
+    def get_frame_count(self) -> int:
+        return len(self.time_frames) * len(self.slices)
+
+    def __iter__(self):
+        if (self.dtype.kind == "f" or self.dtype.itemsize == 4):
+            chunks = self.iterate_normalized_frames()
+        else:
+            chunks = self.iterate_integer_chunks()
+
+        if (self.read_ahead_depth > 0):
+            return iter(ReadAhead(chunks, self.read_ahead_depth))
+        return chunks
+
+    # The same bytes regrouped into one bytes object per frame (slice), for encoders
+    # that work a frame at a time. Unlike the chunks, the frames stay valid.
+    def iterate_frames(self):
+        frame_bytes = self.slice_pixels * 2
+        pending = bytearray()
+        for chunk in self:
+            pending += chunk
+            while (len(pending) >= frame_bytes):
+                yield bytes(pending[:frame_bytes])
+                del pending[:frame_bytes]
+        if (len(pending) > 0):
+            raise Exception(f"Pixel data of {self.inveon_image.get_base_path()} end within a frame")
+
+    # Runs of consecutive slices as (first slice, slice count), so contiguous
+    # parts of the file are read with as few calls as possible.
+    def get_slice_runs(self) -> list:
+        runs = []
+        for slice_index in self.slices:
+            if (runs and runs[-1][0] + runs[-1][1] == slice_index):
+                runs[-1][1] += 1
+            else:
+                runs.append([slice_index, 1])
+        return runs
+
+    def iterate_integer_chunks(self):
+        itemsize     = self.dtype.itemsize
+        slice_bytes  = self.slice_pixels * itemsize
+        chunk_pixels = max(1, self.chunk_size // itemsize)
+
+        # With read-ahead the chunks are produced on another thread. The consumer holds one
+        # chunk and the queue holds read_ahead_depth more, so the buffers are used in rotation.
+        buffers      = [bytearray(chunk_pixels * itemsize) for index in range(self.read_ahead_depth + 2)]
+        buffer_index = 0
+        converted    = BufferPool((chunk_pixels,), "<i2", len(buffers))
+
+        with self.inveon_image.open_pixel_stream() as fh:
+            for time_index in self.time_frames:
+                for first_slice, slice_count in self.get_slice_runs():
+                    offset = (time_index * self.z_dimension + first_slice) * slice_bytes
+                    remaining = slice_count * slice_bytes
+                    if (not self.inveon_image.is_streamed()):
+                        advise_will_need(fh, offset, remaining)
+                    fh.seek(offset)
+                    while (remaining > 0):
+                        buffer       = buffers[buffer_index]
+                        view         = memoryview(buffer)
+                        buffer_index = (buffer_index + 1) % len(buffers)
+                        count = fh.readinto(view[:min(remaining, len(buffer))])
+                        if (count == 0):
+                            raise Exception(f"Unexpected end of pixel file {self.inveon_image.get_base_path()}")
+                        remaining -= count
+                        if (self.dtype == numpy.dtype("<i2")):
+                            yield view[:count]
+                        else:
+                            pixels = numpy.frombuffer(buffer, self.dtype, count // itemsize)
+                            target = converted.next_buffer()[:len(pixels)]
+                            numpy.copyto(target, pixels, casting="unsafe")
+                            yield memoryview(target).cast("B")
+
+    def iterate_normalized_frames(self):
+        # With read-ahead, slices of up to read_ahead_depth + 2 frames can be in flight
+        buffer_count = self.read_ahead_depth + 2 if (self.read_ahead_depth > 0) else 1
+        normalizer = FrameNormalizer(self.inveon_image, buffer_count)
+        for time_index in self.time_frames:
+            normalizer.load_frame(time_index, self.pixel_scale_for_frame(time_index))
+            frame = normalizer.get_frame()
+            for first_slice, slice_count in self.get_slice_runs():
+                yield memoryview(frame[first_slice:first_slice + slice_count]).cast("B")
+
+
+# Tell the OS that a range of a plain .img file will be read soon, so it can start the
+# I/O early. Not available on every platform; compressed streams are skipped.
+def advise_will_need(fh, offset: int, length: int) -> None:
+    if (not hasattr(os, "posix_fadvise")):
+        return
+    try:
+        os.posix_fadvise(fh.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+# Read one block of pixels into block: a whole (z, y, x) time frame when slice_index is
+# None, otherwise one (y, x) slice.
+def read_pixel_block(fh, inveon_image: InveonImage, block: numpy.ndarray, time_index: int,
+                     slice_index=None) -> numpy.ndarray:
+    frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+    slice_bytes = rows * columns * block.dtype.itemsize
+    if (slice_index is None):
+        fh.seek(time_index * z_dimension * slice_bytes)
+    else:
+        fh.seek((time_index * z_dimension + slice_index) * slice_bytes)
+
+    block_bytes = memoryview(block).cast("B")
+    position = 0
+    while (position < len(block_bytes)):
+        count = fh.readinto(block_bytes[position:])
+        if (count == 0):
+            raise Exception(f"Unexpected end of pixel file {inveon_image.get_base_path()}")
+        position += count
+    return block
+
+
+# Reads the given blocks, in order, as (key, pixels) pairs. key is (time_index, slice_index)
+# with slice_index None for whole time frames; all keys are one kind or the other.
+# The next block is announced to the OS while the current one is read.
+#
+# Blocks are read into a ring of buffer_count preallocated arrays, so a block is only
+# valid until buffer_count more blocks have been read.
+def iterate_pixel_blocks(inveon_image: InveonImage, keys: list, buffer_count: int):
+    dtype = inveon_image.get_pixel_dtype()
+    frame_count, z_dimension, rows, columns = inveon_image.get_pixel_shape()
+    slice_bytes = rows * columns * dtype.itemsize
+    if (keys and keys[0][1] is None):
+        pool = BufferPool((z_dimension, rows, columns), dtype, buffer_count)
+    else:
+        pool = BufferPool((rows, columns), dtype, buffer_count)
+
+    with inveon_image.open_pixel_stream() as fh:
+        for index, (time_index, slice_index) in enumerate(keys):
+            if (index + 1 < len(keys) and not inveon_image.is_streamed()):
+                next_time_index, next_slice_index = keys[index + 1]
+                if (next_slice_index is None):
+                    advise_will_need(fh, next_time_index * z_dimension * slice_bytes, z_dimension * slice_bytes)
+                else:
+                    advise_will_need(fh, (next_time_index * z_dimension + next_slice_index) * slice_bytes, slice_bytes)
+            block = read_pixel_block(fh, inveon_image, pool.next_buffer(), time_index, slice_index)
+            yield ((time_index, slice_index), block)
+
+
+# Runs an iterator on a background thread and keeps at most depth of its items waiting
+# in a bounded queue, so reading the .img file overlaps with building and writing datasets.
+# Items can be consumed by iterating, or by key with get() when the iterator produces
+# (key, value) pairs in the order they will be asked for.
+class ReadAhead:
+    END = object()
+
+    def __init__(
+            self,
+            items,
+            depth: int):
+        self.queue         = queue.Queue(maxsize=depth)
+        self.stopped       = threading.Event()
+        self.finished      = False
+        self.current_key   = None
+        self.current_value = None
+        self.thread        = threading.Thread(target=self.run, args=(items,), daemon=True)
+        self.thread.start()
+
+    def run(self, items) -> None:
+        try:
+            for item in items:
+                if (not self.put(item)):
+                    return
+        except BaseException as e:
+            self.put(e)
+        finally:
+            self.put(ReadAhead.END)
+
+    def put(self, item) -> bool:
+        while (not self.stopped.is_set()):
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next_item(self):
+        if (self.finished):
+            return ReadAhead.END
+        item = self.queue.get()
+        if (item is ReadAhead.END):
+            self.finished = True
+        elif (isinstance(item, BaseException)):
+            self.finished = True
+            raise item
+        return item
+
+    def __iter__(self):
+        try:
+            while ((item := self.next_item()) is not ReadAhead.END):
+                yield item
+        finally:
+            self.stop()
+
+    # Value for key, skipping items that were never asked for. Returns None when the
+    # iterator has no such key left, so the caller can fall back to a direct read.
+    def get(self, key):
+        while (self.current_key != key):
+            item = self.next_item()
+            if (item is ReadAhead.END):
+                return None
+            self.current_key, self.current_value = item
+        return self.current_value
+
+    def stop(self) -> None:
+        self.stopped.set()
+        while (not self.finished):
+            try:
+                if (self.queue.get(timeout=0.1) is ReadAhead.END):
+                    self.finished = True
+            except queue.Empty:
+                if (not self.thread.is_alive()):
+                    self.finished = True
+        self.thread.join()
@@ -0,0 +1,202 @@
+import os
+import struct
+import numpy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# RLE Lossless (PS3.5 Annex G) encoding of frames of little endian pixels, and the
+# encapsulated PixelData that holds them.
+#
+# A frame is split into byte planes, most significant byte first, and each plane is
+# one RLE segment, PackBits encoded row by row. The encoder works on a whole plane
+# with numpy: runs of equal bytes are found from the positions where the value or
+# the row changes, runs of two or more bytes become replicate runs, single bytes are
+# gathered into literal runs, and the output is scattered into place in one step.
+
+RLE_HEADER_LENGTH = 64
+RLE_MAX_SEGMENTS  = 15
+RUN_LIMIT         = 128
+
+ITEM_TAG               = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH       = 0xFFFFFFFF
+
+# Frames handed to a worker process at a time, and batches kept in flight per worker
+FRAMES_PER_TASK = 16
+TASKS_PER_JOB   = 4
+
+
+def encode_rle_segment(plane: numpy.ndarray) -> bytes:
+    rows, columns = plane.shape
+    data = numpy.ascontiguousarray(plane, numpy.uint8).ravel()
+    if (data.size == 0):
+        return b""
+
+    # Runs of equal bytes; none crosses a row boundary
+    boundaries = numpy.empty(data.size, bool)
+    boundaries[0] = True
+    numpy.not_equal(data[1:], data[:-1], out=boundaries[1:])
+    boundaries[::columns] = True
+    run_starts  = numpy.flatnonzero(boundaries)
+    run_lengths = numpy.diff(numpy.append(run_starts, data.size))
+
+    # Runs longer than RUN_LIMIT are cut into pieces of at most RUN_LIMIT bytes
+    piece_counts  = (run_lengths + RUN_LIMIT - 1) // RUN_LIMIT
+    piece_run     = numpy.repeat(numpy.arange(len(run_starts)), piece_counts)
+    piece_index   = numpy.arange(len(piece_run)) - numpy.repeat(numpy.cumsum(piece_counts) - piece_counts, piece_counts)
+    piece_starts  = run_starts[piece_run] + piece_index * RUN_LIMIT
+    piece_lengths = numpy.minimum(run_lengths[piece_run] - piece_index * RUN_LIMIT, RUN_LIMIT)
+    piece_values  = data[piece_starts]
+
+    # Single bytes are gathered into literal runs of at most RUN_LIMIT bytes within a row.
+    # opens marks the pieces that start a literal run.
+    literal = piece_lengths == 1
+    positions = numpy.arange(len(literal))
+    follows_literal = numpy.zeros(len(literal), bool)
+    follows_literal[1:] = literal[:-1]
+    opens = literal & ((piece_starts % columns == 0) | ~follows_literal)
+    stretch_start = numpy.maximum.accumulate(numpy.where(opens, positions, 0))
+    opens |= literal & ((positions - stretch_start) % RUN_LIMIT == 0)
+
+    # A replicate run is a count byte and the value, a literal run a count byte and its bytes
+    sizes   = numpy.where(literal, 1 + opens, 2)
+    offsets = numpy.cumsum(sizes) - sizes
+    length  = int(sizes.sum())
+    output  = numpy.zeros(length + length % 2, numpy.uint8)
+
+    replicate = ~literal
+    output[offsets[replicate]]     = (257 - piece_lengths[replicate]) & 0xFF
+    output[offsets[replicate] + 1] = piece_values[replicate]
+
+    literal_run_lengths = numpy.bincount((numpy.cumsum(opens) - 1)[literal])
+    output[offsets[opens]] = literal_run_lengths - 1
+    output[offsets[literal] + opens[literal]] = piece_values[literal]
+
+    return output.tobytes()
+
+
+# One RLE frame: the 64 byte header with the segment offsets, then one segment per
+# byte of a sample, most significant first. frame holds rows * columns little endian samples.
+def encode_rle_frame(frame, rows: int, columns: int, bytes_per_sample: int = 2) -> bytes:
+    planes = numpy.frombuffer(frame, numpy.uint8).reshape(rows, columns, bytes_per_sample)
+    segments = [encode_rle_segment(planes[:, :, byte]) for byte in reversed(range(bytes_per_sample))]
+
+    header = numpy.zeros(RLE_MAX_SEGMENTS + 1, "<u4")
+    header[0] = len(segments)
+    offset = RLE_HEADER_LENGTH
+    for index, segment in enumerate(segments):
+        header[index + 1] = offset
+        offset += len(segment)
+    return header.tobytes() + b"".join(segments)
+
+
+def encode_rle_frames(frames: list, rows: int, columns: int, bytes_per_sample: int = 2) -> list:
+    return [encode_rle_frame(frame, rows, columns, bytes_per_sample) for frame in frames]
+
+
+# Largest possible RLE frame: a literal run costs one count byte per RUN_LIMIT bytes and
+# an isolated byte between replicate runs two, so no segment is more than twice its plane
+def get_max_rle_frame_length(rows: int, columns: int, bytes_per_sample: int = 2) -> int:
+    return RLE_HEADER_LENGTH + bytes_per_sample * (2 * rows * columns + 1)
+
+
+# Encodes a sequence of frames, in order, on jobs worker processes. Frames are sent in
+# batches of FRAMES_PER_TASK and at most TASKS_PER_JOB batches per worker are in flight,
+# so memory stays bounded however many frames there are. With jobs 1 everything runs
+# in this process.
+#
+# Frames are copied before they are handed on, so callers may reuse their buffers.
+class RLEFrameEncoder:
+    def __init__(
+            self,
+            rows: int,
+            columns: int,
+            bytes_per_sample: int = 2,
+            jobs: int = 1):
+        self.rows             = rows
+        self.columns          = columns
+        self.bytes_per_sample = bytes_per_sample
+        self.jobs             = jobs if (jobs is not None) else os.cpu_count()
+
+    def encode_frames(self, frames):
+        if (self.jobs <= 1):
+            for frame in frames:
+                yield encode_rle_frame(frame, self.rows, self.columns, self.bytes_per_sample)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            pending = deque()
+            batch   = []
+            for frame in frames:
+                batch.append(bytes(frame))
+                if (len(batch) == FRAMES_PER_TASK):
+                    pending.append(executor.submit(encode_rle_frames, batch, self.rows, self.columns,
+                                                   self.bytes_per_sample))
+                    batch = []
+                    while (len(pending) >= self.jobs * TASKS_PER_JOB):
+                        yield from pending.popleft().result()
+            if (len(batch) > 0):
+                pending.append(executor.submit(encode_rle_frames, batch, self.rows, self.columns,
+                                               self.bytes_per_sample))
+            while (len(pending) > 0):
+                yield from pending.popleft().result()
+
+
+# The encapsulated PixelData value of a single frame: an empty Basic Offset Table, the
+# frame as one fragment and the sequence delimiter
+def encapsulate_frame(encoded_frame: bytes) -> bytes:
+    return b"".join([struct.pack("<HHI", *ITEM_TAG, 0),
+                     struct.pack("<HHI", *ITEM_TAG, len(encoded_frame)), encoded_frame,
+                     struct.pack("<HHI", *SEQUENCE_DELIMITER_TAG, 0)])
+
+
+# Writes encapsulated PixelData of frame_count frames, one fragment per frame, to a
+# seekable file, preceded by the offset table elements when extended is set.
+#
+# The offsets are only known once the frames are encoded, so the Basic Offset Table (or,
+# when extended, the Extended Offset Table and its lengths, for objects whose offsets
+# may not fit in 32 bits) is written as zeros and filled in by seeking back at the end.
+def write_encapsulated_frames(fh, encoded_frames, frame_count: int, extended: bool) -> int:
+    if (extended):
+        table_position = fh.tell()
+        for element in (0x0001, 0x0002):
+            fh.write(struct.pack("<HH2sHI", 0x7FE0, element, b"OV", 0, 8 * frame_count))
+            fh.write(bytes(8 * frame_count))
+    fh.write(struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OB", 0, UNDEFINED_LENGTH))
+    if (not extended):
+        table_position = fh.tell()
+    fh.write(struct.pack("<HHI", *ITEM_TAG, 0 if (extended) else 4 * frame_count))
+    if (not extended):
+        fh.write(bytes(4 * frame_count))
+
+    first_fragment = fh.tell()
+    offsets = numpy.zeros(frame_count, "<u8")
+    lengths = numpy.zeros(frame_count, "<u8")
+    written = 0
+    for encoded_frame in encoded_frames:
+        if (written == frame_count):
+            raise Exception(f"More than the expected {frame_count} frames to encapsulate")
+        offsets[written] = fh.tell() - first_fragment
+        lengths[written] = len(encoded_frame)
+        fh.write(struct.pack("<HHI", *ITEM_TAG, len(encoded_frame)))
+        fh.write(encoded_frame)
+        written += 1
+    if (written != frame_count):
+        raise Exception(f"Encapsulated {written} frames, expected {frame_count}")
+    fh.write(struct.pack("<HHI", *SEQUENCE_DELIMITER_TAG, 0))
+
+    end = fh.tell()
+    if (extended):
+        fh.seek(table_position + 12)
+        fh.write(offsets.tobytes())
+        fh.seek(12, os.SEEK_CUR)
+        fh.write(lengths.tobytes())
+    else:
+        if (frame_count > 0 and offsets[-1] >= 2**32):
+            raise Exception("Frame offsets do not fit in a Basic Offset Table")
+        fh.seek(table_position + 8)
+        fh.write(offsets.astype("<u4").tobytes())
+    fh.seek(end)
+    return end - first_fragment
+
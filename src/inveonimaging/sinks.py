@@ -0,0 +1,181 @@
+import io
+import os
+import sys
+import time
+import tarfile
+import zipfile
+import posixpath
+import tempfile
+from contextlib import contextmanager
+
+
+# Where converted files go: a folder tree (the default), or a single tar or zip archive,
+# or a tar stream on stdout. The factory and InstanceWriter name files by path, e.g.
+# 1/DICOM/PET-000001.dcm, and the sink either writes them to disk or adds them to the
+# archive under that name, so an archive holds the same layout as a converted folder.
+#
+# Archives are written through one large buffer and no file is created per instance.
+# Files written as a stream (multiframe objects) are spooled in memory, or in an
+# anonymous temporary file beyond SPOOL_SIZE, until their size is known.
+
+OUTPUT_BUFFER_SIZE = 8 * 1024 * 1024
+SPOOL_SIZE         = 64 * 1024 * 1024
+
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz")
+ZIP_SUFFIXES = (".zip",)
+
+
+# "-" is a tar archive on stdout
+def is_archive_output(path: str) -> bool:
+    return path == "-" or path.lower().endswith(TAR_SUFFIXES + ZIP_SUFFIXES)
+
+
+def open_output_sink(path: str):
+    if (path == "-"):
+        return TarSink(sys.stdout.buffer, "w|", close_file=False)
+    if (path.lower().endswith(ZIP_SUFFIXES)):
+        return ZipSink(open(path, "wb", buffering=OUTPUT_BUFFER_SIZE))
+    mode = "w|" if (path.lower().endswith(".tar")) else "w|gz"
+    return TarSink(open(path, "wb", buffering=OUTPUT_BUFFER_SIZE), mode)
+
+
+# Files and folders on disk, by the paths given
+class FolderSink:
+    def __init__(
+            self,
+            root: str = ""):
+        self.root = root
+
+    # Folder that the layout of the output starts from
+    def get_root(self) -> str:
+        return self.root
+
+    def create_folder(self, folder: str, must_be_empty: bool) -> None:
+        if (os.path.exists(folder)):
+            if (not os.path.isdir(folder)):
+                raise Exception(f'The item identified by {folder} exists, but it is not a folder')
+            if (must_be_empty and (os.listdir(folder))):
+                raise Exception(f'The item identified by {folder} exists, but it is not empty')
+        else:
+            os.makedirs(folder, 0o777, True)
+
+    # A whole file given as a list of byte strings, written in one call
+    def write_file(self, path: str, parts: list) -> None:
+        with open(path, "wb") as fh:
+            fh.write(b"".join(parts))
+
+    # A seekable handle for a file written piece by piece
+    def open_file(self, path: str):
+        return open(path, "wb")
+
+    # Files are independent, so they may be written from several threads in any order
+    def writes_in_any_order(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+# Members are named by their path relative to the archive root. Every member gets the
+# time the archive was opened. fh is closed with the archive unless close_file is false
+# (stdout).
+class ArchiveSink:
+    def __init__(
+            self,
+            fh,
+            close_file: bool = True):
+        self.fh         = fh
+        self.close_file = close_file
+        self.names      = set()
+        self.mtime      = int(time.time())
+
+    def get_root(self) -> str:
+        return ""
+
+    def get_member_name(self, path: str) -> str:
+        name = posixpath.normpath(path.replace(os.sep, "/")).lstrip("/")
+        if (name in self.names):
+            raise Exception(f"{name} was already written to the archive")
+        self.names.add(name)
+        return name
+
+    # Folders are implied by the member names; a folder that must be empty must not
+    # have had anything written to it
+    def create_folder(self, folder: str, must_be_empty: bool) -> None:
+        folder = posixpath.normpath(folder.replace(os.sep, "/")).lstrip("/")
+        if (must_be_empty and any(name.startswith(folder + "/") for name in self.names)):
+            raise Exception(f'The folder {folder} in the archive is not empty')
+
+    def write_file(self, path: str, parts: list) -> None:
+        data = b"".join(parts)
+        self.add_member(self.get_member_name(path), io.BytesIO(data), len(data))
+
+    # The file is spooled and added to the archive when the handle is closed
+    @contextmanager
+    def open_file(self, path: str):
+        name = self.get_member_name(path)
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            yield spool
+            size = spool.tell()
+            spool.seek(0)
+            self.add_member(name, spool, size)
+
+    # Members are added one after the other, in the order the files are written
+    def writes_in_any_order(self) -> bool:
+        return False
+
+    def add_member(self, name: str, fileobj, size: int) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+# Plain or gzip compressed tar, written as a stream so the output need not be seekable
+class TarSink(ArchiveSink):
+    def __init__(
+            self,
+            fh,
+            mode: str = "w|",
+            close_file: bool = True):
+        super().__init__(fh, close_file)
+        self.tar_file = tarfile.open(fileobj=fh, mode=mode, bufsize=OUTPUT_BUFFER_SIZE)
+
+    def add_member(self, name: str, fileobj, size: int) -> None:
+        info = tarfile.TarInfo(name)
+        info.size  = size
+        info.mtime = self.mtime
+        info.mode  = 0o644
+        self.tar_file.addfile(info, fileobj)
+
+    def close(self) -> None:
+        self.tar_file.close()
+        self.fh.flush()
+        if (self.close_file):
+            self.fh.close()
+
+
+# Members are stored, not compressed: the pixel data hardly compress and the archive
+# is usually compressed again for transfer
+class ZipSink(ArchiveSink):
+    def __init__(
+            self,
+            fh):
+        super().__init__(fh)
+        self.zip_file = zipfile.ZipFile(fh, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_member(self, name: str, fileobj, size: int) -> None:
+        info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+        info.external_attr = 0o644 << 16
+        with self.zip_file.open(info, "w", force_zip64=(size >= zipfile.ZIP64_LIMIT)) as member:
+            while (True):
+                block = fileobj.read(OUTPUT_BUFFER_SIZE)
+                if (len(block) == 0):
+                    break
+                member.write(block)
+
+    def close(self) -> None:
+        self.zip_file.close()
+        self.fh.flush()
+        if (self.close_file):
+            self.fh.close()
@@ -0,0 +1,68 @@
+import uuid
+import hashlib
+from pydicom.uid import generate_uid
+
+
+# Root of UIDs made from a UUID (PS3.5 B.2): 2.25 followed by the UUID as one integer
+UUID_ROOT = "2.25."
+
+
+# Hands out the Study, Series, Frame of Reference and SOP Instance UIDs of a conversion.
+#
+# Without a namespace every UID is random (pydicom generate_uid), as before. With a
+# namespace, UIDs are derived: each is the 2.25 form of a name-based (version 5) UUID
+# of the namespace and a name built from the parts that identify the object, e.g.
+#   study/<study key>
+#   <source identity>/<series key>/series
+#   <source identity>/<series key>/instance/<instance number>
+# so converting the same files again with the same namespace and options gives the
+# same UIDs, and archives that deduplicate on UID see nothing new.
+#
+# The namespace is a UUID, or any other string (which is itself hashed to a UUID).
+class UIDProvider:
+    def __init__(
+            self,
+            namespace: str = None):
+        self.namespace      = namespace
+        self.namespace_uuid = None
+        if (namespace is not None):
+            try:
+                self.namespace_uuid = uuid.UUID(namespace)
+            except ValueError:
+                self.namespace_uuid = uuid.uuid5(uuid.NAMESPACE_OID, namespace)
+
+    def is_deterministic(self) -> bool:
+        return self.namespace_uuid is not None
+
+    def derive_uid(self, *parts) -> str:
+        if (self.namespace_uuid is None):
+            return generate_uid()
+        name = "/".join(str(part) for part in parts)
+        return UUID_ROOT + str(uuid.uuid5(self.namespace_uuid, name).int)
+
+    # UIDs for the numbers first .. first + count - 1 under one prefix, e.g. all the
+    # instances of a series. The SHA-1 of the namespace and prefix is computed once and
+    # copied for each number.
+    def derive_uids(self, parts: tuple, count: int, first: int = 1) -> list:
+        if (self.namespace_uuid is None):
+            return [generate_uid() for index in range(count)]
+
+        prefix = hashlib.sha1(self.namespace_uuid.bytes)
+        prefix.update(("/".join(str(part) for part in parts) + "/").encode("utf-8"))
+        rtn = []
+        for number in range(first, first + count):
+            digest = prefix.copy()
+            digest.update(str(number).encode("utf-8"))
+            rtn.append(UUID_ROOT + str(uuid_from_sha1(digest.digest())))
+        return rtn
+
+
+# The integer value of a version 5 UUID from the SHA-1 digest of its namespace and name,
+# as uuid.uuid5 builds it
+def uuid_from_sha1(digest: bytes) -> int:
+    value = int.from_bytes(digest[:16], "big")
+    value &= ~(0xc000 << 48)
+    value |= 0x8000 << 48
+    value &= ~(0xf000 << 64)
+    value |= 5 << 76
+    return value
@@ -0,0 +1,220 @@
+import io
+import os
+import time
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.charset import default_encoding
+from pydicom.dataset import FileDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element, correct_ambiguous_vr
+from pydicom.tag import Tag
+
+from inveonimaging.deflate import DeflateStream
+from inveonimaging.sinks import FolderSink
+
+
+FILE_META_GROUP_LENGTH_TAG     = Tag(0x0002, 0x0000)
+MEDIA_STORAGE_SOP_INSTANCE_TAG = Tag(0x0002, 0x0003)
+PIXEL_DATA_TAG                 = Tag(0x7FE0, 0x0010)
+
+
+# Writes the single-frame instances of a series from one template dataset (see
+# Factory.create_instance_template), producing the same bytes as FileDataset.save_as.
+#
+# The first instance is encoded element by element with pydicom. Everything that does
+# not change between instances - the preamble, the file meta elements other than the
+# SOP Instance UID and group length, and every dataset element not named in
+# varying_keywords - is kept as encoded bytes. Each instance is then written as those
+# cached bytes interleaved, in tag order, with the varying elements encoded afresh and
+# the raw pixel buffer, in one write.
+#
+# Only the elements named in varying_keywords may change between instances.
+#
+# With a deflate_level the files are Deflated Explicit VR Little Endian: everything after
+# the file meta information is compressed. Instances are then compressed on jobs threads
+# (zlib releases the GIL while compressing), at most two per thread queued, so write()
+# returns while earlier instances are still being compressed; close() waits for the last
+# ones. A sink that takes files in any order (a folder) has each instance deflated
+# straight into its file on the compressing thread. An archive adds its members in order,
+# so there the compressed files are kept in memory and handed to it in order. statistics,
+# when given, collects the sizes and times (see CompressionStatistics).
+#
+# Files go to output_sink (see sinks.py), by default straight to disk.
+class InstanceWriter:
+    def __init__(
+            self,
+            varying_keywords: list,
+            deflate_level=None,
+            jobs: int = 1,
+            statistics=None,
+            output_sink=None):
+        self.varying_tags  = {Tag(keyword) for keyword in varying_keywords}
+        self.deflate_level = deflate_level
+        self.jobs          = jobs if (jobs is not None) else os.cpu_count()
+        self.statistics    = statistics
+        self.output_sink   = output_sink if (output_sink is not None) else FolderSink()
+        self.encodings     = None
+        self.preamble      = None
+        self.meta_before   = None
+        self.meta_after    = None
+        self.segments      = None
+        self.pixel_vr      = None
+        self.executor      = None
+        self.pending       = deque()
+
+    def write(self, template: FileDataset, path: str) -> None:
+        if (self.segments is None):
+            self.encode_static_elements(template)
+
+        header = [self.preamble]
+        header.extend(self.encode_file_meta(template.file_meta[MEDIA_STORAGE_SOP_INSTANCE_TAG].value))
+        parts  = []
+        buffer = None
+        for segment in self.segments:
+            if (isinstance(segment, bytes)):
+                if (buffer is not None):
+                    parts.append(buffer.getvalue())
+                    buffer = None
+                parts.append(segment)
+            elif (segment == PIXEL_DATA_TAG):
+                if (buffer is not None):
+                    parts.append(buffer.getvalue())
+                    buffer = None
+                parts.extend(self.encode_pixel_data(template))
+            elif (segment in template):
+                if (buffer is None):
+                    buffer = create_buffer()
+                write_data_element(buffer, template[segment], self.encodings)
+        if (buffer is not None):
+            parts.append(buffer.getvalue())
+
+        if (self.deflate_level is None):
+            self.output_sink.write_file(path, header + parts)
+        elif (self.jobs <= 1):
+            self.write_deflated(path, self.deflate(path, header, parts))
+        else:
+            # The pixels are a view on a buffer that the next instance reuses
+            parts = [bytes(part) if (isinstance(part, memoryview)) else part for part in parts]
+            if (self.executor is None):
+                self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+            while (len(self.pending) >= 2 * self.jobs):
+                self.write_pending()
+            self.pending.append((path, self.executor.submit(self.deflate, path, header, parts)))
+
+    # Deflates an instance into its file when the sink takes files in any order and returns
+    # None; otherwise returns the whole file, compressed in memory, for write_deflated
+    def deflate(self, path: str, header: list, parts: list):
+        if (self.output_sink.writes_in_any_order()):
+            with self.output_sink.open_file(path) as fh:
+                self.deflate_into(fh, header, parts)
+            return None
+        buffer = io.BytesIO()
+        self.deflate_into(buffer, header, parts)
+        return [buffer.getvalue()]
+
+    # The file meta information as it is, then the rest of the file deflated
+    def deflate_into(self, fh, header: list, parts: list) -> None:
+        start = time.perf_counter()
+        for part in header:
+            fh.write(part)
+        stream = DeflateStream(fh, self.deflate_level)
+        for part in parts:
+            stream.write(part)
+        stream.finish()
+        if (self.statistics is not None):
+            self.statistics.add(stream, time.perf_counter() - start)
+
+    def write_deflated(self, path: str, deflated) -> None:
+        if (deflated is not None):
+            self.output_sink.write_file(path, deflated)
+
+    # Writes the oldest instance queued for compression once it is compressed
+    def write_pending(self) -> None:
+        path, future = self.pending.popleft()
+        self.write_deflated(path, future.result())
+
+    # Waits for the instances still being compressed and writes them, raising the first error
+    def close(self) -> None:
+        if (self.executor is None):
+            return
+        try:
+            while (len(self.pending) > 0):
+                self.write_pending()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+            self.pending.clear()
+
+    # Resolves ambiguous VRs the way save_as does, then encodes the unchanging elements
+    # into runs of bytes separated by the tags of the varying elements
+    def encode_static_elements(self, template: FileDataset) -> None:
+        correct_ambiguous_vr(template, True)
+        self.encodings = template.get("SpecificCharacterSet", default_encoding)
+        self.preamble  = (template.preamble or b"") + (b"DICM" if template.preamble else b"")
+
+        file_meta = template.file_meta
+        self.meta_before = create_buffer()
+        self.meta_after  = create_buffer()
+        for tag in sorted(file_meta.keys()):
+            if (tag in (FILE_META_GROUP_LENGTH_TAG, MEDIA_STORAGE_SOP_INSTANCE_TAG)):
+                continue
+            buffer = self.meta_before if (tag < MEDIA_STORAGE_SOP_INSTANCE_TAG) else self.meta_after
+            write_data_element(buffer, file_meta[tag])
+        self.meta_before = self.meta_before.getvalue()
+        self.meta_after  = self.meta_after.getvalue()
+
+        self.segments = []
+        static = create_buffer()
+        for tag in sorted(set(template.keys()) | self.varying_tags):
+            # Retired group lengths are not written (PS3.5, 7.2)
+            if (tag.element == 0 and tag.group > 6):
+                continue
+            if (tag in self.varying_tags):
+                self.segments.append(static.getvalue())
+                self.segments.append(tag)
+                static = create_buffer()
+            else:
+                write_data_element(static, template[tag], self.encodings)
+        self.segments.append(static.getvalue())
+        self.segments = [segment for segment in self.segments if (segment != b"")]
+
+        if (PIXEL_DATA_TAG in template):
+            self.pixel_vr = template[PIXEL_DATA_TAG].VR
+
+    # Group length, the elements before the SOP Instance UID, the UID, the elements after it
+    def encode_file_meta(self, sop_instance_uid: str) -> list:
+        uid = sop_instance_uid.encode("ascii")
+        if (len(uid) % 2 == 1):
+            uid += b"\0"
+        uid_element  = struct.pack("<HH2sH", 0x0002, 0x0003, b"UI", len(uid)) + uid
+        group_length = len(self.meta_before) + len(uid_element) + len(self.meta_after)
+        return [struct.pack("<HH2sHI", 0x0002, 0x0000, b"UL", 4, group_length),
+                self.meta_before, uid_element, self.meta_after]
+
+    # The PixelData header and the pixel buffer itself, which is not copied into an element.
+    # Encapsulated pixel data (undefined length) already end with the sequence delimiter.
+    def encode_pixel_data(self, template: FileDataset) -> list:
+        if (PIXEL_DATA_TAG not in template):
+            return []
+        if (template[PIXEL_DATA_TAG].is_undefined_length):
+            return [struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OB", 0, 0xFFFFFFFF), template.PixelData]
+        if (self.pixel_vr is None):
+            correct_ambiguous_vr(template, True)
+            self.pixel_vr = template[PIXEL_DATA_TAG].VR
+        pixels = template.PixelData
+        length = len(pixels)
+        if (isinstance(pixels, memoryview)):
+            length = pixels.nbytes
+        parts = [struct.pack("<HH2sHI", 0x7FE0, 0x0010, self.pixel_vr.encode("ascii"), 0, length + length % 2),
+                 pixels]
+        if (length % 2 == 1):
+            parts.append(b"\0")
+        return parts
+
+
+def create_buffer() -> DicomBytesIO:
+    buffer = DicomBytesIO()
+    buffer.is_little_endian = True
+    buffer.is_implicit_VR   = False
+    return buffer
@@ -0,0 +1,75 @@
+import os
+import time
+import random
+import argparse
+import contextlib
+import numpy
+
+from inveonimaging.dicomstrings import DS_CACHE, format_ds, format_ds_array
+from legacy_formatting import legacy_format_ds
+
+
+# Times inveonimaging.dicomstrings against the Decimal and regular expression formatting
+# it replaced (see legacy_formatting; test_dicomstrings checks that both agree).
+# Run from the repository root: PYTHONPATH=src python3 tests/benchmark_dicomstrings.py
+
+def time_best(function, repeat: int, before=None) -> float:
+    best = None
+    for index in range(repeat):
+        if (before is not None):
+            before()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if (best is None or elapsed < best) else best
+    return best
+
+
+# Arguments:
+#              Number of slices in the benchmark stack
+#              Number of time frames in the benchmark stack
+#              Number of times each timing is repeated
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time the DICOM DS formatter against Decimal and regular expressions")
+    parser.add_argument('-z', '--slices',  dest='slices',  type=int, default=159,  help="Slices per time frame (default: 159)")
+    parser.add_argument('-t', '--frames',  dest='frames',  type=int, default=20,   help="Time frames (default: 20)")
+    parser.add_argument('-r', '--repeat',  dest='repeat',  type=int, default=5,    help="Number of timed repetitions (default: 5)")
+    args = parser.parse_args()
+
+    generator = random.Random(1)
+    values = [generator.choice([-1, 1]) * generator.uniform(0, 10) * 10 ** generator.randint(-12, 12)
+              for index in range(10000)]
+
+    # ImagePositionPatient and SliceLocation of every slice of a stack
+    slice_indices = numpy.arange(args.slices * args.frames)
+    z_positions   = (slice_indices + .5 - args.slices / 2) * 0.796 + 3.125
+    stack         = numpy.empty((len(slice_indices), 4))
+    stack[:, 0]   = 2.7173405
+    stack[:, 1]   = -1.9409575
+    stack[:, 2]   = -z_positions
+    stack[:, 3]   = z_positions
+
+    # The scalar header fields of a conversion, formatted once per series
+    header_fields = [("0.776383", 6, "signed", True), ("0.796", 5, "signed", False), ("80", 0, "unsigned", False),
+                     (1234.5, 4, "unsigned", False), (6586.2, 4, "unsigned", False), (0.967, 4, "unsigned", False),
+                     ("350", 2, "plain", False), ("650", 2, "plain", False)] * 500
+
+    for name, workload in (("random values", values), (f"stack of {len(slice_indices)} slices", stack.ravel().tolist())):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            legacy = time_best(lambda: [legacy_format_ds(value, 7, "compact") for value in workload], args.repeat)
+        per_value = time_best(lambda: [format_ds(value, 7) for value in workload], args.repeat, DS_CACHE.clear)
+        array     = time_best(lambda: format_ds_array(workload, 7), args.repeat)
+        print(f"{name}, {len(workload)} values:")
+        for label, elapsed in (("legacy (Decimal + re)", legacy), ("format_ds, not cached", per_value),
+                               ("format_ds_array", array)):
+            print(f"  {label:24} {elapsed / len(workload) * 1e9:8.0f} ns per value  {legacy / elapsed:6.1f}x")
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        legacy = time_best(lambda: [legacy_format_ds(*field) for field in header_fields], args.repeat)
+    DS_CACHE.clear()
+    per_value = time_best(lambda: [format_ds(*field) for field in header_fields], args.repeat)
+    print(f"header fields of {len(header_fields) // 8} series, {len(header_fields)} values:")
+    for label, elapsed in (("legacy (Decimal + re)", legacy), ("format_ds", per_value)):
+        print(f"  {label:24} {elapsed / len(header_fields) * 1e9:8.0f} ns per value  {legacy / elapsed:6.1f}x")
@@ -0,0 +1,71 @@
+import time
+import argparse
+import numpy
+from pydicom.dataset import Dataset
+from pydicom.filewriter import write_data_element
+from pydicom.sequence import Sequence
+
+from inveonimaging.framegroups import PerFrameFunctionalGroups
+from inveonimaging.writer import create_buffer
+
+
+# Times the per-frame functional groups table encoder against one pydicom Dataset per
+# frame (test_framegroups checks that both write the same bytes).
+# Run from the repository root: PYTHONPATH=src python3 tests/benchmark_framegroups.py
+
+
+# Arguments:
+#              Number of slices per time frame
+#              Number of time frames
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time the per-frame functional groups encoder against pydicom")
+    parser.add_argument('-z', '--slices',  dest='slices',  type=int, default=159,  help="Slices per time frame (default: 159)")
+    parser.add_argument('-t', '--frames',  dest='frames',  type=int, default=100,  help="Time frames (default: 100)")
+    args = parser.parse_args()
+
+    frame_count   = args.slices * args.frames
+    time_indices  = numpy.repeat(numpy.arange(args.frames), args.slices)
+    slice_indices = numpy.tile(numpy.arange(args.slices), args.frames)
+
+    time_items = []
+    for time_index in range(args.frames):
+        item = Dataset()
+        item.FrameAcquisitionDateTime = f"20240520{12 + time_index // 60:02d}{time_index % 60:02d}00.000000"
+        item.FrameAcquisitionDuration = 1000. * (time_index + 1)
+        item.FrameAcquisitionNumber   = time_index + 1
+        time_items.append(item)
+    slice_items = []
+    for slice_index in range(args.slices):
+        item = Dataset()
+        item.ImagePositionPatient = f"1.5E1\\-2.25E1\\{slice_index * 0.796:.7E}"
+        slice_items.append(item)
+
+    start = time.perf_counter()
+    groups = PerFrameFunctionalGroups(frame_count)
+    groups.add_elements("FrameContentSequence", time_items, time_indices)
+    groups.add_elements("PlanePositionSequence", slice_items, slice_indices)
+    groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "UL",
+                               numpy.stack([time_indices + 1, slice_indices + 1], axis=1))
+    encoded = groups.encode()
+    elapsed = time.perf_counter() - start
+    print(f"Table encoder: {frame_count} frames, {len(encoded)} bytes in {elapsed:.3f} s")
+
+    start = time.perf_counter()
+    ds = Dataset()
+    frames = []
+    for frame_index in range(frame_count):
+        frame = Dataset()
+        content = Dataset()
+        content.update(time_items[time_indices[frame_index]])
+        content.DimensionIndexValues = [int(time_indices[frame_index]) + 1, int(slice_indices[frame_index]) + 1]
+        frame.FrameContentSequence  = Sequence([content])
+        frame.PlanePositionSequence = Sequence([slice_items[slice_indices[frame_index]]])
+        frames.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+    buffer = create_buffer()
+    write_data_element(buffer, ds["PerFrameFunctionalGroupsSequence"])
+    elapsed_pydicom = time.perf_counter() - start
+    print(f"pydicom Datasets: {frame_count} frames, {len(buffer.getvalue())} bytes in {elapsed_pydicom:.3f} s")
+    print(f"Table encoder {elapsed_pydicom / elapsed:.1f}x faster")
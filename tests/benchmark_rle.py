@@ -0,0 +1,43 @@
+import os
+import time
+import argparse
+import numpy
+
+from inveonimaging.rle import RLEFrameEncoder
+
+
+# Times the RLE Lossless frame encoder, in this process and on worker processes
+# (test_rle checks that pydicom decodes its frames to the original pixels).
+# Run from the repository root: PYTHONPATH=src python3 tests/benchmark_rle.py
+
+
+# Arguments:
+#              Rows and columns of the benchmark frames
+#              Number of frames
+#              Number of worker processes
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time the RLE Lossless frame encoder")
+    parser.add_argument('-s', '--size',    dest='size',   type=int, default=128,  help="Rows and columns of each frame (default: 128)")
+    parser.add_argument('-n', '--frames',  dest='frames', type=int, default=500,  help="Number of frames (default: 500)")
+    parser.add_argument('-j', '--jobs',    dest='jobs',   type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    # Mostly background with a blurred, noisy blob, as in a PET frame
+    generator = numpy.random.default_rng(1)
+    y, x = numpy.mgrid[0:args.size, 0:args.size]
+    blob = numpy.exp(-((x - args.size / 2) ** 2 + (y - args.size / 2) ** 2) / (2 * (args.size / 8) ** 2))
+    frames = []
+    for index in range(args.frames):
+        pixels = numpy.rint(blob * 32767 * generator.uniform(0.5, 1.0, blob.shape)) * (blob > 0.05)
+        frames.append(pixels.astype("<i2").tobytes())
+
+    native = sum(len(frame) for frame in frames)
+    for jobs in (1, args.jobs):
+        start = time.perf_counter()
+        encoded = list(RLEFrameEncoder(args.size, args.size, 2, jobs).encode_frames(frames))
+        elapsed = time.perf_counter() - start
+        size = sum(len(frame) for frame in encoded)
+        print(f"jobs {jobs if (jobs is not None) else os.cpu_count()}: {len(frames)} frames in {elapsed:.3f} s, "
+              f"{native / size:.1f}x smaller")
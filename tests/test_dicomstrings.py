@@ -0,0 +1,73 @@
+import random
+import pytest
+
+from inveonimaging.dicomstrings import format_ds, format_ds_array, format_is, format_is_array
+from legacy_formatting import legacy_format_ds
+
+
+# (precision, style, trim_zero) of each DS field the factory formats
+FACTORY_FORMATS = [
+    (7, "compact",  False),   # ImagePositionPatient, SliceLocation
+    (6, "signed",   True),    # PixelSpacing
+    (5, "signed",   False),   # SliceThickness
+    (4, "unsigned", False),   # distances, RadionuclideTotalDose / HalfLife / PositronFraction
+    (0, "unsigned", False),   # KVP
+    (2, "plain",    False),   # energy window limits
+]
+
+
+def create_float_values() -> list:
+    generator = random.Random(1)
+    values = [generator.choice([-1, 1]) * generator.uniform(0, 10) * 10 ** generator.randint(-12, 12)
+              for index in range(2000)]
+    return values + [0.0, -0.0, 1.0, 10.0, 100.0, 0.1, 0.01, 9.99999995, 0.5, 2.5, 1e100, -1e-100]
+
+
+# Header values are read as text, as the scanner wrote them
+def create_header_strings() -> list:
+    generator = random.Random(2)
+    strings = []
+    for index in range(2000):
+        digits = str(generator.randint(0, 10 ** generator.randint(1, 9)))
+        point  = generator.randint(0, len(digits))
+        strings.append(digits[:point] + "." + digits[point:] if (point < len(digits)) else digits)
+    return strings + ["0", "80", "350", "650", "0.776383", "0.796", "6586.2", "0.967", "0.15", "2.5"]
+
+
+@pytest.mark.parametrize("precision, style, trim_zero", FACTORY_FORMATS)
+@pytest.mark.parametrize("values", [create_float_values(), create_header_strings()], ids=["floats", "strings"])
+def test_format_ds_matches_legacy(values, precision, style, trim_zero, capsys):
+    expected = [legacy_format_ds(value, precision, style, trim_zero) for value in values]
+    capsys.readouterr()
+
+    assert [format_ds(value, precision, style, trim_zero) for value in values] == expected
+    # The second pass is served from the cache
+    assert [format_ds(value, precision, style, trim_zero) for value in values] == expected
+
+
+@pytest.mark.parametrize("precision, style, trim_zero", FACTORY_FORMATS)
+def test_format_ds_array_matches_legacy(precision, style, trim_zero, capsys):
+    values   = create_float_values()
+    expected = [legacy_format_ds(value, precision, style, trim_zero) for value in values]
+    capsys.readouterr()
+
+    assert format_ds_array(values, precision, style, trim_zero) == expected
+
+
+def test_signed_zero_keeps_its_sign():
+    assert format_ds(0.0, 7) == "0.0000000E0"
+    assert format_ds(-0.0, 7) == "-0.0000000E0"
+    assert format_ds(0.0, 7) == "0.0000000E0"
+    assert format_ds_array([0.0, -0.0, 0.0], 7) == ["0.0000000E0", "-0.0000000E0", "0.0000000E0"]
+
+
+def test_format_ds_fits_16_characters():
+    assert len(format_ds(-1.23456789e-100, 7)) <= 16
+    assert all(len(text) <= 16 for text in format_ds_array([-1.23456789e-100, 1e200], 7))
+
+
+def test_format_is_range():
+    assert format_is(2**31 - 1) == "2147483647"
+    assert format_is_array([1, -2]) == ["1", "-2"]
+    with pytest.raises(Exception):
+        format_is(2**31)
@@ -0,0 +1,112 @@
+import numpy
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.filewriter import write_data_element
+from pydicom.sequence import Sequence
+from pydicom.tag import Tag
+
+from inveonimaging.framegroups import PerFrameFunctionalGroups
+from inveonimaging.writer import create_buffer
+
+
+TIME_FRAMES = 3
+SLICES      = 4
+
+TIME_INDICES  = numpy.repeat(numpy.arange(TIME_FRAMES), SLICES)
+SLICE_INDICES = numpy.tile(numpy.arange(SLICES), TIME_FRAMES)
+
+
+# Elements that change with the time frame; FrameAcquisitionDuration is left out of the
+# last one, so its frames lack it
+def create_time_items() -> list:
+    items = []
+    for time_index in range(TIME_FRAMES):
+        item = Dataset()
+        item.FrameAcquisitionDateTime = f"2024052012{time_index:02d}00.000000"
+        item.FrameAcquisitionNumber   = time_index + 1
+        if (time_index < TIME_FRAMES - 1):
+            item.FrameAcquisitionDuration = 1000. * (time_index + 1)
+        items.append(item)
+    return items
+
+
+# Elements that change with the slice, with odd-length values that are padded
+def create_slice_items() -> list:
+    items = []
+    for slice_index in range(SLICES):
+        item = Dataset()
+        item.ImagePositionPatient = f"1.5E1\\-2.25E1\\{slice_index * 0.796:.7E}"
+        items.append(item)
+    return items
+
+
+def create_dimension_index_values() -> numpy.ndarray:
+    return numpy.stack([TIME_INDICES + 1, SLICE_INDICES + 70000], axis=1)
+
+
+def create_groups() -> PerFrameFunctionalGroups:
+    groups = PerFrameFunctionalGroups(TIME_FRAMES * SLICES)
+    groups.add_elements("FrameContentSequence", create_time_items(), TIME_INDICES)
+    groups.add_elements("PlanePositionSequence", create_slice_items(), SLICE_INDICES)
+    groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "UL", create_dimension_index_values())
+    groups.add_integer_element("PlanePositionSequence", "StackID", "US", [[slice_index] for slice_index in SLICE_INDICES])
+    return groups
+
+
+# The same sequence as one pydicom Dataset per frame
+def create_pydicom_element():
+    time_items  = create_time_items()
+    slice_items = create_slice_items()
+    dimension_index_values = create_dimension_index_values()
+    frames = []
+    for frame_index in range(TIME_FRAMES * SLICES):
+        content = Dataset()
+        content.update(time_items[TIME_INDICES[frame_index]])
+        content.DimensionIndexValues = [int(value) for value in dimension_index_values[frame_index]]
+        position = Dataset()
+        position.update(slice_items[SLICE_INDICES[frame_index]])
+        position.add_new("StackID", "US", int(SLICE_INDICES[frame_index]))
+        frame = Dataset()
+        frame.FrameContentSequence  = Sequence([content])
+        frame.PlanePositionSequence = Sequence([position])
+        frames.append(frame)
+    ds = Dataset()
+    ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+    return ds["PerFrameFunctionalGroupsSequence"]
+
+
+def test_encode_matches_pydicom():
+    buffer = create_buffer()
+    write_data_element(buffer, create_pydicom_element())
+    assert create_groups().encode() == buffer.getvalue()
+
+
+def test_to_sequence_reads_back():
+    sequence = create_groups().to_sequence()
+    assert len(sequence) == TIME_FRAMES * SLICES
+    last = sequence[-1]
+    assert last.FrameContentSequence[0].DimensionIndexValues == [TIME_FRAMES, SLICES - 1 + 70000]
+    assert "FrameAcquisitionDuration" not in last.FrameContentSequence[0]
+    assert sequence[0].FrameContentSequence[0].FrameAcquisitionDuration == 1000.
+    assert last.PlanePositionSequence[0].ImagePositionPatient[2] == pytest.approx((SLICES - 1) * 0.796)
+
+
+# Elements of a group added with the same indices are joined into one run per value
+def test_elements_with_the_same_indices_are_merged():
+    groups = create_groups()
+    group  = groups.groups[Tag("FrameContentSequence")]
+    runs   = groups.merge_runs(group)
+    assert len(runs) == 2
+    assert len(runs[0][0]) == TIME_FRAMES
+    assert len(runs[1][0]) == TIME_FRAMES * SLICES
+
+
+def test_bad_values_are_refused():
+    groups = PerFrameFunctionalGroups(2)
+    with pytest.raises(Exception, match="do not fit"):
+        groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "US", [[1], [65536]])
+    with pytest.raises(Exception, match="one index per frame"):
+        groups.add_elements("PlanePositionSequence", create_slice_items(), [0, 1, 2])
+    groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "UL", [[1], [2]])
+    with pytest.raises(Exception, match="already"):
+        groups.add_integer_element("FrameContentSequence", "DimensionIndexValues", "UL", [[1], [2]])
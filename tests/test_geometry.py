@@ -0,0 +1,40 @@
+import numpy
+import pytest
+
+from inveonimaging.inveon import InveonHeader
+from inveonimaging.geometry import ImageGeometry, ORIENTATION_DIRECTIONS
+
+
+def create_header(orientation: int) -> InveonHeader:
+    return InveonHeader({"x_dimension":         "8",
+                         "y_dimension":         "6",
+                         "z_dimension":         "5",
+                         "subject_orientation": str(orientation),
+                         "pixel_size_x":        "0.776383",
+                         "pixel_size_y":        "0.5",
+                         "pixel_size_z":        "0.796",
+                         "image_ref_shift":     "image_ref_shift 1.25 -2.5 3.125"})
+
+
+# The slice positions are computed as a signed permutation of the scanner coordinates;
+# the affine must describe the same geometry
+@pytest.mark.parametrize("orientation", sorted(ORIENTATION_DIRECTIONS))
+def test_affine_matches_slice_positions(orientation):
+    geometry = ImageGeometry(create_header(orientation))
+    affine   = geometry.get_affine()
+    slices   = numpy.arange(5)
+
+    voxels = numpy.zeros((len(slices), 4))
+    voxels[:, 2] = slices
+    voxels[:, 3] = 1
+    numpy.testing.assert_allclose((voxels @ affine.T)[:, :3], geometry.get_slice_positions(slices), atol=1e-9)
+
+
+@pytest.mark.parametrize("orientation", sorted(ORIENTATION_DIRECTIONS))
+def test_affine_matches_image_orientation(orientation):
+    geometry = ImageGeometry(create_header(orientation))
+    affine   = geometry.get_affine()
+    row_direction, column_direction = geometry.get_image_orientation()
+
+    numpy.testing.assert_allclose(affine[:3, 0] / 0.776383, row_direction)
+    numpy.testing.assert_allclose(affine[:3, 1] / 0.5, column_direction)
@@ -0,0 +1,147 @@
+import json
+import zlib
+import numpy
+import pytest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, RLELossless, generate_uid
+
+from inveonimaging.inveonRepatch import construct_values, repatch_file, repatch_folder
+from inveonimaging.rle import encode_rle_frame, write_encapsulated_frames
+
+
+ROWS    = 16
+COLUMNS = 12
+
+VALUES = construct_values({"patient_name":      "Repatched^Name",
+                           "patient_id":        "NEW-ID",
+                           "patient_sex":       "F",
+                           "study_description": "Repatched study"})
+
+
+def create_dataset(transfer_syntax) -> Dataset:
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID    = pydicom.uid.PositronEmissionTomographyImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID          = transfer_syntax
+    ds.SOPClassUID                = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID             = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.StudyDate                  = "20240102"
+    ds.Modality                   = "PT"
+    ds.StudyDescription           = "Original study"
+    ds.PatientName                = "Original^Name"
+    ds.PatientID                  = "OLD-ID"
+    ds.PatientBirthDate           = "20200101"
+    ds.PatientSex                 = "M"
+    ds.PatientWeight              = "0.025"
+    ds.SliceThickness             = "0.796"
+    ds.StudyInstanceUID           = generate_uid()
+    ds.SeriesInstanceUID          = generate_uid()
+    ds.Rows                       = ROWS
+    ds.Columns                    = COLUMNS
+    ds.SamplesPerPixel            = 1
+    ds.PhotometricInterpretation  = "MONOCHROME2"
+    ds.BitsAllocated              = 16
+    ds.BitsStored                 = 16
+    ds.HighBit                    = 15
+    ds.PixelRepresentation        = 1
+    ds.RescaleSlope               = "1.5"
+    ds.RescaleIntercept           = "0"
+    isotope = Dataset()
+    isotope.Radionuclide = "F^18"
+    ds.RadiopharmaceuticalInformationSequence = [isotope]
+
+    if (transfer_syntax != RLELossless):
+        ds.PixelData = create_pixels()
+        ds["PixelData"].VR = "OW"
+    return ds
+
+
+def create_pixels() -> bytes:
+    return numpy.random.default_rng(1).integers(-100, 30000, (ROWS, COLUMNS)).astype("<i2").tobytes()
+
+
+# Writes a file as the converter does; encapsulated PixelData is appended to a file written without it
+def write_file(path, transfer_syntax) -> None:
+    create_dataset(transfer_syntax).save_as(path, enforce_file_format=True)
+    if (transfer_syntax == RLELossless):
+        with open(path, "r+b") as fh:
+            fh.seek(0, 2)
+            write_encapsulated_frames(fh, [encode_rle_frame(create_pixels(), ROWS, COLUMNS)], 1, False)
+
+
+# The bytes of the data set after the File Meta Information, inflated when deflated
+def read_body(path) -> bytes:
+    file_meta = pydicom.filereader.read_file_meta_info(path)
+    with open(path, "rb") as fh:
+        fh.seek(128 + 4 + 12 + file_meta.FileMetaInformationGroupLength)
+        body = fh.read()
+    if (file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian):
+        body = zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+@pytest.mark.parametrize("transfer_syntax", [ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian, RLELossless],
+                         ids=["explicit", "deflated", "rle"])
+def test_repatch_changes_only_targeted_elements(transfer_syntax, tmp_path):
+    path = tmp_path / "image.dcm"
+    write_file(path, transfer_syntax)
+    before      = pydicom.dcmread(path)
+    before_body = read_body(path)
+
+    copied = repatch_file(str(path), VALUES)
+
+    after = pydicom.dcmread(path)
+    assert after.file_meta == before.file_meta
+    for keyword, value in VALUES.items():
+        assert after[keyword].value == value
+    assert after.PatientBirthDate == "20200101"
+
+    changed = [element.keyword for element in after if (element.tag not in before or element != before[element.tag])]
+    assert sorted(changed) == sorted(VALUES)
+    assert [element.tag for element in after] == [element.tag for element in before]
+
+    # Everything from the end of the Patient group on, PixelData included, is copied byte for byte
+    after_body = read_body(path)
+    assert copied > len(before.PixelData)
+    assert after_body[-copied:] == before_body[-copied:]
+    assert after["PixelData"].value == before["PixelData"].value
+
+
+def test_repatch_folder_patches_files_and_metadata(tmp_path):
+    series = tmp_path / "series"
+    series.mkdir()
+    for index, transfer_syntax in enumerate([ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian, RLELossless]):
+        write_file(series / f"image{index}.dcm", transfer_syntax)
+    (series / "notes.txt").write_text("not DICOM")
+    instances = [{"00080060": {"vr": "CS", "Value": ["PT"]},
+                  "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Original^Name"}]}}] * 2
+    (series / "metadata.json").write_text(json.dumps(instances))
+
+    count, copied = repatch_folder(str(tmp_path), VALUES, jobs=2)
+
+    assert count == 4
+    for index in range(3):
+        ds = pydicom.dcmread(series / f"image{index}.dcm")
+        assert (ds.PatientName, ds.PatientID, ds.StudyDescription) == ("Repatched^Name", "NEW-ID", "Repatched study")
+    for instance in json.loads((series / "metadata.json").read_text()):
+        assert instance["00080060"] == {"vr": "CS", "Value": ["PT"]}
+        assert instance["00100010"] == {"vr": "PN", "Value": [{"Alphabetic": "Repatched^Name"}]}
+        assert instance["00100040"] == {"vr": "CS", "Value": ["F"]}
+        assert list(instance) == sorted(instance)
+    assert (series / "notes.txt").read_text() == "not DICOM"
+    assert sorted(path.name for path in series.iterdir()) == ["image0.dcm", "image1.dcm", "image2.dcm",
+                                                              "metadata.json", "notes.txt"]
+
+
+def test_implicit_vr_files_are_refused(tmp_path):
+    path = tmp_path / "implicit.dcm"
+    create_dataset(pydicom.uid.ImplicitVRLittleEndian).save_as(path, enforce_file_format=True)
+    with pytest.raises(Exception, match="only explicit VR little endian"):
+        repatch_file(str(path), VALUES)
+
+
+def test_nothing_to_repatch_is_reported():
+    with pytest.raises(Exception, match="Nothing to re-patch"):
+        construct_values({"patient_name": None, "jobs": 2})
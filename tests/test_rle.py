@@ -0,0 +1,118 @@
+import io
+import numpy
+import pytest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.pixels.decoders.rle import _rle_decode_frame
+from pydicom.uid import RLELossless, generate_uid
+
+from inveonimaging.rle import (RLEFrameEncoder, encapsulate_frame, encode_rle_frame, get_max_rle_frame_length,
+                               write_encapsulated_frames)
+
+
+ROWS    = 6
+COLUMNS = 301
+
+
+# Frames of little endian int16 samples with rows that exercise the PackBits cases:
+# runs longer than RUN_LIMIT (and over a whole odd-width row), rows of only literal bytes,
+# runs of two and runs that would cross a row boundary
+def create_frames() -> list:
+    generator = numpy.random.default_rng(1)
+    frames = []
+    for index in range(4):
+        pixels = numpy.zeros((ROWS, COLUMNS), "<i2")
+        pixels[0, :]    = 1000 * index - 1
+        pixels[1, :]    = numpy.arange(COLUMNS) * 257 + index
+        pixels[2, :200] = 7
+        pixels[2, 200:] = generator.integers(-32768, 32767, COLUMNS - 200)
+        pixels[3, ::2]  = 5
+        pixels[3, 1::2] = generator.integers(-32768, 32767, COLUMNS // 2)
+        pixels[4, :]    = generator.integers(-32768, 32767, COLUMNS)
+        pixels[5, 129:] = -2
+        frames.append(pixels.tobytes())
+    frames.append(bytes(2 * ROWS * COLUMNS))
+    return frames
+
+
+def create_dataset(frame_count: int) -> Dataset:
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID    = pydicom.uid.SecondaryCaptureImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID          = RLELossless
+    ds.SOPClassUID                = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID             = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Rows                       = ROWS
+    ds.Columns                    = COLUMNS
+    ds.NumberOfFrames             = frame_count
+    ds.SamplesPerPixel            = 1
+    ds.PhotometricInterpretation  = "MONOCHROME2"
+    ds.BitsAllocated              = 16
+    ds.BitsStored                 = 16
+    ds.HighBit                    = 15
+    ds.PixelRepresentation        = 1
+    return ds
+
+
+def test_frames_decode_with_pydicom():
+    for frame in create_frames():
+        encoded = encode_rle_frame(frame, ROWS, COLUMNS)
+        assert len(encoded) <= get_max_rle_frame_length(ROWS, COLUMNS)
+        assert bytes(_rle_decode_frame(encoded, ROWS, COLUMNS, 1, 16)) == frame
+
+
+def test_encoder_jobs_keep_frame_order():
+    frames = create_frames() * 10
+    serial = list(RLEFrameEncoder(ROWS, COLUMNS, 2, 1).encode_frames(frames))
+    assert list(RLEFrameEncoder(ROWS, COLUMNS, 2, 2).encode_frames(frames)) == serial
+
+
+def test_single_frame_decodes_with_pydicom():
+    frame = create_frames()[0]
+    ds = create_dataset(1)
+    del ds.NumberOfFrames
+    ds.PixelData = encapsulate_frame(encode_rle_frame(frame, ROWS, COLUMNS))
+    ds["PixelData"].VR = "OB"
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+
+    decoded = pydicom.dcmread(io.BytesIO(buffer.getvalue())).pixel_array
+    assert decoded.astype("<i2").tobytes() == frame
+
+
+# PixelData is appended to a file written without it, as InstanceWriter does
+@pytest.mark.parametrize("extended", [False, True], ids=["basic", "extended"])
+def test_encapsulated_frames_decode_with_pydicom(extended, tmp_path):
+    frames = create_frames()
+    path   = tmp_path / "rle.dcm"
+    create_dataset(len(frames)).save_as(path, enforce_file_format=True)
+    with open(path, "r+b") as fh:
+        fh.seek(0, 2)
+        encoded = [encode_rle_frame(frame, ROWS, COLUMNS) for frame in frames]
+        write_encapsulated_frames(fh, iter(encoded), len(frames), extended)
+
+    ds = pydicom.dcmread(path)
+    assert ("ExtendedOffsetTable" in ds) == extended
+    if (extended):
+        offsets = numpy.frombuffer(ds.ExtendedOffsetTable, "<u8")
+        lengths = numpy.frombuffer(ds.ExtendedOffsetTableLengths, "<u8")
+        assert lengths.tolist() == [len(frame) for frame in encoded]
+    else:
+        offsets = numpy.frombuffer(ds.PixelData[8:8 + 4 * len(frames)], "<u4")
+    fragments = ds.PixelData[8 + (0 if (extended) else 4 * len(frames)):]
+    for offset, frame in zip(offsets, encoded):
+        assert fragments[offset + 8:offset + 8 + len(frame)] == frame
+
+    decoded = ds.pixel_array
+    assert decoded.shape == (len(frames), ROWS, COLUMNS)
+    for index, frame in enumerate(frames):
+        assert decoded[index].astype("<i2").tobytes() == frame
+
+
+def test_frame_count_mismatch_is_reported():
+    frames = [encode_rle_frame(frame, ROWS, COLUMNS) for frame in create_frames()]
+    with pytest.raises(Exception, match="expected"):
+        write_encapsulated_frames(io.BytesIO(), iter(frames), len(frames) + 1, False)
+    with pytest.raises(Exception, match="More than"):
+        write_encapsulated_frames(io.BytesIO(), iter(frames), len(frames) - 1, True)
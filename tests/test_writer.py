@@ -0,0 +1,121 @@
+import io
+import zlib
+import numpy
+import pytest
+import pydicom
+from pydicom.dataset import Dataset
+
+from inveonimaging.factory import Factory, PET_INSTANCE_KEYWORDS
+from inveonimaging.rle import encode_rle_frame
+from inveonimaging.writer import InstanceWriter
+
+
+ROWS    = 8
+COLUMNS = 6
+
+# SOP Instance UIDs of odd and even length, so the padded length changes between instances
+SOP_INSTANCE_UIDS = ["1.2.3.4.5.6.7", "1.2.3.4.5.6.78", "1.2.3.4.5.6.789.1", "1.2.3.4.5.6.7891.23"]
+RESCALE_SLOPES    = ["1", "0.5", "1.2345678E-3", "12.5"]
+
+
+# A template as Factory.create_file_dataset makes it, with elements before, between and
+# after the varying ones, a nested sequence and text that needs the character set
+def create_template(transfer_syntax: str):
+    ds = Dataset()
+    ds.SpecificCharacterSet       = "ISO_IR 100"
+    ds.SOPClassUID                = pydicom.uid.PositronEmissionTomographyImageStorage
+    ds.SOPInstanceUID             = SOP_INSTANCE_UIDS[0]
+    ds.StudyDate                  = "20240520"
+    ds.Modality                   = "PT"
+    ds.SeriesDescription          = "Séries dynamique"
+    ds.PatientName                = "Müller^Jörg"
+    ds.PatientID                  = "I"
+    ds.SliceThickness             = "0.796"
+    ds.StudyInstanceUID           = "1.2.3.4"
+    ds.SeriesInstanceUID          = "1.2.3.4.5"
+    ds.ImageOrientationPatient    = [1, 0, 0, 0, 1, 0]
+    ds.SamplesPerPixel            = 1
+    ds.PhotometricInterpretation  = "MONOCHROME2"
+    ds.Rows                       = ROWS
+    ds.Columns                    = COLUMNS
+    ds.PixelSpacing               = [0.776383, 0.776383]
+    ds.BitsAllocated              = 16
+    ds.BitsStored                 = 16
+    ds.HighBit                    = 15
+    ds.PixelRepresentation        = 1
+    ds.RescaleIntercept           = "0"
+    ds.Units                      = "BQML"
+    isotope = Dataset()
+    isotope.Radionuclide = "F^18"
+    ds.RadiopharmaceuticalInformationSequence = [isotope]
+
+    factory = Factory()
+    factory.set_transfer_syntax(transfer_syntax)
+    return factory.create_file_dataset(ds)
+
+
+# Sets the elements of one instance, as Factory.patch_pet_instance and write_instance do
+def patch_instance(template, index: int, transfer_syntax: str) -> None:
+    template.SOPInstanceUID       = SOP_INSTANCE_UIDS[index]
+    template.file_meta.MediaStorageSOPInstanceUID = template.SOPInstanceUID
+    template.InstanceNumber       = index + 1
+    template.RescaleSlope         = RESCALE_SLOPES[index]
+    template.ImagePositionPatient = [1.5, -2.25, index * 0.796]
+    template.SliceLocation        = index * 0.796
+    template.ImageIndex           = index + 1
+    pixels = (numpy.arange(ROWS * COLUMNS) * (index + 1)).astype("<i2")
+    if (transfer_syntax == "rle"):
+        Factory().set_encapsulated_pixel_data(template, encode_rle_frame(pixels.tobytes(), ROWS, COLUMNS))
+    else:
+        # The converter hands the writer a view on its slice buffer
+        template.PixelData = memoryview(pixels.tobytes())
+        template["PixelData"].VR = "OW"
+
+
+# What save_as writes for the template. Encapsulated PixelData from encapsulate_frame ends
+# with its sequence delimiter, which save_as would write a second time.
+def save_as_bytes(template) -> bytes:
+    pixels = template.PixelData
+    if (template["PixelData"].is_undefined_length):
+        template.PixelData = pixels[:-8]
+    elif (isinstance(pixels, memoryview)):
+        template.PixelData = bytes(pixels)
+    buffer = io.BytesIO()
+    template.save_as(buffer)
+    template.PixelData = pixels
+    return buffer.getvalue()
+
+
+# The file meta information and the inflated rest of a deflated file
+def inflate(data: bytes) -> tuple:
+    length = 128 + 4 + 12 + int.from_bytes(data[140:144], "little")
+    return data[:length], zlib.decompress(data[length:], -zlib.MAX_WBITS)
+
+
+@pytest.mark.parametrize("transfer_syntax", ["explicit", "rle"])
+def test_instances_match_save_as(transfer_syntax, tmp_path):
+    template = create_template(transfer_syntax)
+    writer   = InstanceWriter(PET_INSTANCE_KEYWORDS)
+    for index in range(len(SOP_INSTANCE_UIDS)):
+        patch_instance(template, index, transfer_syntax)
+        path = tmp_path / f"{index}.dcm"
+        writer.write(template, str(path))
+        writer.close()
+        assert path.read_bytes() == save_as_bytes(template)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_deflated_instances_match_save_as(jobs, tmp_path):
+    template = create_template("deflate")
+    writer   = InstanceWriter(PET_INSTANCE_KEYWORDS, deflate_level=6, jobs=jobs)
+    expected = []
+    for index in range(len(SOP_INSTANCE_UIDS)):
+        patch_instance(template, index, "deflate")
+        writer.write(template, str(tmp_path / f"{index}.dcm"))
+        expected.append(inflate(save_as_bytes(template)))
+    writer.close()
+
+    for index, instance in enumerate(expected):
+        data = (tmp_path / f"{index}.dcm").read_bytes()
+        assert len(data) % 2 == 0
+        assert inflate(data) == instance